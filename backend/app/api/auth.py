@@ -1,10 +1,13 @@
 from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Form
-from sqlmodel import Session, select
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from pydantic import BaseModel
-from app.db.session import get_session
+from typing import Optional
+from app.db.session import get_async_session
 from app.models.user import User
-from app.core.security import hash_password, verify_password, create_access_token
-from app.core.cloudinary import upload_profile_picture
+from app.core.security import password_hasher, create_access_token, invalidate_cached_user
+from app.services.user_search import username_index
+from app.services.avatars import discard_staged, stage_avatar, submit_profile_picture
 
 class UserLogin(BaseModel):
     username: str
@@ -13,57 +16,80 @@ class UserLogin(BaseModel):
 class Token(BaseModel):
     access_token: str
     token_type: str = "bearer"
+    upload_job_id: Optional[str] = None  # set when a profile picture is still being stored
 
 router = APIRouter()
 
 @router.post("/signup", response_model=Token)
-def signup(
+async def signup(
     username: str = Form(...),
     email: str = Form(...),
     password: str = Form(...),
     full_name: str = Form(...),
     gender: str = Form("other"),
     file: UploadFile = File(None), # Optional: User might not upload a pfp
-    session: Session = Depends(get_session)):
-    existing = session.exec(
+    session: AsyncSession = Depends(get_async_session)):
+    existing = (await session.exec(
         select(User).where(User.username == username)
-    ).first()
+    )).first()
 
     if existing:
         raise HTTPException(status_code=400, detail="Username Already Taken")
     
-    existing_email = session.exec(select(User).where(User.email == email)).first()
+    existing_email = (await session.exec(select(User).where(User.email == email))).first()
     if existing_email:
         raise HTTPException(status_code=400, detail="Email Already Registered")
     
-    image_url = None
-    if file:
-        image_url = upload_profile_picture(file.file)
+    # Staged before the user exists, so a rejected file doesn't leave a half signed up account
+    staged_avatar = await stage_avatar(file) if file else None
+
+    try:
+        # bcrypt is CPU bound, keep it off the event loop
+        hashed_password = await password_hasher.hash(password)
+    except HTTPException:
+        discard_staged(staged_avatar)
+        raise
 
     new_user = User(
         username=username,
         email=email,
-        hashed_password=hash_password(password),
+        hashed_password=hashed_password,
         full_name=full_name,
         gender=gender,
-        profile_picture=image_url,
+        profile_picture=None,
         bio="Hey there! I'm ready to chat anytime"
     )
     session.add(new_user)
-    session.commit()
-    session.refresh(new_user)
+    await session.commit()
+    username_index.add(new_user.username, new_user.id)
+
+    # The picture is stored in the background and saved on the user when ready
+    upload_job_id = None
+    if staged_avatar:
+        upload_job_id = (await submit_profile_picture(staged_avatar, new_user.id, new_user.username)).id
     
     token = create_access_token({"sub": new_user.username})
-    return {"access_token": token}
+    return {"access_token": token, "upload_job_id": upload_job_id}
 
 @router.post("/login", response_model=Token)
-def login(user: UserLogin, session: Session = Depends(get_session)):
-    db_user = session.exec(
+async def login(user: UserLogin, session: AsyncSession = Depends(get_async_session)):
+    db_user = (await session.exec(
         select(User).where(User.username == user.username)
-    ).first()
+    )).first()
 
-    if not db_user or not verify_password(user.password, db_user.hashed_password):
+    if not db_user:
         raise HTTPException(status_code=401, detail="Invalid Credentials")
+
+    valid, new_hash = await password_hasher.verify_and_update(user.password, db_user.hashed_password)
+    if not valid:
+        raise HTTPException(status_code=401, detail="Invalid Credentials")
+
+    if new_hash:
+        # Stored hash predates the current BCRYPT_ROUNDS, upgrade it while we have the password
+        db_user.hashed_password = new_hash
+        session.add(db_user)
+        await session.commit()
+        invalidate_cached_user(db_user.username)
     
     token = create_access_token({"sub": db_user.username})
     return {"access_token": token}
\ No newline at end of file
@@ -1,52 +1,287 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException
-from sqlmodel import Session, select, or_, update
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, Query, Response
+from sqlmodel import select
+from sqlalchemy.exc import IntegrityError
+from sqlmodel.ext.asyncio.session import AsyncSession
 from typing import List, Optional
 from datetime import datetime
-import json
+import asyncio
+import time
 from pydantic import BaseModel
 
-from app.db.session import get_session
+from app.core.config import settings
+from app.db.session import get_async_session, async_session_maker
 from app.models.user import User
 from app.models.message import Message
 from app.websockets.manager import manager
-from app.core.security import verify_token, get_current_user
+from app.websockets.protocol import negotiate_subprotocol, receive_events
+from app.services.conversations import get_summary, mark_conversation_read, read_watermarks
+from app.services.groups import group_members
+from app.services.friends import friend_graph
+from app.services.presence import presence
+from app.services.history import fetch_message_page
+from app.services.message_writer import message_writer
+from app.services.sync import missed_since
+from app.services.delivery import delivery_tracker, recent_client_ids, find_by_client_id
+from app.services.attachments import claim_attachment, release_attachment
+from app.services.message_search import message_search
+from app.core.security import verify_token, get_current_user_async
+from app.core.rate_limit import SocketThrottle, rate_limit_writes
+from app.core.metrics import MESSAGES_INGESTED, MESSAGE_WRITE_SECONDS, WS_THROTTLED
+from app.core.profiler import query_profiler
 
 
 router = APIRouter()
 
+# Close code for sockets that sent nothing, not even a heartbeat, within the idle timeout
+IDLE_CLOSE_CODE = 4001
+# Close code for sockets that kept sending while throttled
+RATE_LIMIT_CLOSE_CODE = 4029
+# Socket events that are never throttled
+UNTHROTTLED_EVENTS = {"ping", "delivered"}
+
 class MessageResponse(BaseModel):
     id: int
     sender_id: int
-    receiver_id: int
+    receiver_id: Optional[int] = None
+    group_id: Optional[int] = None
     content: str
     timestamp: datetime
     is_read:bool
     reply_to_id: Optional[int] = None
+    client_msg_id: Optional[str] = None
+    message_type: Optional[str] = "text"
+    media_url: Optional[str] = None
+    media_name: Optional[str] = None
+    media_mime: Optional[str] = None
+    media_size: Optional[int] = None
+    media_width: Optional[int] = None
+    media_height: Optional[int] = None
+    media_thumbnail: Optional[str] = None
+    media_blurhash: Optional[str] = None
 
     class Config:
         from_attributes = True
 
+class MessageSearchResult(MessageResponse):
+    snippet: str  # HTML-escaped, hits wrapped in <mark>
+
 @router.get("/history/{friend_id}", response_model=List[MessageResponse])
-def get_chat_history(
+async def get_chat_history(
     friend_id: int,
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+    response: Response,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = Query(settings.HISTORY_PAGE_SIZE, ge=1, le=settings.HISTORY_MAX_PAGE_SIZE),
+    session: AsyncSession = Depends(get_async_session),
+    current_user: User = Depends(get_current_user_async)
 ):
-    statement = select(Message).where(
-        or_ (
-            (Message.sender_id == current_user.id) & (Message.receiver_id == friend_id),
-            (Message.sender_id == friend_id) & (Message.receiver_id == current_user.id)
-        )
-    ).order_by(Message.timestamp.asc())
+    # One branch per direction, each an ix_message_conversation range scan
+    branches = [
+        select(Message).where((Message.sender_id == current_user.id) & (Message.receiver_id == friend_id)),
+        select(Message).where((Message.sender_id == friend_id) & (Message.receiver_id == current_user.id)),
+    ]
+    messages = await fetch_message_page(session, branches, response, before_id, after_id, limit)
+
+    # Read state comes from the two read watermarks, not the legacy is_read column
+    my_watermark, friend_watermark = await read_watermarks(session, current_user.id, friend_id)
+    results = []
+    for message in messages:
+        watermark = friend_watermark if message.sender_id == current_user.id else my_watermark
+        result = MessageResponse.model_validate(message)
+        result.is_read = message.id <= watermark
+        results.append(result)
+    return results
+
+@router.get("/search", response_model=List[MessageSearchResult], dependencies=[Depends(rate_limit_writes)])
+async def search_messages(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=200),
+    cursor: int = Query(0, ge=0, le=settings.SEARCH_MAX_OFFSET),
+    limit: int = Query(settings.SEARCH_PAGE_SIZE, ge=1, le=settings.SEARCH_MAX_PAGE_SIZE),
+    peer_id: Optional[int] = None,
+    group_id: Optional[int] = None,
+    session: AsyncSession = Depends(get_async_session),
+    current_user: User = Depends(get_current_user_async)
+):
+    # Rate limited like writes: a search costs far more than a history page
+    if not message_search.available:
+        raise HTTPException(status_code=503, detail="Message search is not available")
+
+    # Ranked, so the cursor is an offset; fetch one extra row to know whether there is more
+    rows = await message_search.search(session, current_user.id, q, cursor, limit + 1, peer_id, group_id)
+    if len(rows) > limit:
+        response.headers["X-Next-Cursor"] = str(cursor + limit)
+
+    return [
+        MessageSearchResult(**MessageResponse.model_validate(message).model_dump(), snippet=snippet)
+        for message, snippet in rows[:limit]
+    ]
+
+@router.get("/ws/stats")
+async def get_socket_stats(current_user: User = Depends(get_current_user_async)):
+    # Send-queue depth per node, to spot backpressure from slow consumers
+    return manager.stats()
+
+def _message_payload(message: Message) -> dict:
+    return {
+        "id": message.id,
+        "sender_id": message.sender_id,
+        "receiver_id": message.receiver_id,
+        "group_id": message.group_id,
+        "content": message.content,
+        "reply_to_id": message.reply_to_id,
+        "client_msg_id": message.client_msg_id,
+        "message_type": message.message_type,
+        "media_url": message.media_url,
+        "media_name": message.media_name,
+        "media_mime": message.media_mime,
+        "media_size": message.media_size,
+        "media_width": message.media_width,
+        "media_height": message.media_height,
+        "media_thumbnail": message.media_thumbnail,
+        "media_blurhash": message.media_blurhash,
+        "timestamp": message.timestamp.isoformat(),
+        "is_read": False
+    }
+
+def _ack(user_id: int, websocket: WebSocket, client_msg_id: Optional[str], message_id: int, duplicate: bool = False):
+    # Only the sending socket needs to know its frame was stored
+    manager.send_to_socket(user_id, websocket, {
+        "type": "ACK",
+        "client_msg_id": client_msg_id,
+        "id": message_id,
+        "duplicate": duplicate
+    })
+
+async def _replay_missed(user_id: int, websocket: WebSocket, since: int):
+    missed = await missed_since(user_id, since)
+    if missed is None:
+        manager.send_to_socket(user_id, websocket, {"type": "RESYNC_REQUIRED"})
+        return
+
+    messages, read_updates = missed
+    batch_size = settings.SYNC_BATCH_SIZE
+    batches = [messages[i:i + batch_size] for i in range(0, len(messages), batch_size)] or [[]]
+    for index, batch in enumerate(batches):
+        frame = {
+            "type": "SYNC",
+            "messages": [_message_payload(message) for message in batch],
+            "done": index == len(batches) - 1,
+        }
+        if frame["done"]:
+            frame["read_updates"] = [
+                {"reader_id": reader_id, "last_read_message_id": watermark}
+                for reader_id, watermark in read_updates
+            ]
+        manager.send_to_socket(user_id, websocket, frame)
+
+async def _handle_event(user_id: int, websocket: WebSocket, message_data: dict):
+    received_at = time.perf_counter()
+    if message_data.get("type") == "ping":
+        manager.send_to_socket(user_id, websocket, {"type": "pong"})
+        return
+
+    if message_data.get("type") == "delivered":
+        # Recipient has everything from peer_id up to message_id; flushed in bulk
+        peer_id = message_data.get("peer_id")
+        message_id = message_data.get("message_id")
+        if isinstance(peer_id, int) and isinstance(message_id, int):
+            delivery_tracker.record(user_id, peer_id, message_id)
+        return
+
+    receiver_id = message_data.get("receiver_id")
+    group_id = message_data.get("group_id")
+    content = message_data.get("content")
+    reply_to_id = message_data.get("reply_to_id")
+    client_msg_id = message_data.get("client_msg_id")
+    if client_msg_id is not None:
+        client_msg_id = str(client_msg_id)[:64]
+    # Finished attachment upload; content is then an optional caption
+    upload_job_id = message_data.get("upload_job_id")
+
+    if not (receiver_id or group_id) or not (content or upload_job_id):
+        return
 
-    messages = session.exec(statement).all()
-    return messages
+    if client_msg_id:
+        # A resend of something already stored: ack again, don't store or fan out twice
+        existing_id = recent_client_ids.get(user_id, client_msg_id)
+        if existing_id is not None:
+            _ack(user_id, websocket, client_msg_id, existing_id, duplicate=True)
+            return
+
+    if group_id:
+        receiver_id = None
+        if not await group_members.is_member(group_id, user_id):
+            return
+
+    media = {}
+    if upload_job_id:
+        media = await claim_attachment(str(upload_job_id), user_id)
+        if media is None:
+            if client_msg_id:
+                # Already sent: this is a resend the dedupe cache didn't see
+                existing = await find_by_client_id(user_id, client_msg_id)
+                if existing:
+                    recent_client_ids.add(user_id, client_msg_id, existing.id)
+                    _ack(user_id, websocket, client_msg_id, existing.id, duplicate=True)
+                    return
+            # Unknown, not the sender's, still processing or already in another message;
+            # clients send after UPLOAD_READY
+            manager.send_to_socket(user_id, websocket, {
+                "type": "REJECTED",
+                "client_msg_id": client_msg_id,
+                "reason": "upload_not_ready"
+            })
+            return
+    
+    new_message = Message(
+        sender_id=user_id,
+        receiver_id=receiver_id,
+        group_id=group_id,
+        content=content or "",
+        reply_to_id=reply_to_id,
+        client_msg_id=client_msg_id,
+        timestamp=datetime.utcnow(),
+        is_read=False,
+        **media
+    )
+    try:
+        # Returns once committed, possibly as part of a batch with other sockets
+        new_message = await message_writer.write(new_message)
+    except Exception as e:
+        if media:
+            # Not stored, so the attachment can still be sent
+            await release_attachment(str(upload_job_id))
+        if not client_msg_id or not isinstance(e, IntegrityError):
+            raise
+        # Cache missed it (restart, other worker); the unique index didn't
+        existing = await find_by_client_id(user_id, client_msg_id)
+        if existing:
+            recent_client_ids.add(user_id, client_msg_id, existing.id)
+            _ack(user_id, websocket, client_msg_id, existing.id, duplicate=True)
+        return
+
+    MESSAGE_WRITE_SECONDS.observe(time.perf_counter() - received_at)
+    MESSAGES_INGESTED.labels("group" if group_id else "direct").inc()
+
+    if client_msg_id:
+        recent_client_ids.add(user_id, client_msg_id, new_message.id)
+    _ack(user_id, websocket, client_msg_id, new_message.id)
+
+    response_payload = _message_payload(new_message)
+    if group_id:
+        # Every member, sender included, gets the message from the cached index
+        await manager.broadcast(response_payload, await group_members.members(group_id))
+        return
+
+    # Send to receiever(if online) and back to sender(to update the UI)
+    await manager.broadcast(response_payload, [receiver_id, user_id])
 
 @router.websocket("/ws/{token}")
 async def websocket_endpoint(
     websocket: WebSocket,
     token: str,
-    session: Session = Depends(get_session)
+    since: Optional[int] = None
 ):
     payload = verify_token(token)
     if not payload:
@@ -54,86 +289,100 @@ async def websocket_endpoint(
         return
     
     username = payload.get("sub")
-    user = session.exec(select(User).where(User.username == username)).first()
+    async with async_session_maker() as session:
+        user = (await session.exec(select(User).where(User.username == username))).first()
 
     if not user:
         await websocket.close(code=4003)
         return
     
     user_id = user.id
-    await manager.connect(user_id, websocket)
+    await manager.connect(user_id, websocket, negotiate_subprotocol(websocket))
+    await presence.connected(user_id)
+
+    throttle = SocketThrottle(username)
 
     try:
+        if since is not None:
+            # Subscribed before querying, so nothing falls in between; clients dedupe by id
+            await _replay_missed(user_id, websocket, since)
+
         while True:
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
-
-            receiver_id = message_data.get("receiver_id")
-            content = message_data.get("content")
-            reply_to_id = message_data.get("reply_to_id")
-
-            if not receiver_id or not content:
-                continue
-            
-            new_message = Message(
-                sender_id=user_id,
-                receiver_id=receiver_id,
-                content=content,
-                reply_to_id=reply_to_id,
-                timestamp=datetime.utcnow(),
-                is_read=False
-            )
-            session.add(new_message)
-            session.commit()
-            session.refresh(new_message)
-
-            response_payload = {
-                "id": new_message.id,
-                "sender_id": user_id,
-                "receiver_id": receiver_id,
-                "content": content,
-                "reply_to_id": reply_to_id,
-                "timestamp": new_message.timestamp.isoformat(),
-                "is_read": False
-            }
-            # Send to receiever(if online)
-            await manager.send_personal_message(response_payload, receiver_id)
-            # Send back to sender(to update the UI)
-            await manager.send_personal_message(response_payload, user_id)
+            try:
+                events = await asyncio.wait_for(
+                    receive_events(websocket, settings.WS_FRAME_BATCH_MAX),
+                    timeout=settings.PRESENCE_IDLE_TIMEOUT_SECONDS
+                )
+            except asyncio.TimeoutError:
+                # No message or heartbeat for too long, treat the client as gone
+                await websocket.close(code=IDLE_CLOSE_CODE)
+                break
+
+            await presence.touch(user_id)
+            # Binary frames may carry several events; they are handled in order
+            for message_data in events:
+                # Heartbeats and delivery acks are cheap and must not starve under load
+                retry_after = 0.0 if message_data.get("type") in UNTHROTTLED_EVENTS else throttle.check()
+                if not retry_after:
+                    with query_profiler.profile(f"WS {message_data.get('type', 'message')}"):
+                        await _handle_event(user_id, websocket, message_data)
+                    continue
+
+                # Throttled events are dropped; one notice per run of them
+                WS_THROTTLED.inc()
+                if throttle.strikes == 1:
+                    manager.send_to_socket(user_id, websocket, {"type": "THROTTLED", "retry_after": retry_after})
+                if throttle.abusive:
+                    await websocket.close(code=RATE_LIMIT_CLOSE_CODE)
+                    return
 
     except WebSocketDisconnect:
-        manager.disconnect(user_id, websocket)
+        pass
+    finally:
+        await manager.disconnect(user_id, websocket)
+        await presence.disconnected(user_id)
 
-@router.put("/read/{sender_id}")
+@router.get("/presence")
+async def get_presence(
+    user_ids: List[int] = Query(...),
+    current_user: User = Depends(get_current_user_async)
+):
+    # Presence is only visible to friends
+    friend_ids = await friend_graph.friends_of(current_user.id)
+    visible = [user_id for user_id in user_ids if user_id in friend_ids or user_id == current_user.id]
+    return await presence.snapshot(visible)
+
+@router.put("/read/{sender_id}", dependencies=[Depends(rate_limit_writes)])
 async def mark_messages_as_read(
     sender_id: int,
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+    session: AsyncSession = Depends(get_async_session),
+    current_user: User = Depends(get_current_user_async)
 ):
-    statement = (
-        update(Message)
-        .where(
-            (Message.sender_id == sender_id) &
-            (Message.receiver_id == current_user.id) &
-            (Message.is_read == False)
-        )
-        .values(is_read = True)
-    )
+    summary = await get_summary(session, current_user.id, sender_id)
 
-    result = session.exec(statement)
-    session.commit()
+    if not summary or summary.last_read_message_id == summary.last_message_id:
+        return {"status": "already_read"}
 
-    updated_count = result.rowcount
+    updated_count = summary.unread_count
+    await mark_conversation_read(session, current_user.id, sender_id)
+    await session.commit()
+    await session.refresh(summary)
 
+    # Watermark only caught up with our own messages, nothing new to report
     if updated_count == 0:
         return {"status": "already_read"}
     
     try:
+        # Clients mark everything they sent up to the watermark as read
         await manager.send_personal_message(
-            {"type":"READ_UPDATE", "reader_id": current_user.id},
+            {
+                "type":"READ_UPDATE",
+                "reader_id": current_user.id,
+                "last_read_message_id": summary.last_read_message_id
+            },
             sender_id
         )
     except Exception as e:
         print(f"User {sender_id} is offline, skipping real-time update")
     
-    return {"status": "success", "count": updated_count}
\ No newline at end of file
+    return {"status": "success", "count": updated_count}
@@ -2,14 +2,18 @@ from datetime import datetime
 
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
-from sqlmodel import Session, select, or_, desc, func
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from typing import List, Optional
-from app.models.message import Message
+from app.models.conversation import ConversationSummary
 
-from app.db.session import get_session
+from app.db.session import get_async_session
 from app.models.user import User
 from app.models.friend import FriendRequest, FriendStatus
-from app.core.security import get_current_user
+from app.core.security import get_current_user_async
+from app.core.rate_limit import rate_limit_writes
+from app.services.friends import friend_graph, canonical_pair
 
 router = APIRouter()
 
@@ -32,6 +36,7 @@ class FriendResponse(BaseModel):
     bio: Optional[str] = None
     gender: Optional[str] = None
     profile_picture: Optional[str] = None
+    profile_thumbnail: Optional[str] = None
     allow_stranger_dms: bool
     last_message_time: Optional[datetime] = None     #Used for sorting friends by recent activity
     last_message_content: Optional[str] = None  #Used to show a preview of last msg in chatsidebar
@@ -39,50 +44,31 @@ class FriendResponse(BaseModel):
 
 
 @router.get("/friends", response_model=List[FriendResponse]) 
-def get_my_friends(
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+async def get_my_friends(
+    session: AsyncSession = Depends(get_async_session),
+    current_user: User = Depends(get_current_user_async)
 ):
-    query = select(FriendRequest).where(
-        (FriendRequest.status == FriendStatus.ACCEPTED) &
-        (
-            (FriendRequest.sender_id == current_user.id) | 
-            (FriendRequest.receiver_id == current_user.id)
-        )
-    )
-    connections = session.exec(query).all()
-
-    friend_ids = []
-    for conn in connections:
-        if conn.sender_id == current_user.id:
-            friend_ids.append(conn.receiver_id)
-        else:
-            friend_ids.append(conn.sender_id)
+    friend_ids = await friend_graph.friends_of(current_user.id)
 
     if not friend_ids:
         return []
 
-    friends = session.exec(select(User).where(User.id.in_(friend_ids))).all()
+    # Summaries are kept up to date on send/read, so this is one indexed read
+    statement = (
+        select(User, ConversationSummary)
+        .outerjoin(
+            ConversationSummary,
+            (ConversationSummary.peer_id == User.id) &
+            (ConversationSummary.user_id == current_user.id)
+        )
+        .where(User.id.in_(friend_ids))
+        .order_by(ConversationSummary.last_message_time.desc().nulls_last())
+    )
+    rows = (await session.exec(statement)).all()
 
     friend_responses = []
 
-    for f in friends:
-        stmt = select(Message).where(
-            or_(
-                (Message.sender_id == current_user.id) & (Message.receiver_id == f.id),
-                (Message.sender_id == f.id) & (Message.receiver_id == current_user.id)
-            )
-        ).order_by(desc(Message.timestamp)).limit(1)
-
-        unread_count = session.exec(
-            select(func.count(Message.id)).where(
-                (Message.sender_id == f.id) & 
-                (Message.receiver_id == current_user.id) &
-                (Message.is_read == False)
-                )
-            ).one()
-
-        last_msg = session.exec(stmt).first()
+    for f, summary in rows:
         friend_responses.append(
             FriendResponse(
                 id=f.id,
@@ -92,34 +78,32 @@ def get_my_friends(
                 bio=f.bio,
                 gender=f.gender,
                 profile_picture=f.profile_picture,
+                profile_thumbnail=f.profile_thumbnail,
                 allow_stranger_dms=f.allow_stranger_dms,
-                last_message_content=str(last_msg.content) if last_msg else None,
-                last_message_time=last_msg.timestamp if last_msg else None,
-                unread_count=unread_count if unread_count else 0
+                last_message_content=summary.last_message_preview if summary else None,
+                last_message_time=summary.last_message_time if summary else None,
+                unread_count=summary.unread_count if summary else 0
             )
         )
-    friend_responses.sort(
-        key=lambda x: x.last_message_time or datetime.min,
-        reverse=True
-    )
     return friend_responses
     
-@router.post("/request/{username}")
-def send_friend_request(username: str, 
-                        session: Session = Depends(get_session),
-                        current_user: User = Depends(get_current_user)):
+@router.post("/request/{username}", dependencies=[Depends(rate_limit_writes)])
+async def send_friend_request(username: str, 
+                              session: AsyncSession = Depends(get_async_session),
+                              current_user: User = Depends(get_current_user_async)):
     if current_user.username == username:
         raise HTTPException(status_code=400, detail="You cannot send a friend request to yourself")
-    target_user = session.exec(select(User).where(User.username == username)).first()
+    target_user = (await session.exec(select(User).where(User.username == username))).first()
     if not target_user:
         raise HTTPException(status_code=404, detail="User Not Found")
     
-    existing_request = session.exec(select(FriendRequest).where(
-        or_(
-            (FriendRequest.sender_id == current_user.id) & (FriendRequest.receiver_id == target_user.id),
-            (FriendRequest.sender_id == target_user.id) & (FriendRequest.receiver_id == current_user.id)
-        )
-    )).first()
+    if await friend_graph.are_friends(current_user.id, target_user.id):
+        raise HTTPException(status_code=400, detail="You are already Friends.")
+
+    pair_low_id, pair_high_id = canonical_pair(current_user.id, target_user.id)
+    existing_request = (await session.exec(select(FriendRequest).where(
+        (FriendRequest.pair_low_id == pair_low_id) & (FriendRequest.pair_high_id == pair_high_id)
+    ))).first()
 
     if existing_request:
         if existing_request.status == FriendStatus.ACCEPTED:
@@ -129,22 +113,29 @@ def send_friend_request(username: str,
     new_request = FriendRequest(
         sender_id=current_user.id,
         receiver_id=target_user.id,
+        pair_low_id=pair_low_id,
+        pair_high_id=pair_high_id,
         status=FriendStatus.PENDING,
     )
     session.add(new_request)
-    session.commit()
+    try:
+        await session.commit()
+    except IntegrityError:
+        # Both users sent a request at the same moment; the pair index let only one through
+        await session.rollback()
+        raise HTTPException(status_code=400, detail="Your Friend Request is Pending")
     return {"message": "Friend Request Sent"}
 
 @router.get("/requests/pending", response_model=List[FriendRequestWithSender])
-def get_pending_requests(
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+async def get_pending_requests(
+    session: AsyncSession = Depends(get_async_session),
+    current_user: User = Depends(get_current_user_async)
 ):
     statement = select(FriendRequest, User).join(User, FriendRequest.sender_id == User.id).where(
         (FriendRequest.receiver_id == current_user.id) & 
         (FriendRequest.status == FriendStatus.PENDING)
     )
-    requests = session.exec(statement).all()
+    requests = (await session.exec(statement)).all()
 
     response_data = []
     for request, sender in requests:
@@ -159,13 +150,13 @@ def get_pending_requests(
 
     return response_data
 
-@router.post("/accept/{request_id}")
-def accept_friend_request(
+@router.post("/accept/{request_id}", dependencies=[Depends(rate_limit_writes)])
+async def accept_friend_request(
     request_id: int, 
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+    session: AsyncSession = Depends(get_async_session),
+    current_user: User = Depends(get_current_user_async)
 ):
-    friend_request = session.get(FriendRequest, request_id)
+    friend_request = await session.get(FriendRequest, request_id)
 
     if not friend_request:
         raise HTTPException(status_code=404, detail="Request Not Found")
@@ -175,20 +166,21 @@ def accept_friend_request(
     
     friend_request.status = FriendStatus.ACCEPTED
     session.add(friend_request)
-    session.commit()
+    await session.commit()
+    friend_graph.add_friendship(friend_request.sender_id, friend_request.receiver_id)
 
     return {"message": "Friend Request Accepted! You can chat now."}
 
-@router.post("/reject/{request_id}")
-def reject_friend_request(
+@router.post("/reject/{request_id}", dependencies=[Depends(rate_limit_writes)])
+async def reject_friend_request(
     request_id: int,
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+    session: AsyncSession = Depends(get_async_session),
+    current_user: User = Depends(get_current_user_async)
 ):
     statement = select(FriendRequest).where(
         FriendRequest.id == request_id
     )
-    friend_request = session.exec(statement).first()
+    friend_request = (await session.exec(statement)).first()
 
     if not friend_request:
         raise HTTPException(status_code=404, detail="Request not found")
@@ -196,35 +188,23 @@ def reject_friend_request(
     if friend_request.receiver_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not Authorized")
     
-    session.delete(friend_request)
-    session.commit()
+    await session.delete(friend_request)
+    await session.commit()
+    friend_graph.remove_friendship(friend_request.sender_id, friend_request.receiver_id)
 
     return {"message": "Friend request rejected and removed"}
 
 @router.get("/list", response_model=List[Friend])
-def get_friends_list(
-    session : Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+async def get_friends_list(
+    session : AsyncSession = Depends(get_async_session),
+    current_user: User = Depends(get_current_user_async)
 ):
-    statement = select(FriendRequest).where(
-        (FriendRequest.status == FriendStatus.ACCEPTED) & (
-                                            (FriendRequest.sender_id == current_user.id) | 
-                                            (FriendRequest.receiver_id == current_user.id) )
-                                            )
-    
-    connections = session.exec(statement).all()
-
-    friend_ids = []
-    for conn in connections:
-        if conn.sender_id == current_user.id:
-            friend_ids.append(conn.receiver_id)
-        else:
-            friend_ids.append(conn.sender_id)
+    friend_ids = await friend_graph.friends_of(current_user.id)
     
     if not friend_ids:
         return []
     
-    friends = session.exec(select(User).where(User.id.in_(friend_ids))).all()
+    friends = (await session.exec(select(User).where(User.id.in_(friend_ids)))).all()
 
     return [
         Friend(id=f.id, username=f.username, email=f.email)
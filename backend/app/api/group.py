@@ -1,16 +1,21 @@
 from typing import Optional, List
-from fastapi import APIRouter, Depends, HTTPException
-from sqlmodel import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from pydantic import BaseModel
-from app.db.session import get_session
+from app.core.config import settings
+from app.db.session import get_async_session
 from app.models.user import User
-from app.core.security import get_current_user
+from app.models.message import Message
+from app.core.security import get_current_user_async
 from app.models.group import Group, GroupMember 
+from app.services.groups import group_members
+from app.services.history import fetch_message_page
+from app.services.avatars import stage_avatar, submit_group_avatar
+from app.api.chat import MessageResponse
 
-import uuid
-import cloudinary.uploader
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
-from app.core.security import get_current_user
+from fastapi import UploadFile, File
+from app.core.rate_limit import rate_limit_writes
 from app.models.user import User
 
 router = APIRouter()
@@ -30,11 +35,11 @@ class GroupResponse(BaseModel):
     created_at: str
     member_count: int
 
-@router.post("/create", response_model=GroupResponse)
+@router.post("/create", response_model=GroupResponse, dependencies=[Depends(rate_limit_writes)])
 async def create_group(
     group_data: GroupCreate, 
-    session: Session = Depends(get_session), 
-    current_user: User = Depends(get_current_user)):
+    session: AsyncSession = Depends(get_async_session), 
+    current_user: User = Depends(get_current_user_async)):
     
     if not group_data.name.strip():
         raise HTTPException(status_code=400, detail="Group name cannot be empty")
@@ -47,8 +52,7 @@ async def create_group(
         creator_id=current_user.id 
     )
     session.add(new_group)
-    session.commit()
-    session.refresh(new_group)
+    await session.commit()
     
     # 2. Actually add the creator to the group!
     admin_member = GroupMember(
@@ -74,7 +78,7 @@ async def create_group(
             session.add(new_member)
             valid_member_count += 1
     
-    session.commit()
+    await session.commit()
 
     return GroupResponse(
         id=new_group.id,
@@ -86,26 +90,27 @@ async def create_group(
         member_count=valid_member_count
     )
 
-@router.post("/upload-avatar")
+@router.get("/{group_id}/history", response_model=List[MessageResponse])
+async def get_group_history(
+    group_id: int,
+    response: Response,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = Query(settings.HISTORY_PAGE_SIZE, ge=1, le=settings.HISTORY_MAX_PAGE_SIZE),
+    session: AsyncSession = Depends(get_async_session),
+    current_user: User = Depends(get_current_user_async)
+):
+    if not await group_members.is_member(group_id, current_user.id):
+        raise HTTPException(status_code=403, detail="You are not a member of this group")
+
+    statement = select(Message).where(Message.group_id == group_id)
+    return await fetch_message_page(session, [statement], response, before_id, after_id, limit)
+
+@router.post("/upload-avatar", dependencies=[Depends(rate_limit_writes)])
 async def upload_group_avatar(
     file: UploadFile = File(...),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user_async)
 ):
-    try:
-        custom_filename = f"group_avatar_{uuid.uuid4().hex[:10]}"
-
-        result = cloudinary.uploader.upload(
-            file.file,
-            folder="chat_app_group_avatars",
-            public_id=custom_filename,
-            transformation=[
-                {"width": 500, "height": 500, "crop": "fill"},
-                {"quality": "auto"}
-            ]
-        )
-        
-        return {"url": result.get("secure_url")}
-        
-    except Exception as e:
-        print(f"Cloudinary Error : {e}")
-        raise HTTPException(status_code=500, detail="Failed to upload image")
\ No newline at end of file
+    job = await submit_group_avatar(await stage_avatar(file), current_user.id)
+    # The URL is final and usable on the group right away; the file lands there shortly
+    return {"url": job.url, "job_id": job.id, "status": job.status}
\ No newline at end of file
@@ -0,0 +1,62 @@
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response
+from pydantic import BaseModel
+
+from app.core.rate_limit import rate_limit_writes
+from app.core.security import get_current_user_async
+from app.models.user import User
+from app.services.attachments import sniff_file, submit_attachment
+from app.services.media_jobs import media_jobs
+from app.services.uploads import chunked_uploads
+
+router = APIRouter()
+
+class UploadCreate(BaseModel):
+    filename: str
+    size: int
+
+@router.post("/files", status_code=201, dependencies=[Depends(rate_limit_writes)])
+async def create_upload(data: UploadCreate, current_user: User = Depends(get_current_user_async)):
+    # Size limits are enforced up front, before a single byte is sent
+    return (await chunked_uploads.create(current_user.id, data.filename, data.size)).to_dict()
+
+@router.get("/files/{upload_id}")
+async def get_upload_offset(upload_id: str, current_user: User = Depends(get_current_user_async)):
+    # Where to resume after a dropped connection
+    return (await chunked_uploads.get(upload_id, current_user.id)).to_dict()
+
+@router.patch("/files/{upload_id}")
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    response: Response,
+    upload_offset: int = Header(...),
+    current_user: User = Depends(get_current_user_async)
+):
+    upload = await chunked_uploads.get(upload_id, current_user.id)
+    # The body is streamed to disk as it arrives
+    await chunked_uploads.append(upload, upload_offset, request.stream())
+    response.headers["Upload-Offset"] = str(upload.offset)
+    result = upload.to_dict()
+    if not upload.complete:
+        return result
+
+    sniffed = await sniff_file(upload.path, upload.filename)
+    # A 503 here keeps the upload; sending an empty chunk at the end retries
+    media_jobs.ensure_capacity()
+    staged_path = await chunked_uploads.finish(upload)
+    result["job"] = (await submit_attachment(staged_path, current_user.id, upload.filename, upload.size, sniffed)).to_dict()
+    return result
+
+@router.delete("/files/{upload_id}")
+async def cancel_upload(upload_id: str, current_user: User = Depends(get_current_user_async)):
+    upload = await chunked_uploads.get(upload_id, current_user.id)
+    await chunked_uploads.discard(upload)
+    return {"status": "cancelled"}
+
+@router.get("/{job_id}")
+async def get_upload_status(job_id: str, current_user: User = Depends(get_current_user_async)):
+    # For clients without a socket; everyone else gets UPLOAD_READY / UPLOAD_FAILED events
+    job = await media_jobs.get(job_id)
+    if not job or job.owner_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return job.to_dict()
@@ -1,15 +1,18 @@
-from app.core import cloudinary
-from app.core.cloudinary import upload_profile_picture
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from sqlmodel import Session, select, or_
+from sqlmodel.ext.asyncio.session import AsyncSession
 from pydantic import BaseModel
 from typing import Optional, List
 from fastapi import File, UploadFile
 
-from app.db.session import get_session
+from app.db.session import get_session, get_async_session
 from app.models.user import User
 from app.models.friend import FriendRequest, FriendStatus
-from app.core.security import get_current_user
+from app.core.security import get_current_user, get_current_user_async, invalidate_cached_user
+from app.core.rate_limit import rate_limit_writes
+from app.services.user_search import search_users, username_index
+from app.services.friends import friend_graph
+from app.services.avatars import PROFILE_THUMBNAIL_SIZE, stage_avatar, submit_profile_picture
 from app.models.user import User
 
 class UserUpdate(BaseModel):
@@ -27,12 +30,13 @@ class UserProfileResponse(BaseModel):
     bio: str               
     gender: str            
     profile_picture: Optional[str] = None 
+    profile_thumbnail: Optional[str] = None
     allow_stranger_dms: bool
     friendship_status: str
 
 router = APIRouter()
 
-@router.patch("/updateme")
+@router.patch("/updateme", dependencies=[Depends(rate_limit_writes)])
 def update_my_profile(
     update_data: UserUpdate,
     session: Session = Depends(get_session),
@@ -41,36 +45,40 @@ def update_my_profile(
     if not update_data:
         raise HTTPException(status_code=400, detail="No data provided for update")
     
+    previous_username = current_user.username
     update_dict = update_data.dict(exclude_unset=True)
     for key,value in update_dict.items():
         setattr(current_user, key, value)
 
     session.add(current_user)
     session.commit()
+    invalidate_cached_user(previous_username)
+    invalidate_cached_user(current_user.username)
+    if current_user.username != previous_username:
+        username_index.remove(previous_username, current_user.id)
+        username_index.add(current_user.username, current_user.id)
 
     session.refresh(current_user)
 
     return current_user
 
-@router.post("/updateme/avatar")
-def update_profile_picture(
+@router.post("/updateme/avatar", dependencies=[Depends(rate_limit_writes)])
+async def update_profile_picture(
     file: UploadFile = File(...),
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user_async)
 ):
-    secure_url = upload_profile_picture(file.file, current_user.id)
-    
-    if not secure_url:
-        raise HTTPException(status_code=500, detail="Failed to upload image to Cloudinary")
-
-    # Save the new URL to the database
-    current_user.profile_picture = secure_url
-    
-    session.add(current_user)
-    session.commit()
-    session.refresh(current_user)
-    
-    return current_user
+    staged = await stage_avatar(file)
+    job = await submit_profile_picture(staged, current_user.id, current_user.username)
+
+    # Answered before the upload finishes: the URL is where the picture will be, and
+    # UPLOAD_READY on the socket (or GET /uploads/{job_id}) says when it is saved
+    profile = current_user.model_dump(exclude={"hashed_password"})
+    profile.update(
+        profile_picture=job.url,
+        profile_thumbnail=job.thumbnails.get(str(PROFILE_THUMBNAIL_SIZE), profile.get("profile_thumbnail")),
+        upload_job_id=job.id
+    )
+    return profile
 
 @router.get("/check-username")
 def check_username_availability(username: str, session: Session = Depends(get_session)):
@@ -93,45 +101,59 @@ def get_current_user_profile(
         bio=current_user.bio,
         gender=current_user.gender,
         profile_picture=current_user.profile_picture,
+        profile_thumbnail=current_user.profile_thumbnail,
         allow_stranger_dms=current_user.allow_stranger_dms,
         friendship_status="self" # Special status for yourself
     )
 
 @router.get("/search", response_model=List[UserProfileResponse])
-def get_user_profile(
+async def get_user_profile(
     q: str,
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = Query(10, ge=1, le=50),
+    session: AsyncSession = Depends(get_async_session),
+    current_user: User = Depends(get_current_user_async)
 ):
-    target_users = session.exec(select(User).where(
-        User.username.ilike(f"%{q}%"),
-        User.id != current_user.id).limit(10)
-    ).all()
+    target_users = await search_users(session, q, current_user.id, limit + 1, after)
+    has_more = len(target_users) > limit
+    target_users = target_users[:limit]
     
-    if not target_users:
+    if not target_users and after is None:
         raise HTTPException(status_code=404, detail="User Not Found")
 
+    if has_more:
+        response.headers["X-Next-Cursor"] = target_users[-1].username
+
+    # Friends come from the in-memory graph, pending requests for every hit from one query
+    friend_ids = await friend_graph.friends_of(current_user.id)
+    target_ids = [user.id for user in target_users if user.id not in friend_ids]
+    statement = select(FriendRequest).where(
+        (FriendRequest.status == FriendStatus.PENDING) &
+        or_(
+            (FriendRequest.sender_id == current_user.id) & (FriendRequest.receiver_id.in_(target_ids)),
+            (FriendRequest.sender_id.in_(target_ids)) & (FriendRequest.receiver_id == current_user.id)
+        )
+    )
+    requests_by_user = {}
+    for friend_request in (await session.exec(statement)).all():
+        other_id = friend_request.receiver_id if friend_request.sender_id == current_user.id else friend_request.sender_id
+        requests_by_user[other_id] = friend_request
+
     results = []
 
     for user in target_users:
         # Check Friendship Status
-        statement = select(FriendRequest).where(
-            or_(
-                (FriendRequest.sender_id == current_user.id) & (FriendRequest.receiver_id == user.id),
-                (FriendRequest.sender_id == user.id) & (FriendRequest.receiver_id == current_user.id)
-            )
-        )
-        friend_request = session.exec(statement).first()
+        friend_request = requests_by_user.get(user.id)
         status = "stranger"
 
-        if friend_request:
-            if friend_request.status == FriendStatus.ACCEPTED:
-                status = "friends"
-            elif friend_request.status == FriendStatus.PENDING:
-                if friend_request.sender_id == current_user.id:
-                    status = "request_sent"
-                else:
-                    status = "request_received"
+        if user.id in friend_ids:
+            status = "friends"
+        elif friend_request:
+            if friend_request.sender_id == current_user.id:
+                status = "request_sent"
+            else:
+                status = "request_received"
 
         results.append( UserProfileResponse(
             id=user.id,
@@ -141,9 +163,9 @@ def get_user_profile(
             bio=user.bio,             
             gender=user.gender,      
             profile_picture=user.profile_picture, 
+            profile_thumbnail=user.profile_thumbnail,
             allow_stranger_dms=user.allow_stranger_dms,
             friendship_status=status
             )
         )
     return results
-
@@ -1,13 +1,85 @@
+from typing import Optional
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
     DATABASE_URL: str
+    ASYNC_DATABASE_URL: Optional[str] = None
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: int = 30
+    DB_POOL_RECYCLE: int = 1800
+    DB_ECHO: bool = False  # log every statement; use the query profiler instead in production
     ACCESS_TOKEN_EXPIRE_MINUTES: int
     ALGORITHM: str
     SECRET_KEY: str
-    CLOUDINARY_CLOUD_NAME: str
-    CLOUDINARY_API_KEY: str
-    CLOUDINARY_API_SECRET: str
+    STORAGE_BACKEND: str = "cloudinary"  # or "local" to keep media on disk (offline, tests)
+    CLOUDINARY_CLOUD_NAME: Optional[str] = None
+    CLOUDINARY_API_KEY: Optional[str] = None
+    CLOUDINARY_API_SECRET: Optional[str] = None
+    MEDIA_ROOT: str = "media"
+    MEDIA_BASE_URL: str = "http://localhost:8000/media"  # where MEDIA_ROOT is served from
+    UPLOAD_TMP_DIR: Optional[str] = None  # staging area, system temp dir when unset; shared by all workers
+    AVATAR_MAX_BYTES: int = 10 * 1024 * 1024
+    MEDIA_UPLOAD_WORKERS: int = 2
+    MEDIA_QUEUE_SIZE: int = 100
+    MEDIA_JOB_TTL_SECONDS: int = 3600  # a finished attachment must be sent within this long
+    IMAGE_PROCESSING: bool = True  # resize and thumbnail in-house instead of via Cloudinary
+    IMAGE_PROCESS_WORKERS: int = 2
+    IMAGE_FORMAT: str = "webp"  # or "jpeg"
+    IMAGE_QUALITY: int = 80
+    IMAGE_MAX_PIXELS: int = 40_000_000  # larger images are rejected before decoding
+    MESSAGE_MEDIA_MAX_BYTES: int = 100 * 1024 * 1024
+    MESSAGE_IMAGE_SIZE: int = 1600  # longest side of images sent in chats
+    MESSAGE_THUMBNAIL_SIZE: int = 320
+    UPLOAD_SESSION_TTL_SECONDS: int = 86400  # unfinished resumable uploads idle this long are dropped
+    UPLOAD_SESSIONS_PER_USER: int = 5
+    UPLOAD_SWEEP_INTERVAL_SECONDS: int = 600  # also drops expired media jobs
+    BROKER_URL: Optional[str] = None  # e.g. redis://localhost:6379/0, in-memory when unset
+    WS_SEND_QUEUE_SIZE: int = 256  # per socket, consumers that fill it are disconnected
+    WS_SEND_TIMEOUT: float = 10.0
+    MESSAGE_BATCHING: bool = False  # group-commit inbound messages from all sockets
+    MESSAGE_BATCH_MAX_SIZE: int = 100
+    MESSAGE_BATCH_MAX_DELAY_MS: int = 5
+    GROUP_CACHE_SIZE: int = 10000
+    GROUP_CACHE_TTL_SECONDS: int = 300
+    USER_CACHE_SIZE: int = 10000
+    USER_CACHE_TTL_SECONDS: int = 60
+    TOKEN_CACHE_SIZE: int = 10000
+    BCRYPT_ROUNDS: int = 12  # changing it rehashes passwords on next login
+    PASSWORD_HASH_WORKERS: int = 4
+    PASSWORD_HASH_MAX_PENDING: int = 64
+    PASSWORD_HASH_RETRY_AFTER_SECONDS: int = 2
+    USER_SEARCH_REFRESH_SECONDS: int = 300
+    FRIEND_CACHE_SIZE: int = 50000
+    FRIEND_CACHE_TTL_SECONDS: int = 300
+    PRESENCE_IDLE_TIMEOUT_SECONDS: int = 90  # clients heartbeat with {"type": "ping"}
+    PRESENCE_DEBOUNCE_SECONDS: float = 5.0
+    PRESENCE_LAST_SEEN_CACHE_SIZE: int = 100000  # users tracked per worker, and by the in-memory broker
+    PRESENCE_LAST_SEEN_TTL_SECONDS: int = 86400  # last seen is reported as unknown after this
+    SYNC_MAX_MESSAGES: int = 2000  # larger reconnect gaps get RESYNC_REQUIRED
+    SYNC_BATCH_SIZE: int = 200
+    CLIENT_MSG_ID_WINDOW: int = 256  # recent client_msg_ids remembered per sender
+    CLIENT_MSG_ID_CACHE_SIZE: int = 10000
+    CLIENT_MSG_ID_TTL_SECONDS: int = 600
+    DELIVERY_FLUSH_INTERVAL_MS: int = 500
+    WS_FRAME_BATCH_MAX: int = 64  # events per binary frame, either direction
+    RATE_LIMIT_PER_SECOND: float = 10.0  # per user, socket frames and HTTP writes combined
+    RATE_LIMIT_BURST: int = 40
+    RATE_LIMIT_MAX_KEYS: int = 100000
+    WS_CONNECTION_RATE_PER_SECOND: float = 5.0
+    WS_CONNECTION_BURST: int = 20
+    WS_RATE_LIMIT_MAX_STRIKES: int = 50  # throttled events in a row before the socket is closed
+    METRICS_TOKEN: Optional[str] = None  # bearer token for /metrics, which is disabled while unset
+    QUERY_PROFILER_ENABLED: bool = False
+    QUERY_PROFILER_FLAG_FILE: Optional[str] = None  # profiling is on while this file exists
+    QUERY_SLOW_MS: float = 100.0
+    QUERY_SLOW_LOG_SAMPLE_RATE: float = 0.25
+    QUERY_N_PLUS_ONE_THRESHOLD: int = 5  # identical statements per request before warning
+    SEARCH_PAGE_SIZE: int = 20
+    SEARCH_MAX_PAGE_SIZE: int = 100
+    SEARCH_MAX_OFFSET: int = 1000  # ranking scores every match, deeper pages should refine the query
+    HISTORY_PAGE_SIZE: int = 50
+    HISTORY_MAX_PAGE_SIZE: int = 200
 
     class Config:
         env_file = ".env"
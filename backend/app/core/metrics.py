@@ -0,0 +1,162 @@
+import hmac
+import time
+from typing import Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core.config import settings
+from app.core.profiler import query_profiler
+
+# Per-process registry: with several workers, scrape each one (or aggregate upstream)
+
+# Database calls are mostly sub-millisecond, the default buckets start too coarse
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ["method", "route", "status"]
+)
+
+WS_CONNECTIONS = Gauge("ws_connections", "Open WebSocket connections on this worker")
+WS_ONLINE_USERS = Gauge("ws_online_users", "Users with at least one socket on this worker")
+WS_QUEUED_FRAMES = Gauge("ws_send_queue_frames", "Frames waiting in socket send queues")
+WS_MAX_QUEUE_DEPTH = Gauge("ws_send_queue_max_depth", "Deepest socket send queue")
+WS_FRAMES_SENT = Counter("ws_frames_sent_total", "WebSocket frames written to clients")
+WS_EVICTIONS = Counter("ws_evictions_total", "Sockets closed for being slow consumers")
+WS_THROTTLED = Counter("ws_throttled_events_total", "Inbound socket events dropped by the rate limiter")
+
+MESSAGES_INGESTED = Counter("chat_messages_ingested_total", "Messages stored", ["kind"])
+MESSAGE_WRITE_SECONDS = Histogram(
+    "chat_message_write_seconds", "Time from receiving a message to it being committed", buckets=FAST_BUCKETS
+)
+FANOUT_RECIPIENTS = Counter("chat_fanout_recipients_total", "Users an event was published to")
+FANOUT_SECONDS = Histogram("chat_fanout_seconds", "Time to publish one event to all its recipients", buckets=FAST_BUCKETS)
+
+DB_POOL_CHECKOUT_WAIT_SECONDS = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent getting a connection from the pool, including waiting for a free one",
+    ["engine"],
+    buckets=FAST_BUCKETS
+)
+DB_POOL_CONNECT_SECONDS = Histogram(
+    "db_pool_connect_seconds", "Time to open a new database connection", ["engine"], buckets=FAST_BUCKETS
+)
+DB_POOL_HOLD_SECONDS = Histogram(
+    "db_pool_hold_seconds", "Time a connection stays checked out of the pool", ["engine"], buckets=FAST_BUCKETS
+)
+DB_POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "Connections currently checked out of the pool", ["engine"])
+DB_QUERY_SECONDS = Histogram("db_query_duration_seconds", "Statement execution time", ["engine", "operation"], buckets=FAST_BUCKETS)
+
+def _operation(statement: str) -> str:
+    # First keyword only, keeps the label set small
+    keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return keyword if keyword in ("SELECT", "INSERT", "UPDATE", "DELETE") else "OTHER"
+
+def _time_checkouts(pool: Pool, name: str):
+    # Pool events only fire once a connection is handed over, so the acquire call is
+    # wrapped itself: this is where requests queue when the pool is exhausted
+    checkout_wait = DB_POOL_CHECKOUT_WAIT_SECONDS.labels(name)
+    do_get = pool._do_get
+
+    def _timed_do_get():
+        started = time.perf_counter()
+        try:
+            return do_get()
+        finally:
+            checkout_wait.observe(time.perf_counter() - started)
+
+    pool._do_get = _timed_do_get
+
+def instrument_engine(engine: Engine, name: str):
+    """Time pool connections and statements of a sync engine (use async_engine.sync_engine for async)."""
+    _time_checkouts(engine.pool, name)
+    connect_seconds = DB_POOL_CONNECT_SECONDS.labels(name)
+    hold_seconds = DB_POOL_HOLD_SECONDS.labels(name)
+    checkedout = getattr(engine.pool, "checkedout", None)
+    if checkedout is not None:
+        # A pool that stays at its size plus overflow makes requests queue for connections
+        DB_POOL_CHECKED_OUT.labels(name).set_function(checkedout)
+
+    @event.listens_for(engine, "do_connect")
+    def _start_connect(dialect, connection_record, cargs, cparams):
+        connection_record.info["connect_started"] = time.perf_counter()
+
+    @event.listens_for(engine, "connect")
+    def _stop_connect(dbapi_connection, connection_record):
+        started = connection_record.info.pop("connect_started", None)
+        if started is not None:
+            connect_seconds.observe(time.perf_counter() - started)
+
+    @event.listens_for(engine, "checkout")
+    def _start_hold(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checked_out"] = time.perf_counter()
+
+    @event.listens_for(engine, "checkin")
+    def _stop_hold(dbapi_connection, connection_record):
+        started = connection_record.info.pop("checked_out", None)
+        if started is not None:
+            hold_seconds.observe(time.perf_counter() - started)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _start_timer(conn, cursor, statement, parameters, context, executemany):
+        # Statements on one connection never overlap, one start time is enough
+        conn.info["query_started"] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop("query_started", None)
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        DB_QUERY_SECONDS.labels(name, _operation(statement)).observe(seconds)
+        query_profiler.record(statement, seconds)
+
+    @event.listens_for(engine, "handle_error")
+    def _drop_timer(context):
+        # Failed statements never reach after_cursor_execute
+        if context.connection is not None:
+            context.connection.info.pop("query_started", None)
+
+class MetricsMiddleware:
+    """Pure ASGI middleware timing HTTP requests, labelled by route template rather than raw path."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router records the matched route in the scope
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.labels(
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                str(status_code),
+            ).observe(time.perf_counter() - started)
+
+def metrics_authorized(authorization: Optional[str]) -> bool:
+    """Scrapes must present METRICS_TOKEN as a bearer token; without one configured, nobody may."""
+    if not settings.METRICS_TOKEN or not authorization:
+        return False
+    scheme, _, token = authorization.partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(token.encode(), settings.METRICS_TOKEN.encode())
+
+def render_metrics():
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,147 @@
+import os
+import random
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterable, Optional, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core.config import settings
+
+class QueryProfile:
+    """Queries run while handling one HTTP request or one WebSocket event."""
+
+    __slots__ = ("name", "count", "seconds", "statements")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.seconds = 0.0
+        self.statements: Counter = Counter()
+
+_current_profile: ContextVar[Optional[QueryProfile]] = ContextVar("query_profile", default=None)
+# Set while work queued by several requests runs elsewhere, e.g. a batched insert
+_charged_profiles: ContextVar[Tuple[QueryProfile, ...]] = ContextVar("charged_profiles", default=())
+
+class QueryProfiler:
+    """Per-request query counting and timing, a sampled slow-query log and N+1 warnings.
+
+    Off by default. It is on while QUERY_PROFILER_ENABLED is set or, checked at most
+    once a second, while QUERY_PROFILER_FLAG_FILE exists, so it can be flipped on every
+    worker at once by touching a file. No restarts needed.
+    """
+
+    FLAG_CHECK_SECONDS = 1.0
+
+    def __init__(self, enabled: bool, flag_file: Optional[str]):
+        self.enabled = enabled
+        self.flag_file = flag_file
+        self._flag_set = False
+        self._flag_checked_at = 0.0
+
+    @property
+    def active(self) -> bool:
+        if self.enabled:
+            return True
+        if not self.flag_file:
+            return False
+        now = time.monotonic()
+        if now - self._flag_checked_at >= self.FLAG_CHECK_SECONDS:
+            self._flag_checked_at = now
+            self._flag_set = os.path.exists(self.flag_file)
+        return self._flag_set
+
+    @contextmanager
+    def profile(self, name: str):
+        if not self.active:
+            yield None
+            return
+        profile = QueryProfile(name)
+        token = _current_profile.set(profile)
+        try:
+            yield profile
+        finally:
+            _current_profile.reset(token)
+            self._report(profile)
+
+    def current(self) -> Optional[QueryProfile]:
+        """The profile being collected here, to hand to charge() wherever the queries end up running."""
+        return _current_profile.get()
+
+    @contextmanager
+    def charge(self, profiles: Iterable[Optional[QueryProfile]]):
+        """Count statements run in here towards each of profiles, which were captured with current().
+
+        For work done on behalf of several requests at once, like a group commit:
+        every request waited for the whole of it, so each is charged the full time.
+        """
+        charged = tuple({id(p): p for p in profiles if p is not None}.values())
+        if not charged:
+            yield
+            return
+        token = _charged_profiles.set(charged)
+        try:
+            yield
+        finally:
+            _charged_profiles.reset(token)
+
+    def record(self, statement: str, seconds: float):
+        """Called for every statement executed by an instrumented engine."""
+        profiles = _charged_profiles.get()
+        if not profiles:
+            profile = _current_profile.get()
+            if profile is None:
+                return
+            profiles = (profile,)
+        for profile in profiles:
+            profile.count += 1
+            profile.seconds += seconds
+            # Statements are parameterized, so the same text is the same query shape
+            profile.statements[statement] += 1
+
+        if seconds * 1000 >= settings.QUERY_SLOW_MS and random.random() < settings.QUERY_SLOW_LOG_SAMPLE_RATE:
+            names = ", ".join(profile.name for profile in profiles)
+            print(f"Slow query ({seconds * 1000:.1f} ms) in {names} : {_shorten(statement)}")
+
+    def _report(self, profile: QueryProfile):
+        # The same query once per row of an earlier result is the N+1 signature
+        for statement, count in profile.statements.most_common():
+            if count < settings.QUERY_N_PLUS_ONE_THRESHOLD:
+                break
+            print(
+                f"Possible N+1 in {profile.name} : {count} of {profile.count} queries were "
+                f"{_shorten(statement)}"
+            )
+
+def _shorten(statement: str, limit: int = 300) -> str:
+    statement = " ".join(statement.split())
+    return statement if len(statement) <= limit else statement[:limit] + "..."
+
+query_profiler = QueryProfiler(
+    enabled=settings.QUERY_PROFILER_ENABLED,
+    flag_file=settings.QUERY_PROFILER_FLAG_FILE,
+)
+
+class QueryProfilerMiddleware:
+    """Profiles each HTTP request and reports it in a Server-Timing header."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not query_profiler.active:
+            await self.app(scope, receive, send)
+            return
+
+        with query_profiler.profile(f"{scope['method']} {scope['path']}") as profile:
+            async def send_wrapper(message: Message):
+                if message["type"] == "http.response.start":
+                    timing = f'db;dur={profile.seconds * 1000:.1f};desc="{profile.count} queries"'
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", timing.encode())
+                    ]
+                await send(message)
+
+            await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,101 @@
+import math
+import time
+
+from fastapi import Depends, HTTPException, status
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.core.security import oauth2_scheme, verify_token
+
+class TokenBucket:
+    """Allows `burst` operations at once, refilled at `rate` per second."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def wait(self, cost: float = 1.0) -> float:
+        """Seconds until cost tokens are available, 0 if they are now. Spends nothing."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def take(self, cost: float = 1.0) -> float:
+        """Spend cost tokens. Returns 0 if allowed, otherwise seconds until it would be."""
+        retry_after = self.wait(cost)
+        if not retry_after:
+            self.tokens -= cost
+        return retry_after
+
+class RateLimiter:
+    """Per-key token buckets held in memory. Not shared across workers.
+
+    A bucket left alone for burst / rate seconds is full again, indistinguishable from
+    a new one, so idle buckets simply expire out of the cache.
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = TTLCache(max_size=max_keys, ttl_seconds=burst / rate)
+
+    def wait(self, key, cost: float = 1.0) -> float:
+        bucket = self._buckets.get(key)
+        # No bucket means a full one
+        return bucket.wait(cost) if bucket is not None else 0.0
+
+    def take(self, key, cost: float = 1.0) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+        retry_after = bucket.take(cost)
+        self._buckets.set(key, bucket)
+        return retry_after
+
+# Keyed by username so socket frames and HTTP writes draw from the same bucket
+user_limiter = RateLimiter(
+    rate=settings.RATE_LIMIT_PER_SECOND,
+    burst=settings.RATE_LIMIT_BURST,
+    max_keys=settings.RATE_LIMIT_MAX_KEYS,
+)
+
+def rate_limit_writes(token: str = Depends(oauth2_scheme)):
+    payload = verify_token(token)
+    # Bad tokens are rejected by the route's own auth dependency
+    if not payload or not payload.get("sub"):
+        return
+    retry_after = user_limiter.take(payload["sub"])
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests, please slow down",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+class SocketThrottle:
+    """Limits one socket by its own bucket and by its user's shared one, counting consecutive strikes."""
+
+    def __init__(self, username: str):
+        self.username = username
+        self.bucket = TokenBucket(settings.WS_CONNECTION_RATE_PER_SECOND, settings.WS_CONNECTION_BURST)
+        self.strikes = 0
+
+    def check(self) -> float:
+        # Both buckets are checked before either is spent, so a denial costs nothing
+        retry_after = max(self.bucket.wait(), user_limiter.wait(self.username))
+        if not retry_after:
+            self.bucket.take()
+            user_limiter.take(self.username)
+        self.strikes = self.strikes + 1 if retry_after else 0
+        return retry_after
+
+    @property
+    def abusive(self) -> bool:
+        return self.strikes >= settings.WS_RATE_LIMIT_MAX_STRIKES
@@ -1,26 +1,84 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
 from passlib.context import CryptContext
+from sqlalchemy.orm import make_transient_to_detached
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from app.core.cache import TTLCache
 from app.core.config import settings
-from app.db.session import get_session
+from app.db.session import get_session, get_async_session
 from app.models.user import User
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# min/max pinned to the configured cost so hashes made at any other cost are flagged for rehash
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__max_rounds=settings.BCRYPT_ROUNDS,
+)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
+user_cache = TTLCache(max_size=settings.USER_CACHE_SIZE, ttl_seconds=settings.USER_CACHE_TTL_SECONDS)
+token_cache = TTLCache(max_size=settings.TOKEN_CACHE_SIZE, ttl_seconds=settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
 
 def verify_password(password: str, hashed: str) -> bool:
     return pwd_context.verify(password, hashed)
 
+class PasswordHasher:
+    """Runs bcrypt on its own bounded pool so login bursts can't starve the shared threadpool.
+
+    bcrypt releases the GIL, so threads give real parallelism here. Once max_pending
+    calls are queued or running, new ones are rejected with 503 instead of piling up.
+    """
+
+    def __init__(self, workers: int, max_pending: int, retry_after: int):
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, please try again shortly",
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+    async def verify_and_update(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        """Returns (valid, new_hash). new_hash is set when the stored hash uses an outdated cost."""
+        return await self._run(pwd_context.verify_and_update, password, hashed)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+password_hasher = PasswordHasher(
+    workers=settings.PASSWORD_HASH_WORKERS,
+    max_pending=settings.PASSWORD_HASH_MAX_PENDING,
+    retry_after=settings.PASSWORD_HASH_RETRY_AFTER_SECONDS,
+)
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -31,44 +89,88 @@ def create_access_token(data: dict):
         algorithm=settings.ALGORITHM
     )
 
-def get_current_user(
-    token: str = Depends(oauth2_scheme),
-    session: Session = Depends(get_session)
-) -> User:
-    credentials_exception = HTTPException(
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
 
+def _decode_token(token: str) -> Optional[dict]:
+    # Decoded payloads are reused until the token's own exp, skipping the signature check
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
     try:
         payload = jwt.decode(
             token, 
             settings.SECRET_KEY, 
             algorithms=[settings.ALGORITHM]
         )
-        
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-            
     except JWTError:
-        raise credentials_exception
+        return None
+
+    exp = payload.get("exp")
+    if exp is not None:
+        token_cache.set(token, payload, exp - time.time())
+    return payload
+
+def _token_subject(token: str) -> str:
+    payload = _decode_token(token)
+    if payload is None:
+        raise _credentials_exception()
+
+    username: str = payload.get("sub")
+    if username is None:
+        raise _credentials_exception()
+
+    return username
+
+def _detached_copy(user: User) -> User:
+    # The cache holds its own detached instance; requests merge it into their session
+    copy = User(**user.model_dump())
+    make_transient_to_detached(copy)
+    return copy
+
+def invalidate_cached_user(username: str):
+    user_cache.invalidate(username)
+
+def get_current_user(
+    token: str = Depends(oauth2_scheme),
+    session: Session = Depends(get_session)
+) -> User:
+    username = _token_subject(token)
+
+    cached = user_cache.get(username)
+    if cached is not None:
+        return session.merge(cached, load=False)
 
     user = session.exec(select(User).where(User.username == username)).first()
     
     if user is None:
-        raise credentials_exception
+        raise _credentials_exception()
 
+    user_cache.set(username, _detached_copy(user))
+    return user
+
+async def get_current_user_async(
+    token: str = Depends(oauth2_scheme),
+    session: AsyncSession = Depends(get_async_session)
+) -> User:
+    username = _token_subject(token)
+
+    cached = user_cache.get(username)
+    if cached is not None:
+        return await session.merge(cached, load=False)
+
+    user = (await session.exec(select(User).where(User.username == username))).first()
+
+    if user is None:
+        raise _credentials_exception()
+
+    user_cache.set(username, _detached_copy(user))
     return user
 
 def verify_token(token: str) -> Optional[dict]:
-    try:
-        payload = jwt.decode(
-            token,
-            settings.SECRET_KEY,
-            algorithms=[settings.ALGORITHM]
-        )
-        return payload
-    except JWTError:
-        return None
\ No newline at end of file
+    return _decode_token(token)
@@ -0,0 +1,69 @@
+from typing import Optional, Tuple
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlmodel import SQLModel
+
+# create_all only creates missing tables; columns and indexes added to tables that
+# already shipped reach existing databases through here instead.
+
+# (table, column, SQL default for rows that predate it; None leaves them NULL)
+ADDED_COLUMNS: Tuple[Tuple[str, str, Optional[str]], ...] = (
+    ("friendrequest", "pair_low_id", None),
+    ("friendrequest", "pair_high_id", None),
+    ("message", "client_msg_id", None),
+    # NULL marks summaries whose watermark backfill_read_watermarks still has to derive
+    ("conversationsummary", "last_read_message_id", None),
+    ("conversationsummary", "last_delivered_message_id", "0"),
+    ("user", "profile_thumbnail", None),
+    ("message", "media_name", None),
+    ("message", "media_mime", None),
+    ("message", "media_size", None),
+    ("message", "media_width", None),
+    ("message", "media_height", None),
+    ("message", "media_thumbnail", None),
+    ("message", "media_blurhash", None),
+)
+
+# (table, index name) of indexes declared on the models
+ADDED_INDEXES: Tuple[Tuple[str, str], ...] = (
+    # History pages are a range scan on this; without it they sort the whole conversation
+    ("message", "ix_message_conversation"),
+    ("friendrequest", "ix_friendrequest_pair_high"),
+    # Existing rows all have a NULL client_msg_id, which never collides
+    ("message", "uq_message_client_msg"),
+)
+
+def has_index(conn: Connection, table_name: str, name: str) -> bool:
+    """Whether table_name has an index or unique constraint called name."""
+    inspector = inspect(conn)
+    names = {index["name"] for index in inspector.get_indexes(table_name)}
+    names.update(constraint["name"] for constraint in inspector.get_unique_constraints(table_name))
+    return name in names
+
+def _add_columns(conn: Connection):
+    preparer = conn.dialect.identifier_preparer
+    inspector = inspect(conn)
+    for table_name, column_name, default in ADDED_COLUMNS:
+        if column_name in {column["name"] for column in inspector.get_columns(table_name)}:
+            continue
+        column = SQLModel.metadata.tables[table_name].c[column_name]
+        ddl = (
+            f"ALTER TABLE {preparer.quote(table_name)} "
+            f"ADD COLUMN {preparer.quote(column_name)} {column.type.compile(dialect=conn.dialect)}"
+        )
+        if default is not None:
+            ddl += f" DEFAULT {default}"
+        conn.execute(text(ddl))
+
+def _create_indexes(conn: Connection):
+    for table_name, index_name in ADDED_INDEXES:
+        index = next(i for i in SQLModel.metadata.tables[table_name].indexes if i.name == index_name)
+        index.create(conn, checkfirst=True)
+
+def ensure_schema(engine: Engine):
+    """Create missing tables and bring existing ones up to the models. Safe to run on every start."""
+    SQLModel.metadata.create_all(engine)
+    with engine.begin() as conn:
+        _add_columns(conn)
+        _create_indexes(conn)
@@ -1,18 +1,41 @@
-from fastapi import FastAPI
-from sqlmodel import SQLModel
+import os
+from typing import Optional
+from urllib.parse import urlparse
+
+from fastapi import FastAPI, Header, HTTPException, Response
+from fastapi.staticfiles import StaticFiles
+from sqlmodel import Session, select
 from fastapi.middleware.cors import CORSMiddleware
 
 from app.models.user import User
 from app.models.friend import FriendRequest
 from app.models.message import Message
 from app.models.group import Group, GroupMember
+from app.models.conversation import ConversationSummary
+from app.models.media import MediaJobRecord, UploadSession
 
 from app.db.session import engine
+from app.db.migrations import ensure_schema
+from app.services.conversations import rebuild_conversation_summaries, backfill_read_watermarks
+from app.services.user_search import ensure_search_indexes
+from app.services.message_search import message_search
+from app.services.friends import backfill_friend_pairs
+from app.core.security import password_hasher
+from app.core.metrics import MetricsMiddleware, metrics_authorized, render_metrics
+from app.core.profiler import QueryProfilerMiddleware
+from app.websockets.manager import manager
+from app.services.message_writer import message_writer
+from app.services.delivery import delivery_tracker
+from app.services.media_jobs import media_jobs
+from app.services.images import image_processor
+from app.services.uploads import chunked_uploads
+from app.core.config import settings
 from app.api.auth import router as auth_router
 from app.api.users import router as user_router
 from app.api.friends import router as friend_router
 from app.api.chat import router as chat_router
 from app.api.group import router as group_router
+from app.api.media import router as media_router
 
 app = FastAPI(title="Chat Application")
 
@@ -25,17 +48,71 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Upload-Offset"],
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(QueryProfilerMiddleware)
 
 app.include_router(auth_router, prefix="/auth")
 app.include_router(user_router, prefix="/users")
 app.include_router(friend_router, prefix="/users/friends")
 app.include_router(chat_router,prefix="/chat",tags=["chat"])
 app.include_router(group_router, prefix="/groups", tags=["groups"])
+app.include_router(media_router, prefix="/uploads", tags=["uploads"])
+
+if settings.STORAGE_BACKEND == "local":
+    # Local storage is served by the app itself
+    os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+    app.mount(urlparse(settings.MEDIA_BASE_URL).path or "/media", StaticFiles(directory=settings.MEDIA_ROOT), name="media")
 
 @app.on_event("startup")
 def on_startup():
-    SQLModel.metadata.create_all(engine)
+    ensure_schema(engine)
+    ensure_search_indexes(engine)
+    message_search.ensure(engine)
+    with Session(engine) as session:
+        backfill_friend_pairs(session)
+        # One-time backfill for databases that predate the summary table
+        has_summaries = session.exec(select(ConversationSummary.id).limit(1)).first()
+        has_messages = session.exec(select(Message.id).limit(1)).first()
+        if has_messages and not has_summaries:
+            rebuild_conversation_summaries(session)
+        backfill_read_watermarks(session)
+
+@app.on_event("startup")
+async def start_connection_manager():
+    await manager.start()
+    await message_writer.start()
+    await delivery_tracker.start()
+    await media_jobs.start()
+    await chunked_uploads.start()
+
+@app.on_event("shutdown")
+async def stop_connection_manager():
+    await media_jobs.stop()
+    await message_writer.stop()
+    await delivery_tracker.stop()
+    await manager.stop()
+
+@app.on_event("shutdown")
+def stop_password_hasher():
+    password_hasher.shutdown()
+
+@app.on_event("shutdown")
+async def stop_image_processor():
+    await image_processor.shutdown()
+
+@app.on_event("shutdown")
+async def stop_upload_sweeper():
+    await chunked_uploads.stop()
+
+@app.get("/metrics", include_in_schema=False)
+def metrics(authorization: Optional[str] = Header(None)):
+    if not metrics_authorized(authorization):
+        # Same answer whether metrics are disabled or the token is wrong
+        raise HTTPException(status_code=404, detail="Not Found")
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
 
 @app.get("/")
 def home():
@@ -0,0 +1,28 @@
+from sqlmodel import SQLModel, Field
+from sqlalchemy import Index, UniqueConstraint
+from datetime import datetime
+from typing import Optional
+
+class ConversationSummary(SQLModel, table=True):
+    # One row per (owner, peer) so the sidebar is a single indexed read
+    __table_args__ = (
+        UniqueConstraint("user_id", "peer_id", name="uq_conversation_user_peer"),
+        Index("ix_conversation_recent", "user_id", "last_message_time"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+
+    user_id: int = Field(foreign_key="user.id")
+    peer_id: int = Field(foreign_key="user.id")
+
+    last_message_id: Optional[int] = Field(default=None, foreign_key="message.id")
+    last_message_preview: Optional[str] = Field(default=None)
+    last_message_time: Optional[datetime] = Field(default=None)
+    unread_count: int = Field(default=0)
+
+    # Everything from peer up to this id has been read by user; replaces per-row is_read.
+    # NULL only on rows that predate the column, until backfill_read_watermarks runs
+    last_read_message_id: Optional[int] = Field(default=0)
+
+    # Everything from peer up to this id has reached one of user's clients
+    last_delivered_message_id: Optional[int] = Field(default=0)
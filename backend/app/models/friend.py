@@ -1,4 +1,5 @@
 from sqlmodel import SQLModel, Field
+from sqlalchemy import Index, UniqueConstraint
 from typing import Optional
 from enum import Enum
 
@@ -8,9 +9,19 @@ class FriendStatus(str, Enum):
     REJECTED = "rejected"
 
 class FriendRequest(SQLModel, table=True):
+    # One request per pair of users, whichever of them sent it
+    __table_args__ = (
+        UniqueConstraint("pair_low_id", "pair_high_id", name="uq_friendrequest_pair"),
+        Index("ix_friendrequest_pair_high", "pair_high_id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
 
     sender_id: int = Field(foreign_key="user.id")
     receiver_id: int = Field(foreign_key="user.id")
 
-    status: FriendStatus = Field(default=FriendStatus.PENDING)
\ No newline at end of file
+    # Canonical (min_id, max_id) of sender/receiver so pair lookups hit one index
+    pair_low_id: Optional[int] = Field(default=None)
+    pair_high_id: Optional[int] = Field(default=None)
+
+    status: FriendStatus = Field(default=FriendStatus.PENDING)
@@ -0,0 +1,50 @@
+from sqlmodel import SQLModel, Field
+from sqlalchemy import JSON, Column
+from datetime import datetime
+from typing import Optional
+
+class MediaJobRecord(SQLModel, table=True):
+    # State of a media job that every worker can read; the job itself runs where the upload arrived
+    id: str = Field(primary_key=True, max_length=32)
+    owner_id: int = Field(foreign_key="user.id", index=True)
+    kind: str = Field(max_length=32)
+    status: str = Field(default="pending", max_length=16)  # pending, processing, done, failed
+    url: Optional[str] = Field(default=None)
+    thumbnails: dict = Field(default_factory=dict, sa_column=Column(JSON))
+    meta: dict = Field(default_factory=dict, sa_column=Column(JSON))
+    error: Optional[str] = Field(default=None)
+    expires_at: datetime = Field(index=True)
+    # Set when a message takes the attachment, so one upload is sent at most once
+    consumed_at: Optional[datetime] = Field(default=None)
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "url": self.url,
+            "thumbnails": self.thumbnails,
+            "meta": self.meta,
+            "error": self.error,
+            "expires_at": self.expires_at.isoformat(),
+        }
+
+class UploadSession(SQLModel, table=True):
+    # A resumable upload; any worker may take the next chunk, the staged file is in UPLOAD_TMP_DIR
+    id: str = Field(primary_key=True, max_length=32)
+    owner_id: int = Field(foreign_key="user.id", index=True)
+    filename: str
+    size: int
+    path: str
+    offset: int = Field(default=0)
+    expires_at: datetime = Field(index=True)
+    # Held by the request appending to the file, renewed before every write
+    lease_id: Optional[str] = Field(default=None, max_length=32)
+    lease_expires_at: Optional[datetime] = Field(default=None)
+
+    @property
+    def complete(self) -> bool:
+        return self.offset == self.size
+
+    def to_dict(self) -> dict:
+        return {"upload_id": self.id, "filename": self.filename, "size": self.size, "offset": self.offset}
@@ -1,12 +1,29 @@
 from sqlmodel import SQLModel, Field
+from sqlalchemy import Index
 from datetime import datetime
 from typing import Optional
 
 class Message(SQLModel, table=True):
+    # Covers both directions of a conversation so history pages are an index range scan
+    __table_args__ = (
+        Index("ix_message_conversation", "sender_id", "receiver_id", "id"),
+        Index("ix_message_group", "group_id", "id"),
+        # Makes client resends idempotent; NULLs (clients without ids) never collide
+        Index("uq_message_client_msg", "sender_id", "client_msg_id", unique=True),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     content: str
     message_type: Optional[str] = Field(default="text")  # text, image, file
     media_url: Optional[str] = Field(default=None)  # for images/files
+    # Enough to draw a placeholder or file card without downloading anything
+    media_name: Optional[str] = Field(default=None, max_length=255)
+    media_mime: Optional[str] = Field(default=None, max_length=100)
+    media_size: Optional[int] = Field(default=None)  # bytes
+    media_width: Optional[int] = Field(default=None)
+    media_height: Optional[int] = Field(default=None)
+    media_thumbnail: Optional[str] = Field(default=None)
+    media_blurhash: Optional[str] = Field(default=None, max_length=64)
 
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     is_read: bool = Field(default=False)
@@ -17,3 +34,5 @@ class Message(SQLModel, table=True):
     group_id: Optional[int] = Field(default=None, foreign_key="group.id")
 
     reply_to_id: Optional[int] = Field(default=None, foreign_key="message.id") #For reply preview
+
+    client_msg_id: Optional[str] = Field(default=None, max_length=64)  # sender-chosen id for dedupe
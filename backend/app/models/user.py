@@ -11,5 +11,6 @@ class User(SQLModel, table=True):
     bio: str = Field(default="Hey there! I'm ready to chat Anytime")
     gender: str = Field(default="other")
     profile_picture: Optional[str] = Field(default=None)
+    profile_thumbnail: Optional[str] = Field(default=None)  # small square version for lists
     created_at: datetime = Field(default_factory=datetime.utcnow)
     allow_stranger_dms: bool = Field(default=False)
\ No newline at end of file
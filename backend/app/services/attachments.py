@@ -0,0 +1,170 @@
+import asyncio
+import codecs
+import uuid
+from datetime import datetime
+from typing import Optional, Tuple
+
+from sqlmodel import update
+
+from app.core.config import settings
+from app.db.session import async_session_maker
+from app.models.media import MediaJobRecord
+from app.services.images import ImageSpec
+from app.services.media_jobs import MediaJob, media_jobs
+
+ATTACHMENT_KIND = "attachment"
+SNIFF_BYTES = 512
+
+# Decided from the first bytes only; the client's file name and Content-Type are not trusted
+SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png", ".png"),
+    (b"GIF87a", "image/gif", ".gif"),
+    (b"GIF89a", "image/gif", ".gif"),
+    (b"%PDF-", "application/pdf", ".pdf"),
+    (b"PK\x03\x04", "application/zip", ".zip"),
+    (b"\x1f\x8b", "application/gzip", ".gz"),
+    (b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed", ".7z"),
+    (b"OggS", "audio/ogg", ".ogg"),
+    (b"ID3", "audio/mpeg", ".mp3"),
+    (b"fLaC", "audio/flac", ".flac"),
+    (b"\x1a\x45\xdf\xa3", "video/webm", ".webm"),
+)
+RIFF_FORMATS = {
+    b"WEBP": ("image/webp", ".webp"),
+    b"WAVE": ("audio/wav", ".wav"),
+    b"AVI ": ("video/x-msvideo", ".avi"),
+}
+ISO_BRANDS = {
+    b"qt  ": ("video/quicktime", ".mov"),
+    b"M4A ": ("audio/mp4", ".m4a"),
+    b"heic": ("image/heic", ".heic"),
+    b"heix": ("image/heic", ".heic"),
+    b"mif1": ("image/heif", ".heif"),
+}
+# Zip containers whose extension we keep, so they open in the right application
+ZIP_DOCUMENTS = {
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    ".odt": "application/vnd.oasis.opendocument.text",
+    ".ods": "application/vnd.oasis.opendocument.spreadsheet",
+    ".odp": "application/vnd.oasis.opendocument.presentation",
+    ".epub": "application/epub+zip",
+}
+
+# Resized, thumbnailed and re-encoded; every other type is stored as uploaded
+PROCESSED_IMAGE_TYPES = {"image/jpeg", "image/png", "image/webp"}
+# Shown inline by browsers, so sent as image messages rather than files
+INLINE_IMAGE_TYPES = {"image/jpeg", "image/png", "image/webp", "image/gif"}
+
+def _looks_like_text(header: bytes) -> bool:
+    if b"\x00" in header:
+        return False
+    try:
+        # Incremental, so a character cut off at the end of the header is fine
+        codecs.getincrementaldecoder("utf-8")().decode(header, final=False)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+def _display_name(filename: str) -> str:
+    name = filename.replace("\\", "/").rsplit("/", 1)[-1].strip()
+    return name[:255] or "file"
+
+def sniff(header: bytes, filename: str) -> Tuple[str, str]:
+    """(mime, ext) of a file from its first bytes.
+
+    Unknown binaries become application/octet-stream with a .bin extension, so nothing
+    is ever served back under a type the upload merely claimed (HTML, SVG, scripts).
+    """
+    for magic, mime, ext in SIGNATURES:
+        if header.startswith(magic):
+            if mime == "application/zip":
+                name_ext = "." + filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+                if name_ext in ZIP_DOCUMENTS:
+                    return ZIP_DOCUMENTS[name_ext], name_ext
+            return mime, ext
+    if header[:4] == b"RIFF" and header[8:12] in RIFF_FORMATS:
+        return RIFF_FORMATS[header[8:12]]
+    if header[4:8] == b"ftyp":
+        return ISO_BRANDS.get(header[8:12], ("video/mp4", ".mp4"))
+    if _looks_like_text(header):
+        return "text/plain", ".txt"
+    return "application/octet-stream", ".bin"
+
+def _read_header(path: str) -> bytes:
+    with open(path, "rb") as staged:
+        return staged.read(SNIFF_BYTES)
+
+async def sniff_file(path: str, filename: str) -> Tuple[str, str]:
+    return sniff(await asyncio.to_thread(_read_header, path), filename)
+
+def _attachment_spec() -> Optional[ImageSpec]:
+    if not settings.IMAGE_PROCESSING:
+        return None
+    return ImageSpec(
+        size=settings.MESSAGE_IMAGE_SIZE,
+        crop="limit",
+        thumbnails=(settings.MESSAGE_THUMBNAIL_SIZE,),
+        format=settings.IMAGE_FORMAT,
+        quality=settings.IMAGE_QUALITY,
+        placeholder=True,
+    )
+
+async def submit_attachment(staged_path: str, owner_id: int, filename: str, size: int, sniffed: Tuple[str, str]) -> MediaJob:
+    """Store a complete upload for use in a message. Images also get a thumbnail and a blurhash."""
+    mime, ext = sniffed
+    return await media_jobs.submit(MediaJob(
+        owner_id=owner_id,
+        kind=ATTACHMENT_KIND,
+        staged_path=staged_path,
+        # Unguessable, the URL is all it takes to fetch the file
+        key=f"chat_app_attachments/{owner_id}/{uuid.uuid4().hex}",
+        ext=ext,
+        image_spec=_attachment_spec() if mime in PROCESSED_IMAGE_TYPES else None,
+        meta={"name": _display_name(filename), "mime": mime, "size": size},
+    ))
+
+async def claim_attachment(job_id: str, owner_id: int) -> Optional[dict]:
+    """Message columns for a finished attachment of owner_id, None if there is no such thing.
+
+    Marks the job consumed, so it can go into one message only; release_attachment
+    gives it back if that message is never stored.
+    """
+    now = datetime.utcnow()
+    async with async_session_maker() as session:
+        # Conditional, so two sends of the same job on different workers can't both win
+        result = await session.exec(
+            update(MediaJobRecord)
+            .where(
+                MediaJobRecord.id == job_id,
+                MediaJobRecord.owner_id == owner_id,
+                MediaJobRecord.kind == ATTACHMENT_KIND,
+                MediaJobRecord.status == "done",
+                MediaJobRecord.consumed_at.is_(None),
+                MediaJobRecord.expires_at > now
+            )
+            .values(consumed_at=now)
+        )
+        await session.commit()
+        if result.rowcount != 1:
+            return None
+        job = await session.get(MediaJobRecord, job_id)
+    meta = job.meta
+    return {
+        "message_type": "image" if meta.get("mime") in INLINE_IMAGE_TYPES else "file",
+        "media_url": job.url,
+        "media_name": meta.get("name"),
+        "media_mime": meta.get("mime"),
+        "media_size": meta.get("size"),
+        "media_width": meta.get("width"),
+        "media_height": meta.get("height"),
+        "media_thumbnail": next(iter(job.thumbnails.values()), None),
+        "media_blurhash": meta.get("blurhash"),
+    }
+
+async def release_attachment(job_id: str):
+    async with async_session_maker() as session:
+        await session.exec(update(MediaJobRecord).where(MediaJobRecord.id == job_id).values(consumed_at=None))
+        await session.commit()
@@ -0,0 +1,104 @@
+import os
+import uuid
+from typing import Optional, Tuple
+
+from fastapi import HTTPException, UploadFile, status
+from sqlmodel import update
+
+from app.core.config import settings
+from app.core.security import invalidate_cached_user
+from app.db.session import async_session_maker
+from app.models.user import User
+from app.services.attachments import INLINE_IMAGE_TYPES, sniff_file
+from app.services.images import ImageSpec
+from app.services.media_jobs import MediaJob, media_jobs, stage_upload
+
+PROFILE_PICTURE_TRANSFORMATION = [
+    {"width": 500, "height": 500, "crop": "limit"},
+    {"quality": "auto"}
+]
+GROUP_AVATAR_TRANSFORMATION = [
+    {"width": 500, "height": 500, "crop": "fill"},
+    {"quality": "auto"}
+]
+
+# The same shapes, produced in-house; thumbnails are for chat lists and headers
+AVATAR_THUMBNAIL_SIZES = (64, 128)
+PROFILE_THUMBNAIL_SIZE = 128
+
+def _avatar_spec(crop: str) -> Optional[ImageSpec]:
+    if not settings.IMAGE_PROCESSING:
+        # Left to the storage backend's transformations, as before
+        return None
+    return ImageSpec(
+        size=500,
+        crop=crop,
+        thumbnails=AVATAR_THUMBNAIL_SIZES,
+        format=settings.IMAGE_FORMAT,
+        quality=settings.IMAGE_QUALITY,
+    )
+
+async def stage_avatar(file: UploadFile) -> Tuple[str, str]:
+    """Check the size and stream the upload to a temp file. Returns (staged_path, ext).
+
+    Only JPEG, PNG, WebP and GIF are accepted, judged by the file's own bytes; the
+    extension it is stored under comes from that, never from the uploaded file name.
+    """
+    media_jobs.ensure_capacity()
+    staged_path = await stage_upload(file, settings.AVATAR_MAX_BYTES)
+    mime, ext = await sniff_file(staged_path, "")
+    if mime not in INLINE_IMAGE_TYPES:
+        discard_staged((staged_path, ext))
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="Pictures must be JPEG, PNG, WebP or GIF images",
+        )
+    return staged_path, ext
+
+def discard_staged(staged: Optional[Tuple[str, str]]):
+    if staged:
+        try:
+            os.remove(staged[0])
+        except OSError:
+            pass
+
+async def submit_profile_picture(staged: Tuple[str, str], user_id: int, username: str) -> MediaJob:
+    """Store a staged profile picture and save it on the user, in the background."""
+    staged_path, ext = staged
+
+    async def save_on_user(job: MediaJob):
+        async with async_session_maker() as session:
+            await session.exec(
+                update(User)
+                .where(User.id == user_id)
+                .values(
+                    profile_picture=job.url,
+                    profile_thumbnail=job.thumbnails.get(str(PROFILE_THUMBNAIL_SIZE))
+                )
+            )
+            await session.commit()
+        invalidate_cached_user(username)
+
+    return await media_jobs.submit(MediaJob(
+        owner_id=user_id,
+        kind="profile_picture",
+        staged_path=staged_path,
+        key=f"chat_app_avatars/user_{user_id}_avatar",
+        ext=ext,
+        transformation=PROFILE_PICTURE_TRANSFORMATION,
+        image_spec=_avatar_spec("limit"),
+        on_complete=save_on_user,
+    ))
+
+async def submit_group_avatar(staged: Tuple[str, str], owner_id: int) -> MediaJob:
+    # Uploaded before the group exists; the client puts the returned URL on the group
+    staged_path, ext = staged
+    return await media_jobs.submit(MediaJob(
+        owner_id=owner_id,
+        kind="group_avatar",
+        staged_path=staged_path,
+        key=f"chat_app_group_avatars/group_avatar_{uuid.uuid4().hex[:10]}",
+        ext=ext,
+        transformation=GROUP_AVATAR_TRANSFORMATION,
+        image_spec=_avatar_spec("fill"),
+    ))
@@ -0,0 +1,211 @@
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import bindparam, case
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import Session, select, update, func
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.db.session import async_engine
+from app.models.message import Message
+from app.models.conversation import ConversationSummary
+
+PREVIEW_LENGTH = 120
+
+def _preview(message: Message) -> str:
+    if not message.content and message.media_url:
+        # Attachment sent without a caption
+        return "Photo" if message.message_type == "image" else (message.media_name or "File")[:PREVIEW_LENGTH]
+    return message.content[:PREVIEW_LENGTH]
+
+def _summary_upsert():
+    """INSERT ... ON CONFLICT (user_id, peer_id) DO UPDATE for one summary row per parameter set.
+
+    Atomic, so A->B and B->A (or two sockets of one user) creating the same row at
+    once can't collide on uq_conversation_user_peer. Unread counts add up, and the
+    last message only moves forward, whatever order concurrent writers commit in.
+    """
+    table = ConversationSummary.__table__
+    insert = postgresql_insert if async_engine.dialect.name == "postgresql" else sqlite_insert
+    statement = insert(table).values(
+        user_id=bindparam("b_user_id"),
+        peer_id=bindparam("b_peer_id"),
+        last_message_id=bindparam("b_message_id"),
+        last_message_preview=bindparam("b_preview"),
+        last_message_time=bindparam("b_time"),
+        unread_count=bindparam("b_unread"),
+        last_read_message_id=0,
+        last_delivered_message_id=0,
+    )
+    excluded = statement.excluded
+    newer = func.coalesce(table.c.last_message_id, 0) < excluded.last_message_id
+
+    def latest(column):
+        return case((newer, excluded[column.name]), else_=column)
+
+    return statement.on_conflict_do_update(
+        index_elements=["user_id", "peer_id"],
+        set_={
+            "unread_count": table.c.unread_count + excluded.unread_count,
+            "last_message_id": latest(table.c.last_message_id),
+            "last_message_preview": latest(table.c.last_message_preview),
+            "last_message_time": latest(table.c.last_message_time),
+        },
+    )
+
+def _summary_params(user_id: int, peer_id: int, message: Message, unread_increment: int) -> dict:
+    return {
+        "b_user_id": user_id,
+        "b_peer_id": peer_id,
+        "b_message_id": message.id,
+        "b_preview": _preview(message),
+        "b_time": message.timestamp,
+        "b_unread": unread_increment,
+    }
+
+async def record_direct_messages(session: AsyncSession, messages: List[Message]):
+    """Update both participants' summaries for freshly inserted direct messages. Caller commits.
+
+    Folded per (user, peer) first, so a group-committed batch costs one executemany
+    with a row per conversation side rather than two statements per message.
+    """
+    rows: Dict[Tuple[int, int], dict] = {}
+    for message in messages:
+        if message.receiver_id is None:
+            continue
+        for user_id, peer_id, unread in (
+            (message.sender_id, message.receiver_id, 0),
+            (message.receiver_id, message.sender_id, 1),
+        ):
+            previous = rows.get((user_id, peer_id))
+            params = _summary_params(user_id, peer_id, message, unread)
+            if previous:
+                params["b_unread"] += previous["b_unread"]
+                if previous["b_message_id"] > message.id:
+                    params.update({k: previous[k] for k in ("b_message_id", "b_preview", "b_time")})
+            rows[(user_id, peer_id)] = params
+    if not rows:
+        return
+    connection = await session.connection()
+    await connection.execute(_summary_upsert(), list(rows.values()))
+
+async def get_summary(session: AsyncSession, user_id: int, peer_id: int) -> Optional[ConversationSummary]:
+    return (await session.exec(
+        select(ConversationSummary).where(
+            (ConversationSummary.user_id == user_id) &
+            (ConversationSummary.peer_id == peer_id)
+        )
+    )).first()
+
+async def mark_conversation_read(session: AsyncSession, user_id: int, peer_id: int):
+    """Move user_id's read watermark for peer_id up to the latest message and clear the badge.
+
+    One row update, whatever the number of unread messages. Caller commits.
+    """
+    await session.exec(
+        update(ConversationSummary)
+        .where(
+            (ConversationSummary.user_id == user_id) &
+            (ConversationSummary.peer_id == peer_id)
+        )
+        .values(
+            unread_count=0,
+            last_read_message_id=ConversationSummary.last_message_id
+        )
+    )
+
+async def read_watermarks(session: AsyncSession, user_id: int, peer_id: int) -> Tuple[int, int]:
+    """(user's watermark for peer, peer's watermark for user), 0 where nothing was read."""
+    rows = (await session.exec(
+        select(ConversationSummary.user_id, ConversationSummary.last_read_message_id).where(
+            ((ConversationSummary.user_id == user_id) & (ConversationSummary.peer_id == peer_id)) |
+            ((ConversationSummary.user_id == peer_id) & (ConversationSummary.peer_id == user_id))
+        )
+    )).all()
+    marks = {owner_id: watermark or 0 for owner_id, watermark in rows}
+    return marks.get(user_id, 0), marks.get(peer_id, 0)
+
+def rebuild_conversation_summaries(session: Session):
+    """Backfill the summary table from existing direct messages.
+
+    Read state is taken from the legacy is_read column, which is only current for
+    databases that predate the summary table.
+    """
+    direct = (Message.receiver_id != None) & (Message.group_id == None)
+
+    last_ids: Dict[Tuple[int, int], int] = {}
+    rows = session.exec(
+        select(Message.sender_id, Message.receiver_id, func.max(Message.id))
+        .where(direct)
+        .group_by(Message.sender_id, Message.receiver_id)
+    ).all()
+    for sender_id, receiver_id, max_id in rows:
+        for pair in ((sender_id, receiver_id), (receiver_id, sender_id)):
+            last_ids[pair] = max(last_ids.get(pair, 0), max_id)
+
+    if not last_ids:
+        return
+
+    unread: Dict[Tuple[int, int], int] = {}
+    rows = session.exec(
+        select(Message.receiver_id, Message.sender_id, func.count(Message.id))
+        .where(direct & (Message.is_read == False))
+        .group_by(Message.receiver_id, Message.sender_id)
+    ).all()
+    for receiver_id, sender_id, count in rows:
+        unread[(receiver_id, sender_id)] = count
+
+    read_marks = _legacy_read_watermarks(session)
+
+    messages = session.exec(
+        select(Message).where(Message.id.in_(set(last_ids.values())))
+    ).all()
+    by_id = {m.id: m for m in messages}
+
+    session.exec(ConversationSummary.__table__.delete())
+    for (user_id, peer_id), message_id in last_ids.items():
+        message = by_id[message_id]
+        session.add(ConversationSummary(
+            user_id=user_id,
+            peer_id=peer_id,
+            last_message_id=message.id,
+            last_message_preview=_preview(message),
+            last_message_time=message.timestamp,
+            unread_count=unread.get((user_id, peer_id), 0),
+            last_read_message_id=read_marks.get((user_id, peer_id), 0)
+        ))
+    session.commit()
+
+def _legacy_read_watermarks(session: Session) -> Dict[Tuple[int, int], int]:
+    # Highest message each reader had flagged is_read, per (reader, peer)
+    rows = session.exec(
+        select(Message.receiver_id, Message.sender_id, func.max(Message.id))
+        .where((Message.receiver_id != None) & (Message.group_id == None) & (Message.is_read == True))
+        .group_by(Message.receiver_id, Message.sender_id)
+    ).all()
+    return {(receiver_id, sender_id): max_id for receiver_id, sender_id, max_id in rows}
+
+def backfill_read_watermarks(session: Session):
+    """Migrate legacy per-row is_read flags into watermarks for summaries that have none yet."""
+    missing = session.exec(
+        select(ConversationSummary.id).where(ConversationSummary.last_read_message_id == None).limit(1)
+    ).first()
+    if missing is None:
+        return
+
+    for (user_id, peer_id), watermark in _legacy_read_watermarks(session).items():
+        session.exec(
+            update(ConversationSummary)
+            .where(
+                (ConversationSummary.user_id == user_id) &
+                (ConversationSummary.peer_id == peer_id) &
+                (ConversationSummary.last_read_message_id == None)
+            )
+            .values(last_read_message_id=watermark)
+        )
+    # Conversations with nothing read yet
+    session.exec(
+        update(ConversationSummary)
+        .where(ConversationSummary.last_read_message_id == None)
+        .values(last_read_message_id=0)
+    )
+    session.commit()
@@ -0,0 +1,156 @@
+import asyncio
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import bindparam, case, func, tuple_
+from sqlmodel import select
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.db.session import async_session_maker
+from app.models.conversation import ConversationSummary
+from app.models.message import Message
+from app.websockets.manager import manager
+
+class RecentClientIds:
+    """The last few client_msg_id -> message id pairs per sender, so resends are answered from memory.
+
+    Only a fast path: the unique (sender_id, client_msg_id) index still catches
+    anything this cache has forgotten or that arrived on another worker.
+    """
+
+    def __init__(self, window: int, max_senders: int, ttl_seconds: int):
+        self.window = window
+        self._senders = TTLCache(max_size=max_senders, ttl_seconds=ttl_seconds)
+
+    def get(self, sender_id: int, client_msg_id: str) -> Optional[int]:
+        recent = self._senders.get(sender_id)
+        if recent is None:
+            return None
+        return recent.get(client_msg_id)
+
+    def add(self, sender_id: int, client_msg_id: str, message_id: int):
+        recent = self._senders.get(sender_id)
+        if recent is None:
+            recent = OrderedDict()
+        recent[client_msg_id] = message_id
+        while len(recent) > self.window:
+            recent.popitem(last=False)
+        self._senders.set(sender_id, recent)
+
+recent_client_ids = RecentClientIds(
+    window=settings.CLIENT_MSG_ID_WINDOW,
+    max_senders=settings.CLIENT_MSG_ID_CACHE_SIZE,
+    ttl_seconds=settings.CLIENT_MSG_ID_TTL_SECONDS,
+)
+
+async def find_by_client_id(sender_id: int, client_msg_id: str) -> Optional[Message]:
+    async with async_session_maker() as session:
+        return (await session.exec(
+            select(Message).where(
+                (Message.sender_id == sender_id) &
+                (Message.client_msg_id == client_msg_id)
+            )
+        )).first()
+
+class DeliveryTracker:
+    """Collects delivery acks and writes them as one bulk watermark update per interval.
+
+    Acks only ever move a (recipient, sender) watermark forward, so between flushes
+    only the highest acked id per conversation needs to be kept.
+    """
+
+    def __init__(self, flush_interval_ms: int):
+        self.flush_interval = flush_interval_ms / 1000
+        self._pending: Dict[Tuple[int, int], int] = {}
+        self._flusher: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flusher is None:
+            return
+        self._flusher.cancel()
+        try:
+            await self._flusher
+        except asyncio.CancelledError:
+            pass
+        self._flusher = None
+        # Don't lose the acks of the last interval
+        await self.flush()
+
+    def record(self, user_id: int, peer_id: int, message_id: int):
+        key = (user_id, peer_id)
+        if message_id > self._pending.get(key, 0):
+            self._pending[key] = message_id
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+
+        table = ConversationSummary.__table__
+        # Nobody can have received a message past the end of the conversation
+        watermark = case(
+            (table.c.last_message_id < bindparam("b_message_id"), table.c.last_message_id),
+            else_=bindparam("b_message_id")
+        )
+        statement = (
+            table.update()
+            .where(
+                (table.c.user_id == bindparam("b_user_id")) &
+                (table.c.peer_id == bindparam("b_peer_id")) &
+                (func.coalesce(table.c.last_delivered_message_id, 0) < watermark)
+            )
+            .values(last_delivered_message_id=watermark)
+        )
+        params = [
+            {"b_user_id": user_id, "b_peer_id": peer_id, "b_message_id": message_id}
+            for (user_id, peer_id), message_id in pending.items()
+        ]
+        delivered = (
+            ConversationSummary.user_id,
+            ConversationSummary.peer_id,
+            func.coalesce(ConversationSummary.last_delivered_message_id, 0)
+        )
+        in_pending = tuple_(ConversationSummary.user_id, ConversationSummary.peer_id).in_(list(pending))
+        try:
+            async with async_session_maker() as session:
+                before = {
+                    (user_id, peer_id): watermark
+                    for user_id, peer_id, watermark in (await session.exec(select(*delivered).where(in_pending))).all()
+                }
+                connection = await session.connection()
+                await connection.execute(statement, params)
+                after = (await session.exec(select(*delivered).where(in_pending))).all()
+                await session.commit()
+        except Exception:
+            # Put the acks back for the next flush, unless newer ones arrived meanwhile
+            for key, message_id in pending.items():
+                if message_id > self._pending.get(key, 0):
+                    self._pending[key] = message_id
+            raise
+
+        for user_id, peer_id, last_delivered_message_id in after:
+            # Acks at or behind the stored watermark changed nothing, nobody needs telling
+            if last_delivered_message_id <= before.get((user_id, peer_id), 0):
+                continue
+            await manager.send_personal_message(
+                {
+                    "type": "DELIVERY_UPDATE",
+                    "recipient_id": user_id,
+                    "last_delivered_message_id": last_delivered_message_id
+                },
+                peer_id
+            )
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Delivery ack flush failed : {e}")
+
+delivery_tracker = DeliveryTracker(flush_interval_ms=settings.DELIVERY_FLUSH_INTERVAL_MS)
@@ -0,0 +1,106 @@
+from typing import Dict, List, Set, Tuple
+
+from sqlalchemy import case, delete, text
+from sqlmodel import Session, select, update
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.db.migrations import has_index
+from app.db.session import async_session_maker
+from app.models.friend import FriendRequest, FriendStatus
+
+# Declared on FriendRequest; tables from before it get it as a unique index
+PAIR_CONSTRAINT = "uq_friendrequest_pair"
+
+def canonical_pair(user_a: int, user_b: int) -> Tuple[int, int]:
+    return (min(user_a, user_b), max(user_a, user_b))
+
+class FriendGraph:
+    """Per-user sets of friend ids, warmed lazily from accepted FriendRequest rows.
+
+    accept/reject on this worker update it in place; the TTL bounds staleness from other workers.
+    """
+
+    def __init__(self, max_users: int, ttl_seconds: int):
+        self._friends = TTLCache(max_size=max_users, ttl_seconds=ttl_seconds)
+
+    async def friends_of(self, user_id: int) -> Set[int]:
+        friends = self._friends.get(user_id)
+        if friends is not None:
+            return friends
+
+        async with async_session_maker() as session:
+            rows = (await session.exec(
+                select(FriendRequest.pair_low_id, FriendRequest.pair_high_id).where(
+                    (FriendRequest.status == FriendStatus.ACCEPTED) &
+                    ((FriendRequest.pair_low_id == user_id) | (FriendRequest.pair_high_id == user_id))
+                )
+            )).all()
+        friends = {high if low == user_id else low for low, high in rows}
+        self._friends.set(user_id, friends)
+        return friends
+
+    async def are_friends(self, user_a: int, user_b: int) -> bool:
+        return user_b in await self.friends_of(user_a)
+
+    def add_friendship(self, user_a: int, user_b: int):
+        for user_id, friend_id in ((user_a, user_b), (user_b, user_a)):
+            friends = self._friends.get(user_id)
+            if friends is not None:
+                friends.add(friend_id)
+
+    def remove_friendship(self, user_a: int, user_b: int):
+        for user_id, friend_id in ((user_a, user_b), (user_b, user_a)):
+            friends = self._friends.get(user_id)
+            if friends is not None:
+                friends.discard(friend_id)
+
+def backfill_friend_pairs(session: Session):
+    """Fill pair_low_id/pair_high_id on rows created before the columns existed, then enforce one row per pair.
+
+    Older databases may hold a request in each direction for the same two users; the
+    accepted one is kept (else the newest) before the unique index is created.
+    """
+    session.exec(
+        update(FriendRequest)
+        .where(FriendRequest.pair_low_id == None)
+        .values(
+            pair_low_id=case(
+                (FriendRequest.sender_id < FriendRequest.receiver_id, FriendRequest.sender_id),
+                else_=FriendRequest.receiver_id
+            ),
+            pair_high_id=case(
+                (FriendRequest.sender_id < FriendRequest.receiver_id, FriendRequest.receiver_id),
+                else_=FriendRequest.sender_id
+            ),
+        )
+    )
+
+    connection = session.connection()
+    if not has_index(connection, FriendRequest.__tablename__, PAIR_CONSTRAINT):
+        keep: Dict[Tuple[int, int], Tuple[bool, int]] = {}
+        duplicates: List[int] = []
+        rows = session.exec(
+            select(FriendRequest.id, FriendRequest.pair_low_id, FriendRequest.pair_high_id, FriendRequest.status)
+        ).all()
+        for request_id, low, high, status in rows:
+            rank = (status == FriendStatus.ACCEPTED, request_id)
+            kept = keep.get((low, high))
+            if kept is None:
+                keep[(low, high)] = rank
+            elif rank > kept:
+                duplicates.append(kept[1])
+                keep[(low, high)] = rank
+            else:
+                duplicates.append(request_id)
+        if duplicates:
+            session.exec(delete(FriendRequest).where(FriendRequest.id.in_(duplicates)))
+        connection.execute(text(
+            f"CREATE UNIQUE INDEX {PAIR_CONSTRAINT} ON friendrequest (pair_low_id, pair_high_id)"
+        ))
+    session.commit()
+
+friend_graph = FriendGraph(
+    max_users=settings.FRIEND_CACHE_SIZE,
+    ttl_seconds=settings.FRIEND_CACHE_TTL_SECONDS,
+)
@@ -0,0 +1,63 @@
+from typing import FrozenSet, Set
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlmodel import select
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.db.session import async_session_maker
+from app.models.group import GroupMember
+
+class GroupMembershipIndex:
+    """Cached group -> member ids map so group fan-out skips the membership query.
+
+    Entries are dropped whenever a session commits a membership change (see
+    _drop_changed_groups below). The TTL bounds how stale other workers' copies can get.
+    """
+
+    def __init__(self, max_groups: int, ttl_seconds: int):
+        self._groups = TTLCache(max_size=max_groups, ttl_seconds=ttl_seconds)
+
+    async def members(self, group_id: int) -> FrozenSet[int]:
+        members = self._groups.get(group_id)
+        if members is not None:
+            return members
+
+        async with async_session_maker() as session:
+            rows = (await session.exec(
+                select(GroupMember.User_id).where(GroupMember.group_id == group_id)
+            )).all()
+        members = frozenset(rows)
+        self._groups.set(group_id, members)
+        return members
+
+    async def is_member(self, group_id: int, user_id: int) -> bool:
+        return user_id in await self.members(group_id)
+
+    def invalidate(self, group_id: int):
+        self._groups.invalidate(group_id)
+
+group_members = GroupMembershipIndex(
+    max_groups=settings.GROUP_CACHE_SIZE,
+    ttl_seconds=settings.GROUP_CACHE_TTL_SECONDS,
+)
+
+# Every ORM write to GroupMember, from any session, sync or async, goes through these;
+# groups are collected on flush and dropped once committed, so a read in between
+# can't cache the old members again
+@event.listens_for(Session, "after_flush")
+def _collect_changed_groups(session: Session, flush_context):
+    changed: Set[int] = session.info.setdefault("changed_groups", set())
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, GroupMember):
+            changed.add(obj.group_id)
+
+@event.listens_for(Session, "after_commit")
+def _drop_changed_groups(session: Session):
+    for group_id in session.info.pop("changed_groups", ()):
+        group_members.invalidate(group_id)
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changed_groups(session: Session):
+    session.info.pop("changed_groups", None)
@@ -0,0 +1,62 @@
+from typing import List, Optional, Sequence
+
+from fastapi import HTTPException, Response
+from sqlalchemy import union_all
+from sqlalchemy.orm import aliased
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlmodel.sql.expression import SelectOfScalar
+
+from app.models.message import Message
+
+def merge_limited(pages: Sequence[SelectOfScalar[Message]], ascending: bool, limit: int) -> SelectOfScalar[Message]:
+    """UNION ALL of already ordered and limited message queries, merged in id order and limited again."""
+    if len(pages) == 1:
+        return pages[0]
+    union = union_all(*[select(page.subquery()) for page in pages]).subquery()
+    merged = aliased(Message, union)
+    return select(merged).order_by(merged.id.asc() if ascending else merged.id.desc()).limit(limit)
+
+async def fetch_message_page(
+    session: AsyncSession,
+    branches: Sequence[SelectOfScalar[Message]],
+    response: Response,
+    before_id: Optional[int],
+    after_id: Optional[int],
+    limit: int
+) -> List[Message]:
+    """Keyset-paginate a message query on id and set X-Next-Cursor when more rows exist.
+
+    Pages are returned oldest first. Without a cursor the newest page is returned.
+    Each branch is a query that one index serves in id order, e.g. one direction of a
+    conversation. Every branch is limited on its own and the results are merged, so a
+    page costs the same however long the conversation is. An OR of the branches would
+    make the database collect and sort every matching row instead.
+    """
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="Use either before_id or after_id, not both")
+
+    # Message ids are monotonic, so they double as the keyset cursor
+    def keyset(statement: SelectOfScalar[Message]) -> SelectOfScalar[Message]:
+        if after_id is not None:
+            statement = statement.where(Message.id > after_id).order_by(Message.id.asc())
+        else:
+            if before_id is not None:
+                statement = statement.where(Message.id < before_id)
+            statement = statement.order_by(Message.id.desc())
+        # One extra row to know whether another page exists
+        return statement.limit(limit + 1)
+
+    statement = merge_limited([keyset(branch) for branch in branches], after_id is not None, limit + 1)
+    messages = (await session.exec(statement)).all()
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+
+    if after_id is None:
+        messages.reverse()
+
+    if has_more and messages:
+        cursor = messages[-1].id if after_id is not None else messages[0].id
+        response.headers["X-Next-Cursor"] = str(cursor)
+
+    return messages
@@ -0,0 +1,186 @@
+import asyncio
+import math
+import multiprocessing
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Sequence
+
+from PIL import Image, ImageOps
+
+from app.core.config import settings
+
+# Pillow format name, file extension and MIME type per output format
+FORMATS = {"webp": ("WEBP", ".webp", "image/webp"), "jpeg": ("JPEG", ".jpg", "image/jpeg")}
+
+BLURHASH_CHARACTERS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+
+class ImageSpec:
+    """What to produce from one upload: a main image and square-bounded thumbnails.
+
+    crop is "fill" (center-crop to exactly size x size) or "limit" (shrink to fit,
+    keeping the aspect ratio). placeholder adds a blurhash of the image to the result.
+    Sent to worker processes, so keep it plain data.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        crop: str,
+        thumbnails: Sequence[int],
+        format: str,
+        quality: int,
+        placeholder: bool = False,
+    ):
+        if format not in FORMATS:
+            raise ValueError(f"Unsupported image format: {format}")
+        self.size = size
+        self.crop = crop
+        self.thumbnails = tuple(thumbnails)
+        self.format = format
+        self.quality = quality
+        self.placeholder = placeholder
+
+    @property
+    def ext(self) -> str:
+        return FORMATS[self.format][1]
+
+    @property
+    def mime(self) -> str:
+        return FORMATS[self.format][2]
+
+def _init_worker(max_pixels: int):
+    # Refuse decompression bombs outright instead of only warning about them
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    warnings.simplefilter("error", Image.DecompressionBombWarning)
+
+def _resize(image: Image.Image, size: int, crop: str) -> Image.Image:
+    if crop == "fill":
+        return ImageOps.fit(image, (size, size), Image.LANCZOS)
+    resized = image.copy()
+    resized.thumbnail((size, size), Image.LANCZOS)
+    return resized
+
+def _save(image: Image.Image, path: str, spec: ImageSpec) -> str:
+    pillow_format = FORMATS[spec.format][0]
+    if pillow_format == "WEBP":
+        image.save(path, pillow_format, quality=spec.quality, method=4)
+    else:
+        image.save(path, pillow_format, quality=spec.quality, optimize=True, progressive=True)
+    return path
+
+def _srgb_to_linear(value: int) -> float:
+    value = value / 255
+    return value / 12.92 if value <= 0.04045 else ((value + 0.055) / 1.055) ** 2.4
+
+def _linear_to_srgb(value: float) -> int:
+    value = max(0.0, min(1.0, value))
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+def _base83(value: int, length: int) -> str:
+    return "".join(
+        BLURHASH_CHARACTERS[(value // 83 ** (length - i)) % 83] for i in range(1, length + 1)
+    )
+
+def _blurhash(image: Image.Image, x_components: int = 4, y_components: int = 3) -> str:
+    """Encode a blurhash (https://blurha.sh) so clients can paint a placeholder before loading."""
+    # The hash only keeps a few low frequencies, a tiny copy gives the same result
+    small = image.convert("RGB")
+    small.thumbnail((32, 32), Image.BILINEAR)
+    width, height = small.size
+    pixels = [tuple(_srgb_to_linear(channel) for channel in pixel) for pixel in small.getdata()]
+
+    factors = []
+    for j in range(y_components):
+        cos_y = [math.cos(math.pi * j * y / height) for y in range(height)]
+        for i in range(x_components):
+            cos_x = [math.cos(math.pi * i * x / width) for x in range(width)]
+            normalisation = 1 if i == 0 and j == 0 else 2
+            r = g = b = 0.0
+            for y in range(height):
+                row = y * width
+                for x in range(width):
+                    basis = cos_x[x] * cos_y[y]
+                    pixel = pixels[row + x]
+                    r += basis * pixel[0]
+                    g += basis * pixel[1]
+                    b += basis * pixel[2]
+            scale = normalisation / (width * height)
+            factors.append((r * scale, g * scale, b * scale))
+
+    dc, ac = factors[0], factors[1:]
+    result = _base83((x_components - 1) + (y_components - 1) * 9, 1)
+    if ac:
+        quantised_max = max(0, min(82, int(max(abs(c) for factor in ac for c in factor) * 166 - 0.5)))
+        maximum = (quantised_max + 1) / 166
+        result += _base83(quantised_max, 1)
+    else:
+        maximum = 1.0
+        result += _base83(0, 1)
+    result += _base83((_linear_to_srgb(dc[0]) << 16) + (_linear_to_srgb(dc[1]) << 8) + _linear_to_srgb(dc[2]), 4)
+
+    def quantise(value: float) -> int:
+        scaled = math.copysign(abs(value / maximum) ** 0.5, value)
+        return max(0, min(18, int(math.floor(scaled * 9 + 9.5))))
+
+    for r, g, b in ac:
+        result += _base83(quantise(r) * 19 * 19 + quantise(g) * 19 + quantise(b), 2)
+    return result
+
+def process_image(source_path: str, spec: ImageSpec) -> Dict:
+    """Decode, orient, crop and re-encode one upload. Runs in a worker process.
+
+    Writes the outputs next to source_path and returns
+    {"width", "height", "files": {"full" | "<size>": path}}, plus "blurhash" when
+    the spec asks for a placeholder. Metadata is not carried over.
+    """
+    with Image.open(source_path) as image:
+        # JPEGs decode straight at a reduced scale, so memory stays bounded by the output size
+        image.draft("RGB", (spec.size, spec.size))
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        image = image.convert("RGBA" if has_alpha and spec.format == "webp" else "RGB")
+
+    main = _resize(image, spec.size, spec.crop)
+    base, ext = os.path.splitext(source_path)[0], spec.ext
+    files = {"full": _save(main, f"{base}{ext}", spec)}
+    for size in spec.thumbnails:
+        # Derived from the already reduced main image, which is cheap
+        files[str(size)] = _save(_resize(main, size, spec.crop), f"{base}_{size}{ext}", spec)
+    result = {"width": main.width, "height": main.height, "files": files}
+    if spec.placeholder:
+        result["blurhash"] = _blurhash(main)
+    return result
+
+class ImageProcessor:
+    """Runs Pillow in a process pool: decoding and resampling are CPU bound and would stall the event loop.
+
+    Concurrency is already bounded by the media job workers feeding it.
+    """
+
+    def __init__(self, workers: int, max_pixels: int):
+        self.workers = workers
+        self.max_pixels = max_pixels
+        # Created on first use: worker processes import this module too and must not build their own pool
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    async def process(self, source_path: str, spec: ImageSpec) -> Dict:
+        if self._executor is None:
+            # spawn, not fork: the server process has threads and a running loop
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.max_pixels,),
+            )
+        return await asyncio.get_running_loop().run_in_executor(self._executor, process_image, source_path, spec)
+
+    async def shutdown(self):
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            # Waiting reaps the worker processes; a thread keeps that off the event loop
+            await asyncio.to_thread(executor.shutdown, wait=True, cancel_futures=True)
+
+image_processor = ImageProcessor(workers=settings.IMAGE_PROCESS_WORKERS, max_pixels=settings.IMAGE_MAX_PIXELS)
@@ -0,0 +1,281 @@
+import asyncio
+import os
+import tempfile
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException, UploadFile, status
+from sqlmodel import delete, update
+
+from app.core.config import settings
+from app.db.session import async_session_maker
+from app.models.media import MediaJobRecord
+from app.services.images import ImageSpec, image_processor
+from app.services.storage import Storage, storage
+from app.websockets.manager import manager
+
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+# Called with the finished job once everything is stored, e.g. to save the URL on the user
+OnComplete = Callable[["MediaJob"], Awaitable[None]]
+
+class MediaJob:
+    def __init__(
+        self,
+        owner_id: int,
+        kind: str,
+        staged_path: str,
+        key: str,
+        ext: str,
+        transformation: Optional[list] = None,
+        image_spec: Optional[ImageSpec] = None,
+        on_complete: Optional[OnComplete] = None,
+        meta: Optional[dict] = None,
+    ):
+        self.id = uuid.uuid4().hex
+        self.owner_id = owner_id
+        self.kind = kind
+        self.staged_path = staged_path
+        self.key = key
+        # Processed images are re-encoded, so they get the spec's extension
+        self.ext = image_spec.ext if image_spec else ext
+        self.transformation = transformation
+        self.image_spec = image_spec
+        self.on_complete = on_complete
+        self.status = "pending"
+        # Set on submit to the URL the file will have, so clients can use it right away
+        self.url: Optional[str] = None
+        self.thumbnails: Dict[str, str] = {}
+        # Whatever clients need to render the file without fetching it: name, size, dimensions...
+        self.meta: dict = dict(meta or {})
+        self.error: Optional[str] = None
+        # Set on submit; after this the job is deleted and can no longer be used in a message
+        self.expires_at: Optional[datetime] = None
+
+    def thumbnail_key(self, size: int) -> str:
+        return f"{self.key}_{size}"
+
+    def record(self) -> MediaJobRecord:
+        return MediaJobRecord(
+            id=self.id,
+            owner_id=self.owner_id,
+            kind=self.kind,
+            status=self.status,
+            url=self.url,
+            thumbnails=self.thumbnails,
+            meta=self.meta,
+            error=self.error,
+            expires_at=self.expires_at,
+        )
+
+    def to_dict(self) -> dict:
+        return self.record().to_dict()
+
+async def stage_upload(file: UploadFile, max_bytes: int) -> str:
+    """Stream an upload to a temp file in chunks and return its path. 413 past max_bytes."""
+    fd, path = tempfile.mkstemp(prefix="upload-", dir=settings.UPLOAD_TMP_DIR)
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as staged:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail=f"File is larger than {max_bytes // (1024 * 1024)} MB",
+                    )
+                await asyncio.to_thread(staged.write, chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+def _queue_full() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Upload queue is full, please try again shortly",
+        headers={"Retry-After": "5"},
+    )
+
+class MediaJobQueue:
+    """Background workers that move staged uploads into storage and tell the owner when done.
+
+    Requests only stage the file and enqueue, so nobody waits on the storage round-trip.
+    Job state goes to the database for MEDIA_JOB_TTL_SECONDS, so any worker can report
+    it or attach the file to a message; the work itself stays on the worker that got the upload.
+    """
+
+    def __init__(self, store: Storage, workers: int, max_pending: int, ttl_seconds: float, sweep_interval: float):
+        self.storage = store
+        self.workers = workers
+        self.max_pending = max_pending
+        self.ttl = ttl_seconds
+        self.sweep_interval = sweep_interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweep_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Jobs never picked up would otherwise leave their staged files behind
+        while self._queue is not None and not self._queue.empty():
+            job = self._queue.get_nowait()
+            job.status = "failed"
+            job.error = "Server shut down before the upload was stored"
+            try:
+                os.remove(job.staged_path)
+            except OSError:
+                pass
+            try:
+                await self._save(job)
+            except Exception as e:
+                print(f"Media job {job.id} state lost : {e}")
+
+    def ensure_capacity(self):
+        # Checked before staging, so a full queue doesn't cost a disk write first
+        if self._queue is None or self._queue.full():
+            raise _queue_full()
+
+    async def submit(self, job: MediaJob) -> MediaJob:
+        job.url = self.storage.url_for(job.key, job.ext)
+        if job.image_spec:
+            job.thumbnails = {
+                str(size): self.storage.url_for(job.thumbnail_key(size), job.ext)
+                for size in job.image_spec.thumbnails
+            }
+        job.expires_at = datetime.utcnow() + timedelta(seconds=self.ttl)
+        try:
+            # Recorded before it is queued, so the worker always has a row to update
+            async with async_session_maker() as session:
+                session.add(job.record())
+                await session.commit()
+        except BaseException:
+            os.remove(job.staged_path)
+            raise
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            os.remove(job.staged_path)
+            await self._forget(job.id)
+            raise _queue_full()
+        return job
+
+    async def get(self, job_id: str) -> Optional[MediaJobRecord]:
+        async with async_session_maker() as session:
+            record = await session.get(MediaJobRecord, job_id)
+        if not record or record.expires_at <= datetime.utcnow():
+            return None
+        return record
+
+    async def _save(self, job: MediaJob):
+        async with async_session_maker() as session:
+            await session.exec(
+                update(MediaJobRecord)
+                .where(MediaJobRecord.id == job.id)
+                .values(status=job.status, url=job.url, thumbnails=job.thumbnails, meta=job.meta, error=job.error)
+            )
+            await session.commit()
+
+    @staticmethod
+    async def _forget(job_id: str):
+        async with async_session_maker() as session:
+            await session.exec(delete(MediaJobRecord).where(MediaJobRecord.id == job_id))
+            await session.commit()
+
+    async def _sweep_loop(self):
+        # Expired jobs can't be attached any more; their files stay in storage
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                async with async_session_maker() as session:
+                    await session.exec(delete(MediaJobRecord).where(MediaJobRecord.expires_at <= datetime.utcnow()))
+                    await session.commit()
+            except Exception as e:
+                print(f"Media job sweep failed : {e}")
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._process(job)
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, job: MediaJob):
+        job.status = "processing"
+        try:
+            await self._save(job)
+            if job.image_spec:
+                await self._store_processed(job)
+            else:
+                job.url = await self._store(job.staged_path, job.key, job.ext, job.transformation)
+            if job.on_complete:
+                await job.on_complete(job)
+            job.status = "done"
+        except Exception as e:
+            print(f"Media upload {job.id} failed : {e}")
+            job.status = "failed"
+            job.error = "Upload failed"
+        finally:
+            try:
+                os.remove(job.staged_path)
+            except OSError:
+                pass
+
+        try:
+            await self._save(job)
+        except Exception as e:
+            print(f"Media job {job.id} state lost : {e}")
+        await manager.send_personal_message(
+            {"type": "UPLOAD_READY" if job.status == "done" else "UPLOAD_FAILED", **job.to_dict()},
+            job.owner_id
+        )
+
+    async def _store(self, path: str, key: str, ext: str, transformation: Optional[list] = None) -> str:
+        url = await asyncio.to_thread(self.storage.save, path, key, ext, transformation)
+        if not url:
+            raise RuntimeError("storage returned no URL")
+        return url
+
+    async def _store_processed(self, job: MediaJob):
+        # Decoding doubles as validation: anything Pillow can't read fails the job
+        result = await image_processor.process(job.staged_path, job.image_spec)
+        try:
+            job.meta.update(
+                mime=job.image_spec.mime,
+                size=os.path.getsize(result["files"]["full"]),
+                width=result["width"],
+                height=result["height"],
+            )
+            if "blurhash" in result:
+                job.meta["blurhash"] = result["blurhash"]
+            for name, path in result["files"].items():
+                if name == "full":
+                    job.url = await self._store(path, job.key, job.ext)
+                else:
+                    job.thumbnails[name] = await self._store(path, job.thumbnail_key(int(name)), job.ext)
+        finally:
+            for path in result["files"].values():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+media_jobs = MediaJobQueue(
+    store=storage,
+    workers=settings.MEDIA_UPLOAD_WORKERS,
+    max_pending=settings.MEDIA_QUEUE_SIZE,
+    ttl_seconds=settings.MEDIA_JOB_TTL_SECONDS,
+    sweep_interval=settings.UPLOAD_SWEEP_INTERVAL_SECONDS,
+)
@@ -0,0 +1,260 @@
+import html
+import re
+from typing import List, Optional, Tuple
+
+from sqlalchemy import column, func, literal_column, table, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import DBAPIError
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.db.session import async_engine
+from app.models.conversation import ConversationSummary
+from app.models.group import GroupMember
+from app.models.message import Message
+
+# Private-use characters mark hits inside snippets, swapped for <mark> after escaping
+MARK_START, MARK_END = "\ue000", "\ue001"
+SNIPPET_TOKENS = 16
+# Shorter last words match whole words only; a one-letter prefix matches half the index
+PREFIX_MIN_CHARS = 3
+
+SEARCH_DOCUMENT_TEXT = "coalesce(message.content, '') || ' ' || coalesce(message.media_name, '')"
+# Conversation keys, "d<low user id>x<high user id>" or "g<group id>": one token each,
+# so the index narrows a search to the caller's conversations before ranking anything
+SQLITE_CONVERSATION_KEY = (
+    "CASE WHEN group_id IS NOT NULL THEN 'g' || group_id "
+    "ELSE 'd' || min(sender_id, receiver_id) || 'x' || max(sender_id, receiver_id) END"
+)
+POSTGRES_CONVERSATION_KEY = (
+    "CASE WHEN group_id IS NOT NULL THEN 'g' || group_id::text "
+    "ELSE 'd' || least(sender_id, receiver_id)::text || 'x' || greatest(sender_id, receiver_id)::text END"
+)
+
+WORD = re.compile(r"\w+")
+
+def conversation_key(sender_id: int, receiver_id: Optional[int], group_id: Optional[int]) -> str:
+    """Same value as the SQL expressions above."""
+    if group_id is not None:
+        return f"g{group_id}"
+    low, high = sorted((sender_id, receiver_id))
+    return f"d{low}x{high}"
+
+class MessageSearchIndex:
+    """Full-text index over message text and attachment names.
+
+    SQLite gets an FTS5 table with external content (no second copy of the text), read
+    through a view that adds the conversation key as an indexed column; the message
+    writer fills it in the same transaction as the messages. Postgres gets stored
+    generated columns for the key and the tsvector, under one btree_gin index (or two
+    plain ones without that extension), which Postgres maintains on every insert itself.
+    Both use the "simple" configuration: chats are multilingual, so no stemming. Only
+    SQLite folds diacritics; Postgres would need the unaccent extension for that.
+    """
+
+    def __init__(self):
+        self.available = False
+
+    @property
+    def dialect(self) -> str:
+        return async_engine.dialect.name
+
+    def ensure(self, engine: Engine):
+        try:
+            with engine.begin() as conn:
+                if engine.dialect.name == "postgresql":
+                    conn.execute(text(
+                        "ALTER TABLE message ADD COLUMN IF NOT EXISTS search_conversation text "
+                        f"GENERATED ALWAYS AS ({POSTGRES_CONVERSATION_KEY}) STORED"
+                    ))
+                    conn.execute(text(
+                        "ALTER TABLE message ADD COLUMN IF NOT EXISTS search_document tsvector "
+                        f"GENERATED ALWAYS AS (to_tsvector('simple'::regconfig, {SEARCH_DOCUMENT_TEXT})) STORED"
+                    ))
+                    self._create_postgres_index(conn)
+                elif engine.dialect.name == "sqlite":
+                    existing = conn.execute(text(
+                        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'message_fts'"
+                    )).scalar()
+                    # Recreated every start, so it always matches the code; FTS5 looks it up by name
+                    conn.execute(text("DROP VIEW IF EXISTS message_fts_source"))
+                    conn.execute(text(
+                        "CREATE VIEW message_fts_source AS "
+                        f"SELECT id, content, media_name, {SQLITE_CONVERSATION_KEY} AS conversation FROM message"
+                    ))
+                    conn.execute(text(
+                        "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5("
+                        "content, media_name, conversation, content='message_fts_source', content_rowid='id', "
+                        "tokenize='unicode61 remove_diacritics 2')"
+                    ))
+                    if not existing:
+                        # One-time backfill of messages written before the index existed
+                        conn.execute(text("INSERT INTO message_fts(message_fts) VALUES ('rebuild')"))
+                else:
+                    return
+            self.available = True
+        except Exception as e:
+            print(f"Could not create message search index : {e}")
+
+    @staticmethod
+    def _create_postgres_index(conn: Connection):
+        try:
+            # btree_gin lets one GIN index hold the key and the document together
+            with conn.begin_nested():
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS btree_gin"))
+        except DBAPIError as e:
+            # Not every server ships the contrib extensions; two indexes do the same, a bit slower
+            print(f"btree_gin unavailable, indexing search columns separately : {e.orig}")
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_message_search_document ON message USING gin (search_document)"
+            ))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_message_search_conversation_key ON message (search_conversation)"
+            ))
+            return
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_message_search_conversation "
+            "ON message USING gin (search_conversation, search_document)"
+        ))
+
+    async def add(self, session: AsyncSession, messages: List[Message]):
+        """Index freshly flushed messages; part of the caller's transaction."""
+        if not self.available or self.dialect != "sqlite":
+            return
+        params = [
+            {
+                "id": message.id,
+                "content": message.content,
+                "media_name": message.media_name,
+                "conversation": conversation_key(message.sender_id, message.receiver_id, message.group_id),
+            }
+            for message in messages
+        ]
+        connection = await session.connection()
+        await connection.execute(
+            text(
+                "INSERT INTO message_fts(rowid, content, media_name, conversation) "
+                "VALUES (:id, :content, :media_name, :conversation)"
+            ),
+            params
+        )
+
+    async def search(
+        self,
+        session: AsyncSession,
+        user_id: int,
+        q: str,
+        offset: int,
+        limit: int,
+        peer_id: Optional[int] = None,
+        group_id: Optional[int] = None
+    ) -> List[Tuple[Message, str]]:
+        """Best matches first, as (message, snippet) with hits wrapped in <mark> and the rest escaped."""
+        words = WORD.findall(q.lower())
+        if not words:
+            return []
+
+        # Only conversations the caller is in: their direct chats and their groups
+        conversations = await self._conversations(session, user_id, peer_id, group_id)
+        if not conversations:
+            return []
+
+        # Every word must match, the last one as a prefix once it is long enough, so results follow typing
+        prefix = len(words[-1]) >= PREFIX_MIN_CHARS
+        if self.dialect == "postgresql":
+            rows = await self._search_postgres(session, words, prefix, conversations, offset, limit)
+        else:
+            rows = await self._search_sqlite(session, words, prefix, conversations, offset, limit)
+        return [(message, _render_snippet(snippet)) for message, snippet in rows]
+
+    @staticmethod
+    async def _conversations(
+        session: AsyncSession,
+        user_id: int,
+        peer_id: Optional[int],
+        group_id: Optional[int]
+    ) -> List[str]:
+        if peer_id is not None and group_id is not None:
+            return []
+        if peer_id is not None:
+            return [conversation_key(user_id, peer_id, None)]
+
+        my_groups = select(GroupMember.group_id).where(GroupMember.User_id == user_id)
+        if group_id is not None:
+            my_groups = my_groups.where(GroupMember.group_id == group_id)
+        keys = [conversation_key(user_id, None, gid) for gid in (await session.exec(my_groups)).all()]
+        if group_id is None:
+            # Every direct chat has a summary row for each side
+            peers = select(ConversationSummary.peer_id).where(ConversationSummary.user_id == user_id)
+            keys += [conversation_key(user_id, peer, None) for peer in (await session.exec(peers)).all()]
+        return keys
+
+    async def _search_sqlite(
+        self,
+        session: AsyncSession,
+        words: List[str],
+        prefix: bool,
+        conversations: List[str],
+        offset: int,
+        limit: int
+    ):
+        terms = " ".join(f'"{word}"' for word in words) + ("*" if prefix else "")
+        match = f"{{conversation}} : ({' OR '.join(conversations)}) AND {{content media_name}} : ({terms})"
+        fts = table("message_fts", column("rowid"))
+        fts_table = literal_column("message_fts")
+        # The key column would also be picked for snippets, so both text columns are asked for
+        content_snippet = func.snippet(fts_table, 0, MARK_START, MARK_END, "…", SNIPPET_TOKENS)
+        name_snippet = func.snippet(fts_table, 1, MARK_START, MARK_END, "…", SNIPPET_TOKENS)
+        statement = (
+            select(Message, content_snippet, name_snippet)
+            .join(fts, fts.c.rowid == Message.id)
+            .where(fts_table.op("MATCH")(match))
+            # Zero weight for the key, or long conversations would rank lower
+            .order_by(func.bm25(fts_table, 1.0, 1.0, 0.0), Message.id.desc())
+            .offset(offset)
+            .limit(limit)
+        )
+        return [
+            (message, content if MARK_START in (content or "") else name)
+            for message, content, name in (await session.exec(statement)).all()
+        ]
+
+    async def _search_postgres(
+        self,
+        session: AsyncSession,
+        words: List[str],
+        prefix: bool,
+        conversations: List[str],
+        offset: int,
+        limit: int
+    ):
+        query = func.to_tsquery(literal_column("'simple'"), " & ".join(words) + (":*" if prefix else ""))
+        document = literal_column("message.search_document")
+        rank = func.ts_rank_cd(document, query).label("rank")
+        page = (
+            select(Message.id, rank)
+            .where(literal_column("message.search_conversation").in_(conversations), document.op("@@")(query))
+            .order_by(rank.desc(), Message.id.desc())
+            .offset(offset)
+            .limit(limit)
+            .subquery()
+        )
+        # Headlines are expensive, so only the rows of this page get one
+        headline = func.ts_headline(
+            literal_column("'simple'"),
+            literal_column(SEARCH_DOCUMENT_TEXT),
+            query,
+            f"StartSel={MARK_START}, StopSel={MARK_END}, MaxWords=24, MinWords=8, MaxFragments=2",
+        )
+        statement = (
+            select(Message, headline)
+            .join(page, page.c.id == Message.id)
+            .order_by(page.c.rank.desc(), Message.id.desc())
+        )
+        return (await session.exec(statement)).all()
+
+def _render_snippet(snippet: Optional[str]) -> str:
+    escaped = html.escape((snippet or "").strip())
+    return escaped.replace(MARK_START, "<mark>").replace(MARK_END, "</mark>")
+
+message_search = MessageSearchIndex()
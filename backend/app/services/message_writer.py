@@ -0,0 +1,114 @@
+import asyncio
+from typing import List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.profiler import QueryProfile, query_profiler
+from app.db.session import async_session_maker
+from app.models.message import Message
+from app.services.conversations import record_direct_messages
+from app.services.message_search import message_search
+
+# A queued message, the future its writer awaits and the profile of the request it came from
+QueuedMessage = Tuple[Message, asyncio.Future, Optional[QueryProfile]]
+
+class MessageWriter:
+    """Persists chat messages, optionally group-committing bursts from every socket into one transaction.
+
+    write() only returns once the message is committed, so nothing is fanned out before it is durable.
+    """
+
+    def __init__(self, batching: bool, max_batch_size: int, max_delay_ms: int):
+        self.batching = batching
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._flusher: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if not self.batching:
+            return
+        self._queue = asyncio.Queue()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flusher is None:
+            return
+        # Let already queued messages commit before shutting down
+        await self._queue.join()
+        self._flusher.cancel()
+        try:
+            await self._flusher
+        except asyncio.CancelledError:
+            pass
+        self._flusher = None
+
+    async def write(self, message: Message) -> Message:
+        if self._flusher is None:
+            await self._commit([message])
+            return message
+
+        future = asyncio.get_running_loop().create_future()
+        # The flusher runs outside this request's context, so its profile travels along
+        await self._queue.put((message, future, query_profiler.current()))
+        return await future
+
+    async def _commit(self, messages: List[Message]):
+        async with async_session_maker() as session:
+            session.add_all(messages)
+            # One multi-row INSERT; ids come back in order for the summary updates
+            await session.flush()
+            await record_direct_messages(session, messages)
+            # Same transaction, so search never sees a message that wasn't stored or misses one that was
+            await message_search.add(session, messages)
+            await session.commit()
+
+    async def _next_batch(self) -> List[QueuedMessage]:
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _commit_individually(self, batch: List[QueuedMessage]):
+        # Keep one bad row from failing everyone else's message
+        for message, future, profile in batch:
+            # The failed flush left rolled-back ids on the originals, retry with fresh rows
+            message = Message(**message.model_dump(exclude={"id"}))
+            try:
+                with query_profiler.charge([profile]):
+                    await self._commit([message])
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(message)
+
+    async def _flush_loop(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                with query_profiler.charge(profile for _, _, profile in batch):
+                    await self._commit([message for message, _, _ in batch])
+            except Exception as e:
+                print(f"Message batch failed, retrying one by one : {e}")
+                await self._commit_individually(batch)
+            else:
+                for message, future, _ in batch:
+                    if not future.done():
+                        future.set_result(message)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+message_writer = MessageWriter(
+    batching=settings.MESSAGE_BATCHING,
+    max_batch_size=settings.MESSAGE_BATCH_MAX_SIZE,
+    max_delay_ms=settings.MESSAGE_BATCH_MAX_DELAY_MS,
+)
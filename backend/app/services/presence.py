@@ -0,0 +1,101 @@
+import asyncio
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.services.friends import friend_graph
+from app.websockets.manager import manager
+
+class PresenceService:
+    """Keeps who is online in the broker and pushes debounced status changes to their friends.
+
+    Each node claims the users it holds for a while and renews the claim from their
+    heartbeats, so a user counts as online while any node has a live claim on them.
+    A transition is only announced once the user has stayed in the new state for
+    debounce_seconds, so a flapping mobile connection produces no broadcasts at all.
+    """
+
+    def __init__(self, debounce_seconds: float, idle_timeout_seconds: float, refreshed_size: int):
+        self.debounce = debounce_seconds
+        # Sockets idle for the timeout are closed, so a live one renews within it
+        self.refresh_interval = idle_timeout_seconds / 3
+        self.claim_seconds = idle_timeout_seconds + self.refresh_interval
+        # Users whose claim was renewed lately; heartbeats in between skip the broker
+        self._refreshed = TTLCache(max_size=refreshed_size, ttl_seconds=self.refresh_interval)
+        # Status last pushed to friends; users absent here were announced offline
+        self._announced_online: Dict[int, bool] = {}
+        self._pending: Dict[int, asyncio.Task] = {}
+
+    async def is_online(self, user_id: int) -> bool:
+        return (await manager.broker.get_presence([user_id]))[user_id][0]
+
+    async def touch(self, user_id: int):
+        if self._refreshed.get(user_id) is None:
+            await self._claim(user_id, True)
+
+    async def connected(self, user_id: int):
+        await self._claim(user_id, True)
+        self._schedule(user_id)
+
+    async def disconnected(self, user_id: int):
+        # Other sockets of the user on this node keep the claim
+        await self._claim(user_id, user_id in manager.active_connections)
+        self._schedule(user_id)
+
+    async def _claim(self, user_id: int, online: bool):
+        try:
+            await manager.broker.set_presence(user_id, self.claim_seconds if online else None)
+        except Exception as e:
+            print(f"Presence update failed : {e}")
+            return
+        if online:
+            self._refreshed.set(user_id, True)
+        else:
+            self._refreshed.invalidate(user_id)
+
+    def _schedule(self, user_id: int):
+        # A pending check reads the state when it fires, so one per user is enough
+        if user_id not in self._pending:
+            self._pending[user_id] = asyncio.create_task(self._announce_later(user_id))
+
+    async def _announce_later(self, user_id: int):
+        try:
+            await asyncio.sleep(self.debounce)
+        finally:
+            self._pending.pop(user_id, None)
+
+        online, last_seen = (await manager.broker.get_presence([user_id]))[user_id]
+        if self._announced_online.get(user_id, False) == online:
+            return
+        if online:
+            self._announced_online[user_id] = True
+        else:
+            self._announced_online.pop(user_id, None)
+
+        friends = await friend_graph.friends_of(user_id)
+        await manager.broadcast(
+            {
+                "type": "PRESENCE",
+                "user_id": user_id,
+                "status": "online" if online else "offline",
+                "last_seen": _isoformat(last_seen) or datetime.utcnow().isoformat(),
+            },
+            friends
+        )
+
+    async def snapshot(self, user_ids: Iterable[int]) -> Dict[int, dict]:
+        states = await manager.broker.get_presence(list(user_ids))
+        return {
+            user_id: {"online": online, "last_seen": _isoformat(last_seen)}
+            for user_id, (online, last_seen) in states.items()
+        }
+
+def _isoformat(timestamp: Optional[float]) -> Optional[str]:
+    return datetime.utcfromtimestamp(timestamp).isoformat() if timestamp else None
+
+presence = PresenceService(
+    debounce_seconds=settings.PRESENCE_DEBOUNCE_SECONDS,
+    idle_timeout_seconds=settings.PRESENCE_IDLE_TIMEOUT_SECONDS,
+    refreshed_size=settings.PRESENCE_LAST_SEEN_CACHE_SIZE,
+)
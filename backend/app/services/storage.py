@@ -0,0 +1,112 @@
+import os
+import shutil
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from app.core.config import settings
+
+class Storage(ABC):
+    """Where uploaded media ends up. Calls block, the media job workers run them in threads.
+
+    Keys are slash-separated paths without extension, e.g. "chat_app_avatars/user_5_avatar".
+    url_for is deterministic, so a URL can be handed out before the upload has finished.
+    """
+
+    @abstractmethod
+    def url_for(self, key: str, ext: str) -> str:
+        ...
+
+    @abstractmethod
+    def save(self, source_path: str, key: str, ext: str, transformation: Optional[list] = None) -> str:
+        """Store the file at source_path under key and return its public URL."""
+
+    @abstractmethod
+    def delete(self, key: str, ext: str):
+        ...
+
+class LocalStorage(Storage):
+    """Files under MEDIA_ROOT, served by the app itself at MEDIA_BASE_URL. Works offline."""
+
+    def __init__(self, root: str, base_url: str):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip("/")
+
+    def _path(self, key: str, ext: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, key + ext))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Storage key escapes the media root: {key}")
+        return path
+
+    def url_for(self, key: str, ext: str) -> str:
+        return f"{self.base_url}/{key}{ext}"
+
+    def save(self, source_path: str, key: str, ext: str, transformation: Optional[list] = None) -> str:
+        # Transformations are a Cloudinary feature, local files are stored as uploaded
+        path = self._path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Copy then rename, so readers never see a half written file
+        partial = path + ".part"
+        shutil.copyfile(source_path, partial)
+        os.replace(partial, path)
+        return self.url_for(key, ext)
+
+    def delete(self, key: str, ext: str):
+        try:
+            os.remove(self._path(key, ext))
+        except FileNotFoundError:
+            pass
+
+# Anything else is stored as a "raw" resource, served as uploaded
+CLOUDINARY_IMAGE_EXTENSIONS = {
+    ".jpg", ".jpeg", ".jfif", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff", ".heic", ".heif", ".avif",
+}
+
+class CloudinaryStorage(Storage):
+    def __init__(self, cloud_name: str, api_key: str, api_secret: str):
+        import cloudinary
+
+        cloudinary.config(cloud_name=cloud_name, api_key=api_key, api_secret=api_secret, secure=True)
+        self.cloud_name = cloud_name
+
+    @staticmethod
+    def _resource_type(ext: str) -> str:
+        return "image" if ext.lower() in CLOUDINARY_IMAGE_EXTENSIONS else "raw"
+
+    def url_for(self, key: str, ext: str) -> str:
+        if self._resource_type(ext) == "raw":
+            # Raw public ids keep their extension
+            return f"https://res.cloudinary.com/{self.cloud_name}/raw/upload/{key}{ext}"
+        # Image delivery URLs work without a version or extension
+        return f"https://res.cloudinary.com/{self.cloud_name}/image/upload/{key}"
+
+    def save(self, source_path: str, key: str, ext: str, transformation: Optional[list] = None) -> str:
+        import cloudinary.uploader
+
+        resource_type = self._resource_type(ext)
+        folder, _, public_id = key.rpartition("/")
+        result = cloudinary.uploader.upload(
+            source_path,
+            folder=folder or None,
+            public_id=public_id + ext if resource_type == "raw" else public_id,
+            resource_type=resource_type,
+            overwrite=True,
+            transformation=transformation if resource_type == "image" else None,
+        )
+        return result.get("secure_url")
+
+    def delete(self, key: str, ext: str):
+        import cloudinary.uploader
+
+        resource_type = self._resource_type(ext)
+        cloudinary.uploader.destroy(key + ext if resource_type == "raw" else key, resource_type=resource_type)
+
+def create_storage() -> Storage:
+    if settings.STORAGE_BACKEND == "local":
+        return LocalStorage(settings.MEDIA_ROOT, settings.MEDIA_BASE_URL)
+    return CloudinaryStorage(
+        settings.CLOUDINARY_CLOUD_NAME,
+        settings.CLOUDINARY_API_KEY,
+        settings.CLOUDINARY_API_SECRET,
+    )
+
+storage = create_storage()
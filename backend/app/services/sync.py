@@ -0,0 +1,70 @@
+from typing import List, Optional, Tuple
+
+from sqlmodel import select
+
+from app.core.config import settings
+from app.db.session import async_session_maker
+from app.models.conversation import ConversationSummary
+from app.models.group import GroupMember
+from app.models.message import Message
+from app.services.history import merge_limited
+
+# SQLite caps a compound SELECT at 500 terms
+BRANCHES_PER_QUERY = 200
+
+async def missed_since(user_id: int, since_id: int) -> Optional[Tuple[List[Message], List[Tuple[int, int]]]]:
+    """Everything a reconnecting client missed after since_id, across all its conversations.
+
+    Returns (messages in id order, [(reader_id, last_read_message_id)]) for the peers'
+    read watermarks that moved, or None when the gap exceeds SYNC_MAX_MESSAGES and the
+    client has to refetch history instead.
+    """
+    limit = settings.SYNC_MAX_MESSAGES + 1
+    async with async_session_maker() as session:
+        # Scans follow this user's own conversations, never the site-wide id range
+        peer_ids = (await session.exec(
+            select(ConversationSummary.peer_id).where(
+                (ConversationSummary.user_id == user_id) &
+                (ConversationSummary.last_message_id > since_id)
+            )
+        )).all()
+        group_ids = (await session.exec(
+            select(GroupMember.group_id).where(GroupMember.User_id == user_id)
+        )).all()
+
+        # Each direction of each active conversation is an ix_message_conversation range
+        branches = [
+            select(Message).where(
+                (Message.sender_id == sender_id) &
+                (Message.receiver_id == receiver_id) &
+                (Message.id > since_id)
+            ).order_by(Message.id.asc()).limit(limit)
+            for peer_id in peer_ids
+            for sender_id, receiver_id in ((user_id, peer_id), (peer_id, user_id))
+        ]
+        if group_ids:
+            # One ix_message_group range per group
+            branches.append(
+                select(Message)
+                .where(Message.group_id.in_(group_ids) & (Message.id > since_id))
+                .order_by(Message.id.asc())
+                .limit(limit)
+            )
+
+        messages: List[Message] = []
+        for start in range(0, len(branches), BRANCHES_PER_QUERY):
+            statement = merge_limited(branches[start:start + BRANCHES_PER_QUERY], True, limit)
+            messages.extend((await session.exec(statement)).all())
+            if len(messages) > settings.SYNC_MAX_MESSAGES:
+                return None
+        messages.sort(key=lambda message: message.id)
+
+        # Watermarks are message ids, so peers that read anything at or after since_id moved
+        read_updates = (await session.exec(
+            select(ConversationSummary.user_id, ConversationSummary.last_read_message_id).where(
+                (ConversationSummary.peer_id == user_id) &
+                (ConversationSummary.last_read_message_id >= since_id)
+            )
+        )).all()
+
+    return messages, list(read_updates)
@@ -0,0 +1,244 @@
+import asyncio
+import os
+import tempfile
+import uuid
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Optional
+
+from fastapi import HTTPException, status
+from sqlalchemy import func, or_
+from sqlmodel import delete, select, update
+
+from app.core.config import settings
+from app.db.session import async_session_maker
+from app.models.media import UploadSession
+from app.services.media_jobs import UPLOAD_CHUNK_BYTES
+
+# A writer that stalls this long without a chunk loses the upload to the next request
+UPLOAD_LEASE_SECONDS = 60
+
+def _busy() -> HTTPException:
+    return HTTPException(status_code=409, detail="Another request is writing to this upload")
+
+def _unleased(now: datetime):
+    return or_(UploadSession.lease_expires_at.is_(None), UploadSession.lease_expires_at <= now)
+
+class ChunkedUploads:
+    """Resumable uploads staged on disk, for files too big to send in one request.
+
+    The client declares the size, then PATCHes byte ranges at the offset the server
+    reports; after a dropped connection it asks for the offset and carries on from there.
+    Chunks are written through in UPLOAD_CHUNK_BYTES pieces, never held whole in memory.
+    Sessions live in the database and files in UPLOAD_TMP_DIR, so consecutive chunks
+    may land on different workers; a lease keeps two requests from writing at once.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float, sessions_per_user: int, sweep_interval: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl_seconds
+        self.sessions_per_user = sessions_per_user
+        self.sweep_interval = sweep_interval
+        self._sweeper: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        # Unfinished uploads outlive the process; the client resumes on whichever worker is up
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+
+    async def create(self, owner_id: int, filename: str, size: int) -> UploadSession:
+        if size <= 0:
+            raise HTTPException(status_code=400, detail="File is empty")
+        if size > self.max_bytes:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"File is larger than {self.max_bytes // (1024 * 1024)} MB",
+            )
+        now = datetime.utcnow()
+        async with async_session_maker() as session:
+            pending = (await session.exec(
+                select(func.count()).select_from(UploadSession).where(
+                    UploadSession.owner_id == owner_id,
+                    UploadSession.expires_at > now
+                )
+            )).one()
+            if pending >= self.sessions_per_user:
+                raise HTTPException(status_code=429, detail="Too many unfinished uploads")
+
+            fd, path = tempfile.mkstemp(prefix="upload-", dir=settings.UPLOAD_TMP_DIR)
+            os.close(fd)
+            upload = UploadSession(
+                id=uuid.uuid4().hex,
+                owner_id=owner_id,
+                filename=filename,
+                size=size,
+                path=path,
+                expires_at=now + timedelta(seconds=self.ttl),
+            )
+            session.add(upload)
+            try:
+                await session.commit()
+            except BaseException:
+                os.remove(path)
+                raise
+        return upload
+
+    async def get(self, upload_id: str, owner_id: int) -> UploadSession:
+        async with async_session_maker() as session:
+            upload = await session.get(UploadSession, upload_id)
+        if not upload or upload.owner_id != owner_id or upload.expires_at <= datetime.utcnow():
+            raise HTTPException(status_code=404, detail="Upload not found")
+        return upload
+
+    async def append(self, upload: UploadSession, offset: int, chunks: AsyncIterator[bytes]):
+        """Write a request body at offset. Whatever arrived before a disconnect is kept."""
+        lease_id = await self._acquire(upload)
+        try:
+            if offset != upload.offset:
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"Upload is at offset {upload.offset}",
+                    headers={"Upload-Offset": str(upload.offset)},
+                )
+            with open(upload.path, "r+b") as staged:
+                # Drops anything past the offset left behind by a failed write
+                staged.seek(upload.offset)
+                staged.truncate()
+                buffer = bytearray()
+                try:
+                    async for piece in chunks:
+                        if upload.offset + len(buffer) + len(piece) > upload.size:
+                            raise HTTPException(
+                                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail="More data than the declared size",
+                            )
+                        buffer += piece
+                        if len(buffer) >= UPLOAD_CHUNK_BYTES:
+                            await self._write(upload, lease_id, staged, buffer)
+                            buffer = bytearray()
+                finally:
+                    if buffer:
+                        await self._write(upload, lease_id, staged, buffer)
+        finally:
+            await self._release(upload, lease_id)
+
+    async def _acquire(self, upload: UploadSession) -> str:
+        lease_id = uuid.uuid4().hex
+        now = datetime.utcnow()
+        async with async_session_maker() as session:
+            result = await session.exec(
+                update(UploadSession)
+                .where(UploadSession.id == upload.id, _unleased(now))
+                .values(lease_id=lease_id, lease_expires_at=now + timedelta(seconds=UPLOAD_LEASE_SECONDS))
+            )
+            await session.commit()
+            if result.rowcount != 1:
+                raise _busy()
+            # Whoever held it before may have moved the offset since the caller read it
+            upload.offset = (await session.get(UploadSession, upload.id)).offset
+        return lease_id
+
+    async def _renew(self, upload: UploadSession, lease_id: str) -> bool:
+        """Save the offset and extend the lease, False if it was lost to another request."""
+        now = datetime.utcnow()
+        async with async_session_maker() as session:
+            result = await session.exec(
+                update(UploadSession)
+                .where(
+                    UploadSession.id == upload.id,
+                    UploadSession.lease_id == lease_id,
+                    UploadSession.lease_expires_at > now
+                )
+                .values(
+                    offset=upload.offset,
+                    expires_at=now + timedelta(seconds=self.ttl),
+                    lease_expires_at=now + timedelta(seconds=UPLOAD_LEASE_SECONDS)
+                )
+            )
+            await session.commit()
+        return result.rowcount == 1
+
+    async def _write(self, upload: UploadSession, lease_id: str, staged, data: bytearray):
+        # Checked before touching the file, so a writer that stalled past its lease never
+        # writes over the request that took the upload from it
+        if not await self._renew(upload, lease_id):
+            raise _busy()
+        await asyncio.to_thread(staged.write, data)
+        upload.offset += len(data)
+
+    async def _release(self, upload: UploadSession, lease_id: str):
+        now = datetime.utcnow()
+        async with async_session_maker() as session:
+            await session.exec(
+                update(UploadSession)
+                .where(UploadSession.id == upload.id, UploadSession.lease_id == lease_id)
+                .values(
+                    offset=upload.offset,
+                    expires_at=now + timedelta(seconds=self.ttl),
+                    lease_id=None,
+                    lease_expires_at=None
+                )
+            )
+            await session.commit()
+
+    async def finish(self, upload: UploadSession) -> str:
+        """Hand over the complete staged file; the caller deletes it from here on."""
+        if not await self._delete(upload):
+            raise HTTPException(status_code=409, detail="Upload already finished")
+        return upload.path
+
+    async def discard(self, upload: UploadSession):
+        if not await self._delete(upload):
+            raise _busy()
+        self._remove_file(upload.path)
+
+    @staticmethod
+    async def _delete(upload: UploadSession, *conditions) -> bool:
+        # Only one request gets the row, and never while someone is writing to the file
+        async with async_session_maker() as session:
+            result = await session.exec(
+                delete(UploadSession).where(UploadSession.id == upload.id, _unleased(datetime.utcnow()), *conditions)
+            )
+            await session.commit()
+        return result.rowcount == 1
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    async def _sweep(self):
+        # Abandoned uploads would otherwise keep their partial files forever
+        now = datetime.utcnow()
+        async with async_session_maker() as session:
+            expired = (await session.exec(
+                select(UploadSession).where(UploadSession.expires_at <= now, _unleased(now))
+            )).all()
+        for upload in expired:
+            # Unless a chunk arrived in the meantime
+            if await self._delete(upload, UploadSession.expires_at <= now):
+                self._remove_file(upload.path)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self._sweep()
+            except Exception as e:
+                print(f"Upload sweep failed : {e}")
+
+chunked_uploads = ChunkedUploads(
+    max_bytes=settings.MESSAGE_MEDIA_MAX_BYTES,
+    ttl_seconds=settings.UPLOAD_SESSION_TTL_SECONDS,
+    sessions_per_user=settings.UPLOAD_SESSIONS_PER_USER,
+    sweep_interval=settings.UPLOAD_SWEEP_INTERVAL_SECONDS,
+)
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlmodel import select, func
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.config import settings
+from app.db.session import async_engine, async_session_maker
+from app.models.user import User
+
+class UsernameIndex:
+    """Sorted in-memory (lower(username), username, id) list for prefix search without pg_trgm.
+
+    Kept current by signup and username changes on this worker, and fully reloaded in
+    the background every USER_SEARCH_REFRESH_SECONDS to pick up other workers' writes.
+    """
+
+    def __init__(self, refresh_seconds: int):
+        self.refresh_seconds = refresh_seconds
+        self._keys: List[Tuple[str, str, int]] = []
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._refresh: Optional[asyncio.Task] = None
+
+    async def _ensure_loaded(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.refresh_seconds:
+            return
+        # One reload at a time, however many searches notice the index is stale
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.create_task(self._reload())
+        if self._loaded_at is None:
+            # Nothing to serve yet; later searches use the stale copy while it reloads
+            await asyncio.shield(self._refresh)
+
+    async def _reload(self):
+        try:
+            async with async_session_maker() as session:
+                rows = (await session.exec(select(User.username, User.id))).all()
+            keys = sorted((username.lower(), username, user_id) for username, user_id in rows)
+        except Exception as e:
+            print(f"Username index reload failed : {e}")
+            if self._loaded_at is None:
+                raise
+            return
+        with self._lock:
+            self._keys = keys
+            self._loaded_at = time.monotonic()
+
+    def add(self, username: str, user_id: int):
+        key = (username.lower(), username, user_id)
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            position = bisect_left(self._keys, key)
+            if position == len(self._keys) or self._keys[position] != key:
+                self._keys.insert(position, key)
+
+    def remove(self, username: str, user_id: int):
+        key = (username.lower(), username, user_id)
+        with self._lock:
+            position = bisect_left(self._keys, key)
+            if position < len(self._keys) and self._keys[position] == key:
+                del self._keys[position]
+
+    async def prefix_search(self, prefix: str, after: Optional[str], exclude_id: int, limit: int) -> List[int]:
+        await self._ensure_loaded()
+        prefix = prefix.lower()
+        if after and after.lower() >= prefix:
+            start_key = (after.lower(), after, float("inf"))
+        else:
+            start_key = (prefix, "", -1)
+        # Everything starting with prefix sorts before prefix + the highest code point
+        end_key = (prefix + "\U0010ffff", "", -1)
+        with self._lock:
+            start = bisect_right(self._keys, start_key)
+            end = bisect_left(self._keys, end_key)
+            ids = []
+            for position in range(start, end):
+                user_id = self._keys[position][2]
+                if user_id == exclude_id:
+                    continue
+                ids.append(user_id)
+                if len(ids) == limit:
+                    break
+        return ids
+
+username_index = UsernameIndex(refresh_seconds=settings.USER_SEARCH_REFRESH_SECONDS)
+
+def _uses_trigram() -> bool:
+    return async_engine.dialect.name == "postgresql"
+
+def ensure_search_indexes(engine: Engine):
+    """Create the Postgres trigram index that serves substring username search."""
+    if engine.dialect.name != "postgresql":
+        return
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            conn.execute(text(
+                'CREATE INDEX IF NOT EXISTS ix_user_username_trgm '
+                'ON "user" USING gin (lower(username) gin_trgm_ops)'
+            ))
+    except Exception as e:
+        print(f"Could not create trigram search index : {e}")
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+async def search_users(
+    session: AsyncSession,
+    q: str,
+    exclude_id: int,
+    limit: int,
+    after: Optional[str] = None
+) -> List[User]:
+    """Username search ordered by username, keyset-paginated with the last username seen."""
+    if _uses_trigram():
+        # Substring match served by the pg_trgm GIN index
+        statement = select(User).where(
+            func.lower(User.username).like(f"%{_escape_like(q.lower())}%", escape="\\"),
+            User.id != exclude_id
+        )
+        if after:
+            statement = statement.where(User.username > after)
+        statement = statement.order_by(User.username).limit(limit)
+        return list((await session.exec(statement)).all())
+
+    ids = await username_index.prefix_search(q, after, exclude_id, limit)
+    if not ids:
+        return []
+    users = (await session.exec(select(User).where(User.id.in_(ids)))).all()
+    by_id = {user.id: user for user in users}
+    return [by_id[user_id] for user_id in ids if user_id in by_id]
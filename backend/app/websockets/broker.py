@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import random
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Called with (user_id, frame) for every event routed to a user held by this node.
+# Frames are pre-encoded JSON text so they are serialized once however many sockets receive them.
+DeliverHandler = Callable[[int, str], Awaitable[None]]
+
+# (online, last seen as a unix timestamp or None) per user
+PresenceState = Tuple[bool, Optional[float]]
+
+class Broker(ABC):
+    """Routes per-user events between nodes. Each node subscribes only to the users it holds."""
+
+    @abstractmethod
+    async def start(self, handler: DeliverHandler):
+        ...
+
+    @abstractmethod
+    async def stop(self):
+        ...
+
+    @abstractmethod
+    async def subscribe(self, user_id: int):
+        ...
+
+    @abstractmethod
+    async def unsubscribe(self, user_id: int):
+        ...
+
+    @abstractmethod
+    async def publish(self, user_id: int, frame: str):
+        ...
+
+    async def publish_many(self, user_ids: Iterable[int], frame: str):
+        for user_id in user_ids:
+            await self.publish(user_id, frame)
+
+    @abstractmethod
+    async def set_presence(self, user_id: int, online_for: Optional[float]):
+        """Record that this node holds user_id for the next online_for seconds (None: no longer)."""
+        ...
+
+    @abstractmethod
+    async def get_presence(self, user_ids: List[int]) -> Dict[int, PresenceState]:
+        """Presence across all nodes: online if any node's claim on the user hasn't lapsed."""
+        ...
+
+class InMemoryBroker(Broker):
+    """Single-process broker, used when no BROKER_URL is configured and in tests."""
+
+    def __init__(self):
+        self._handler: Optional[DeliverHandler] = None
+        self._subscribed: Set[int] = set()
+        # user_id -> (online until, last seen)
+        self._presence = TTLCache(
+            max_size=settings.PRESENCE_LAST_SEEN_CACHE_SIZE,
+            ttl_seconds=settings.PRESENCE_LAST_SEEN_TTL_SECONDS
+        )
+
+    async def start(self, handler: DeliverHandler):
+        self._handler = handler
+
+    async def stop(self):
+        self._handler = None
+        self._subscribed.clear()
+
+    async def subscribe(self, user_id: int):
+        self._subscribed.add(user_id)
+
+    async def unsubscribe(self, user_id: int):
+        self._subscribed.discard(user_id)
+
+    async def publish(self, user_id: int, frame: str):
+        if self._handler and user_id in self._subscribed:
+            await self._handler(user_id, frame)
+
+    async def set_presence(self, user_id: int, online_for: Optional[float]):
+        now = time.time()
+        self._presence.set(user_id, (now + online_for if online_for else 0.0, now))
+
+    async def get_presence(self, user_ids: List[int]) -> Dict[int, PresenceState]:
+        now = time.time()
+        result = {}
+        for user_id in user_ids:
+            online_until, last_seen = self._presence.get(user_id) or (0.0, None)
+            result[user_id] = (online_until > now, last_seen)
+        return result
+
+class RedisBroker(Broker):
+    """Redis pub/sub broker with one channel per user.
+
+    Presence is a hash per user: one field per node holding the user, set to when
+    that claim lapses, plus the last seen time. A node that dies without cleaning up
+    stops counting once its claim lapses; the whole key goes after the last seen TTL.
+    """
+
+    CHANNEL_PREFIX = "chat:user:"
+    PRESENCE_PREFIX = "chat:presence:"
+    LAST_SEEN_FIELD = "seen"
+    # Reconnect delays double from the first to the last while Redis stays down
+    RECONNECT_MIN_SECONDS = 0.5
+    RECONNECT_MAX_SECONDS = 30.0
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+        from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+
+        self._redis = redis.from_url(url)
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        self._connection_errors = (RedisConnectionError, RedisTimeoutError, OSError)
+        # Channels of the users this node holds, resubscribed after a reconnect
+        self._channels: Set[str] = set()
+        self._stale = False
+        self._handler: Optional[DeliverHandler] = None
+        self._reader: Optional[asyncio.Task] = None
+        self._node_id = uuid.uuid4().hex
+
+    def _channel(self, user_id: int) -> str:
+        return f"{self.CHANNEL_PREFIX}{user_id}"
+
+    async def start(self, handler: DeliverHandler):
+        self._handler = handler
+        self._reader = asyncio.create_task(self._read_loop())
+
+    async def stop(self):
+        if self._reader:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+            self._reader = None
+        await self._pubsub.aclose()
+        await self._redis.aclose()
+
+    async def subscribe(self, user_id: int):
+        channel = self._channel(user_id)
+        self._channels.add(channel)
+        try:
+            await self._pubsub.subscribe(channel)
+        except self._connection_errors:
+            # Still recorded, the reader subscribes it once the connection is back
+            logger.warning("Broker unreachable, subscription to %s deferred", channel)
+            self._stale = True
+
+    async def unsubscribe(self, user_id: int):
+        channel = self._channel(user_id)
+        self._channels.discard(channel)
+        try:
+            await self._pubsub.unsubscribe(channel)
+        except self._connection_errors:
+            self._stale = True
+
+    async def publish(self, user_id: int, frame: str):
+        await self._redis.publish(self._channel(user_id), frame)
+
+    async def publish_many(self, user_ids: Iterable[int], frame: str):
+        # One round-trip for the whole fan-out
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.publish(self._channel(user_id), frame)
+            await pipe.execute()
+
+    async def set_presence(self, user_id: int, online_for: Optional[float]):
+        key = f"{self.PRESENCE_PREFIX}{user_id}"
+        now = time.time()
+        async with self._redis.pipeline(transaction=False) as pipe:
+            if online_for:
+                pipe.hset(key, mapping={self._node_id: now + online_for, self.LAST_SEEN_FIELD: now})
+            else:
+                pipe.hdel(key, self._node_id)
+                pipe.hset(key, self.LAST_SEEN_FIELD, now)
+            pipe.expire(key, settings.PRESENCE_LAST_SEEN_TTL_SECONDS)
+            await pipe.execute()
+
+    async def get_presence(self, user_ids: List[int]) -> Dict[int, PresenceState]:
+        if not user_ids:
+            return {}
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.hgetall(f"{self.PRESENCE_PREFIX}{user_id}")
+            states = await pipe.execute()
+        now = time.time()
+        result = {}
+        for user_id, fields in zip(user_ids, states):
+            fields = {
+                (name.decode() if isinstance(name, bytes) else name): float(value)
+                for name, value in fields.items()
+            }
+            last_seen = fields.pop(self.LAST_SEEN_FIELD, None)
+            result[user_id] = (any(until > now for until in fields.values()), last_seen)
+        return result
+
+    async def _reconnect(self):
+        # A fresh PubSub on a new connection, subscribed to exactly the channels held now
+        stale, self._pubsub = self._pubsub, self._redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            await stale.aclose()
+        except Exception:
+            pass
+        if self._channels:
+            await self._pubsub.subscribe(*self._channels)
+        self._stale = False
+        logger.info("Broker reconnected, %d channels resubscribed", len(self._channels))
+
+    async def _read_loop(self):
+        delay = self.RECONNECT_MIN_SECONDS
+        while True:
+            try:
+                if self._stale:
+                    await self._reconnect()
+                # get_message refuses to run before the first subscribe
+                if not self._pubsub.subscribed:
+                    await asyncio.sleep(0.1)
+                    continue
+                event = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except self._connection_errors:
+                logger.exception("Broker connection lost, reconnecting in %.1fs", delay)
+                self._stale = True
+                # Jittered, so nodes that lost Redis together don't all come back at once
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, self.RECONNECT_MAX_SECONDS)
+                continue
+            delay = self.RECONNECT_MIN_SECONDS
+            if event is None:
+                continue
+
+            try:
+                channel = event["channel"]
+                if isinstance(channel, bytes):
+                    channel = channel.decode()
+                user_id = int(channel[len(self.CHANNEL_PREFIX):])
+                frame = event["data"]
+                if isinstance(frame, bytes):
+                    frame = frame.decode()
+                await self._handler(user_id, frame)
+            except Exception:
+                # One bad event or socket must not stop delivery to everyone else
+                logger.exception("Failed to deliver broker event %r", event.get("channel"))
+
+def create_broker() -> Broker:
+    if settings.BROKER_URL:
+        return RedisBroker(settings.BROKER_URL)
+    return InMemoryBroker()
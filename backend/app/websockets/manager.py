@@ -1,28 +1,211 @@
-from typing import Dict
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Union
 from fastapi import WebSocket
 
+from app.core.config import settings
+from app.core.metrics import (
+    FANOUT_RECIPIENTS, FANOUT_SECONDS, WS_CONNECTIONS, WS_EVICTIONS, WS_FRAMES_SENT,
+    WS_MAX_QUEUE_DEPTH, WS_ONLINE_USERS, WS_QUEUED_FRAMES,
+)
+from app.websockets.broker import Broker, create_broker
+from app.websockets.protocol import MSGPACK_SUBPROTOCOL, pack_batch, pack_event
+
+# Close code sent to consumers that cannot keep up with their queue
+SLOW_CONSUMER_CLOSE_CODE = 4008
+# Broker frames whose msgpack encoding is kept; a fan-out delivers the same frame to many users in a row
+PACKED_FRAME_MEMO_SIZE = 64
+
+def encode_frame(message: dict) -> str:
+    # Same encoding as WebSocket.send_json
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+class Outbox:
+    """Bounded send queue and writer task for one socket, so a stalled client only delays itself.
+
+    Binary (MessagePack) sockets queue packed events and send whatever has piled up
+    as one multi-event frame; JSON sockets get one text frame per event.
+    """
+
+    def __init__(
+        self,
+        user_id: int,
+        websocket: WebSocket,
+        on_evict: Callable[["Outbox"], Awaitable[None]],
+        binary: bool = False
+    ):
+        self.user_id = user_id
+        self.websocket = websocket
+        self.binary = binary
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.WS_SEND_QUEUE_SIZE)
+        self._on_evict = on_evict
+        self._writer = asyncio.create_task(self._write_loop())
+        self._eviction = None
+        self.closed = False
+
+    def encode(self, message: dict) -> Union[str, bytes]:
+        return pack_event(message) if self.binary else encode_frame(message)
+
+    def enqueue(self, frame: Union[str, bytes]) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            self.evict("send queue full")
+            return False
+        return True
+
+    async def _write_loop(self):
+        while True:
+            frame = await self.queue.get()
+            if self.binary:
+                frames = [frame]
+                while len(frames) < settings.WS_FRAME_BATCH_MAX and not self.queue.empty():
+                    frames.append(self.queue.get_nowait())
+                send = self.websocket.send_bytes(frame if len(frames) == 1 else pack_batch(frames))
+            else:
+                send = self.websocket.send_text(frame)
+            try:
+                await asyncio.wait_for(send, timeout=settings.WS_SEND_TIMEOUT)
+                WS_FRAMES_SENT.inc()
+            except asyncio.TimeoutError:
+                self.evict("send timed out")
+                return
+            except Exception:
+                # Socket already gone, the receive loop cleans up
+                return
+
+    def evict(self, reason: str):
+        if self.closed:
+            return
+        self.closed = True
+        self._eviction = asyncio.create_task(self._evict(reason))
+
+    async def _evict(self, reason: str):
+        print(f"Evicting slow consumer for user {self.user_id}: {reason}")
+        await self._on_evict(self)
+        try:
+            await self.websocket.close(code=SLOW_CONSUMER_CLOSE_CODE)
+        except Exception:
+            pass
+
+    def close(self):
+        self.closed = True
+        self._writer.cancel()
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[int, WebSocket] = {}
+    def __init__(self, broker: Broker):
+        self.active_connections: Dict[int, List[Outbox]] = {}
+        self.broker = broker
+        self.evictions = 0
+        self._packed: "OrderedDict[str, bytes]" = OrderedDict()
 
-    async def connect(self, user_id: int, websocket: WebSocket):
-        await websocket.accept()
+    def _pack(self, frame: str) -> bytes:
+        # Pack each published frame once, however many users and binary sockets receive it
+        packed = self._packed.get(frame)
+        if packed is None:
+            packed = pack_event(json.loads(frame))
+            self._packed[frame] = packed
+            if len(self._packed) > PACKED_FRAME_MEMO_SIZE:
+                self._packed.popitem(last=False)
+        else:
+            self._packed.move_to_end(frame)
+        return packed
+
+    async def start(self):
+        await self.broker.start(self._deliver_local)
+
+    async def stop(self):
+        await self.broker.stop()
+
+    async def connect(self, user_id: int, websocket: WebSocket, subprotocol: Optional[str] = None):
+        await websocket.accept(subprotocol=subprotocol)
         if user_id not in self.active_connections:
             self.active_connections[user_id] = []
-        self.active_connections[user_id].append(websocket)
+            # First socket for this user on this node, start receiving their events
+            await self.broker.subscribe(user_id)
+        binary = subprotocol == MSGPACK_SUBPROTOCOL
+        self.active_connections[user_id].append(Outbox(user_id, websocket, self._evict, binary))
         print(f"User {user_id} connected. Online users: {len(self.active_connections)}")
 
-    def disconnect(self, user_id: int, websocket: WebSocket):
+    async def disconnect(self, user_id: int, websocket: WebSocket):
         if user_id in self.active_connections:
-            if websocket in self.active_connections[user_id]:
-                self.active_connections[user_id].remove(websocket)
-            if not self.active_connections[user_id]:
-                del self.active_connections[user_id]
+            for outbox in self.active_connections[user_id]:
+                if outbox.websocket is websocket:
+                    await self._remove(outbox)
+                    break
         print(f"User {user_id} disconnected.")
-    
+
+    async def _remove(self, outbox: Outbox):
+        outbox.close()
+        outboxes = self.active_connections.get(outbox.user_id)
+        # Already removed; the list may by now belong to a reconnect still subscribing
+        if outboxes is None or outbox not in outboxes:
+            return
+        outboxes.remove(outbox)
+        if not outboxes:
+            del self.active_connections[outbox.user_id]
+            await self.broker.unsubscribe(outbox.user_id)
+            if outbox.user_id in self.active_connections:
+                # Reconnected while we were unsubscribing, and its subscribe may have landed first
+                await self.broker.subscribe(outbox.user_id)
+
+    async def _evict(self, outbox: Outbox):
+        self.evictions += 1
+        WS_EVICTIONS.inc()
+        await self._remove(outbox)
+
+    def send_to_socket(self, user_id: int, websocket: WebSocket, message: dict):
+        """Reply on one specific socket, through its outbox so writes stay ordered."""
+        for outbox in self.active_connections.get(user_id, ()):
+            if outbox.websocket is websocket:
+                outbox.enqueue(outbox.encode(message))
+                return
+
     async def send_personal_message(self, message: dict, receiver_id: int):
-        if receiver_id in self.active_connections:
-            for connection in self.active_connections[receiver_id]:
-                await connection.send_json(message)
+        await self.broadcast(message, [receiver_id])
+
+    async def broadcast(self, message: dict, user_ids: Iterable[int]):
+        # Encode once; every target socket shares the same immutable frame
+        started = time.perf_counter()
+        frame = encode_frame(message)
+        recipients = set(user_ids)
+        # The receivers may be connected to any node, so always route through the broker
+        await self.broker.publish_many(recipients, frame)
+        FANOUT_RECIPIENTS.inc(len(recipients))
+        FANOUT_SECONDS.observe(time.perf_counter() - started)
+
+    async def _deliver_local(self, receiver_id: int, frame: str):
+        # Enqueue only; each socket's writer task sends independently
+        for outbox in list(self.active_connections.get(receiver_id, ())):
+            if outbox.binary:
+                # Broker frames are JSON, binary sockets get the shared msgpack encoding
+                outbox.enqueue(self._pack(frame))
+            else:
+                outbox.enqueue(frame)
+
+    def stats(self) -> dict:
+        depths = [
+            outbox.queue.qsize()
+            for outboxes in self.active_connections.values()
+            for outbox in outboxes
+        ]
+        return {
+            "online_users": len(self.active_connections),
+            "connections": len(depths),
+            "queued_messages": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "queue_limit": settings.WS_SEND_QUEUE_SIZE,
+            "evictions": self.evictions,
+        }
+
+manager = ConnectionManager(create_broker())
 
-manager = ConnectionManager()
+# Read at scrape time, so they cost nothing on the hot path
+WS_ONLINE_USERS.set_function(lambda: len(manager.active_connections))
+WS_CONNECTIONS.set_function(lambda: manager.stats()["connections"])
+WS_QUEUED_FRAMES.set_function(lambda: manager.stats()["queued_messages"])
+WS_MAX_QUEUE_DEPTH.set_function(lambda: manager.stats()["max_queue_depth"])
@@ -0,0 +1,43 @@
+import json
+from typing import List, Optional, Union
+
+import msgpack
+from fastapi import WebSocket, WebSocketDisconnect
+
+# Negotiated through Sec-WebSocket-Protocol; clients that offer nothing get JSON text frames
+JSON_SUBPROTOCOL = "chat.json"
+MSGPACK_SUBPROTOCOL = "chat.msgpack"
+
+def negotiate_subprotocol(websocket: WebSocket) -> Optional[str]:
+    offered = websocket.scope.get("subprotocols") or []
+    if MSGPACK_SUBPROTOCOL in offered:
+        return MSGPACK_SUBPROTOCOL
+    if JSON_SUBPROTOCOL in offered:
+        return JSON_SUBPROTOCOL
+    return None
+
+def pack_event(message: dict) -> bytes:
+    return msgpack.packb(message, use_bin_type=True)
+
+def pack_batch(packed_events: List[bytes]) -> bytes:
+    # An array header followed by the already packed events is itself a valid msgpack array,
+    # so batching never re-encodes an event
+    return msgpack.Packer().pack_array_header(len(packed_events)) + b"".join(packed_events)
+
+def _as_events(decoded: Union[dict, list], max_events: int) -> List[dict]:
+    events = decoded if isinstance(decoded, list) else [decoded]
+    return [event for event in events[:max_events] if isinstance(event, dict)]
+
+async def receive_events(websocket: WebSocket, max_events: int) -> List[dict]:
+    """Next inbound frame as a list of events.
+
+    Binary frames are MessagePack, holding one event or an array of them. Text frames
+    are JSON with a single event, as before, whichever subprotocol was negotiated.
+    """
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+
+    if message.get("bytes") is not None:
+        return _as_events(msgpack.unpackb(message["bytes"], raw=False), max_events)
+    return _as_events(json.loads(message["text"]), 1)
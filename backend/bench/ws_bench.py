@@ -0,0 +1,411 @@
+"""WebSocket load generator and latency benchmark for the chat backend.
+
+Signs up synthetic users, opens sockets to /chat/ws/{token}, drives direct and/or
+group traffic and reports throughput, end-to-end delivery latency percentiles and
+event-loop lag as JSON.
+
+    cd backend
+    python bench/ws_bench.py --users 50 --connections 100 --rate 2 --duration 30
+    python bench/ws_bench.py --pattern group --group-size 20 --binary --output run.json
+    python bench/ws_bench.py --baseline last-release.json --tolerance 0.15
+
+Without --url it starts its own uvicorn server on a throwaway SQLite database (or
+--database-url), with rate limits lifted and cheap bcrypt so setup stays fast.
+With --baseline the run exits with status 1 if it regressed past the tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from typing import Dict, List, Optional
+
+import msgpack
+import websockets
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONTENT_PREFIX = "bench:"
+HEARTBEAT_SECONDS = 25
+LOOP_LAG_INTERVAL = 0.05
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Existing server, e.g. http://localhost:8000. Started locally if omitted")
+    parser.add_argument("--database-url", help="Database for the local server (default: temporary SQLite file)")
+    parser.add_argument("--batching", action="store_true", help="Start the local server with MESSAGE_BATCHING on")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--connections", type=int, default=40, help="Sockets, spread round-robin over the users")
+    parser.add_argument("--pattern", choices=["dm", "group", "mixed"], default="dm")
+    parser.add_argument("--group-size", type=int, default=10)
+    parser.add_argument("--group-ratio", type=float, default=0.3, help="Share of group messages with --pattern mixed")
+    parser.add_argument("--rate", type=float, default=1.0, help="Messages per second per connection (0 = idle sockets)")
+    parser.add_argument("--duration", type=float, default=20.0, help="Measured seconds, after the warmup")
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--drain", type=float, default=3.0, help="Seconds to wait for in-flight deliveries")
+    parser.add_argument("--binary", action="store_true", help="Use the chat.msgpack subprotocol")
+    parser.add_argument("--output", help="Write the JSON report here as well as to stdout")
+    parser.add_argument("--baseline", help="Earlier report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative regression against --baseline")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+# ---------------------------------------------------------------- server setup
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(args: argparse.Namespace):
+    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+    env = dict(os.environ)
+    env.setdefault("SECRET_KEY", "bench")
+    env.setdefault("ALGORITHM", "HS256")
+    env.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "120")
+    for name in ("CLOUDINARY_CLOUD_NAME", "CLOUDINARY_API_KEY", "CLOUDINARY_API_SECRET"):
+        env.setdefault(name, "bench")
+    env["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    env.pop("ASYNC_DATABASE_URL", None)
+    # Measure the messaging path, not bcrypt or the abuse limits
+    env["BCRYPT_ROUNDS"] = "4"
+    env["RATE_LIMIT_PER_SECOND"] = env["WS_CONNECTION_RATE_PER_SECOND"] = "1000000"
+    env["RATE_LIMIT_BURST"] = env["WS_CONNECTION_BURST"] = "1000000"
+    if args.batching:
+        env["MESSAGE_BATCHING"] = "true"
+
+    port = _free_port()
+    log_path = os.path.join(workdir, "server.log")
+    log = open(log_path, "w")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            urllib.request.urlopen(url + "/", timeout=1).close()
+            return process, url
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise SystemExit(f"Server did not start, see {log_path}")
+
+def _http(method: str, url: str, token: Optional[str] = None, form: Optional[dict] = None, body: Optional[dict] = None):
+    headers = {}
+    data = None
+    if form is not None:
+        data = urllib.parse.urlencode(form).encode()
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+    if body is not None:
+        data = json.dumps(body).encode()
+        headers["Content-Type"] = "application/json"
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    request = urllib.request.Request(url, data=data, method=method, headers=headers)
+    for _ in range(20):
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return json.loads(response.read() or b"null")
+        except urllib.error.HTTPError as e:
+            # Password hashing admission control or rate limiting, back off and retry
+            if e.code not in (429, 503):
+                raise
+            time.sleep(float(e.headers.get("Retry-After", 1)))
+    raise RuntimeError(f"{method} {url} kept being rejected")
+
+async def create_users(base_url: str, count: int, concurrency: int = 8) -> List[dict]:
+    run_id = uuid.uuid4().hex[:8]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def create(index: int) -> dict:
+        name = f"bench_{run_id}_{index}"
+        async with semaphore:
+            token = (await asyncio.to_thread(
+                _http, "POST", base_url + "/auth/signup",
+                form={"username": name, "email": f"{name}@bench.local", "password": "bench", "full_name": name},
+            ))["access_token"]
+            me = await asyncio.to_thread(_http, "GET", base_url + "/users/me", token)
+        return {"id": me["id"], "token": token}
+
+    return await asyncio.gather(*(create(index) for index in range(count)))
+
+async def create_groups(base_url: str, users: List[dict], group_size: int) -> Dict[int, int]:
+    """Partition users into groups of group_size. Returns user id -> group id."""
+    membership = {}
+    for start in range(0, len(users), group_size):
+        members = users[start:start + group_size]
+        group = await asyncio.to_thread(
+            _http, "POST", base_url + "/groups/create", members[0]["token"],
+            body={"name": f"bench-{start}", "member_ids": [user["id"] for user in members]},
+        )
+        for user in members:
+            membership[user["id"]] = group["id"]
+    return membership
+
+# ---------------------------------------------------------------- load generation
+
+class Stats:
+    def __init__(self):
+        self.measure_from = float("inf")
+        self.sent = 0
+        self.acked = 0
+        self.expected_deliveries = 0
+        self.deliveries = 0
+        self.throttled = 0
+        self.errors = 0
+        self.delivery_latency: List[float] = []
+        self.ack_latency: List[float] = []
+        self.loop_lag: List[float] = []
+
+class Client:
+    def __init__(self, index: int, user: dict, ws_url: str, binary: bool, stats: Stats):
+        self.index = index
+        self.user = user
+        self.ws_url = ws_url
+        self.binary = binary
+        self.stats = stats
+        self.websocket = None
+        self.pending_acks: Dict[str, float] = {}
+        self._seq = 0
+
+    async def connect(self):
+        self.websocket = await websockets.connect(
+            f"{self.ws_url}/chat/ws/{self.user['token']}",
+            subprotocols=["chat.msgpack"] if self.binary else None,
+            ping_interval=None,
+            max_queue=None,
+        )
+
+    async def send(self, event: dict):
+        if self.binary:
+            await self.websocket.send(msgpack.packb(event, use_bin_type=True))
+        else:
+            await self.websocket.send(json.dumps(event))
+
+    async def send_message(self, target: dict, expected: int):
+        now = time.perf_counter()
+        self._seq += 1
+        client_msg_id = f"{self.index}-{self._seq}"
+        event = dict(target, content=f"{CONTENT_PREFIX}{now:.6f}", client_msg_id=client_msg_id)
+        if now >= self.stats.measure_from:
+            self.stats.sent += 1
+            self.stats.expected_deliveries += expected
+            self.pending_acks[client_msg_id] = now
+        await self.send(event)
+
+    async def receive_loop(self):
+        async for frame in self.websocket:
+            received_at = time.perf_counter()
+            if isinstance(frame, bytes):
+                decoded = msgpack.unpackb(frame, raw=False)
+                events = decoded if isinstance(decoded, list) else [decoded]
+            else:
+                events = [json.loads(frame)]
+            for event in events:
+                self._record(event, received_at)
+
+    def _record(self, event: dict, received_at: float):
+        kind = event.get("type")
+        if kind == "ACK":
+            sent_at = self.pending_acks.pop(event.get("client_msg_id"), None)
+            if sent_at is not None:
+                self.stats.acked += 1
+                self.stats.ack_latency.append((received_at - sent_at) * 1000)
+        elif kind == "THROTTLED":
+            self.stats.throttled += 1
+        elif kind is None and str(event.get("content", "")).startswith(CONTENT_PREFIX):
+            # Only count deliveries to the other side, not the sender's own echo
+            if event.get("sender_id") == self.user["id"]:
+                return
+            sent_at = float(event["content"][len(CONTENT_PREFIX):])
+            if sent_at >= self.stats.measure_from:
+                self.stats.deliveries += 1
+                self.stats.delivery_latency.append((received_at - sent_at) * 1000)
+
+    async def heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+            await self.send({"type": "ping"})
+
+async def measure_loop_lag(stats: Stats, stop: asyncio.Event):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = time.perf_counter() - started - LOOP_LAG_INTERVAL
+        if started >= stats.measure_from:
+            stats.loop_lag.append(max(lag, 0) * 1000)
+
+async def send_loop(client: Client, args: argparse.Namespace, pick_target, stop: asyncio.Event):
+    interval = 1 / args.rate
+    # Spread connections over the first interval so they don't all fire together
+    next_at = time.perf_counter() + random.random() * interval
+    while not stop.is_set():
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        target, expected = pick_target(client)
+        await client.send_message(target, expected)
+        # Fixed schedule; if we fell behind, skip ahead instead of bursting
+        next_at = max(next_at + interval, time.perf_counter())
+
+def _summary(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def percentile(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))], 3)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 3),
+        "p50": percentile(50),
+        "p95": percentile(95),
+        "p99": percentile(99),
+        "max": round(ordered[-1], 3),
+    }
+
+async def run(args: argparse.Namespace, base_url: str) -> dict:
+    random.seed(args.seed)
+    ws_url = base_url.replace("http://", "ws://", 1).replace("https://", "wss://", 1)
+    users = await create_users(base_url, args.users)
+    groups = await create_groups(base_url, users, args.group_size) if args.pattern != "dm" else {}
+
+    stats = Stats()
+    clients = [Client(index, users[index % len(users)], ws_url, args.binary, stats) for index in range(args.connections)]
+    connect_limit = asyncio.Semaphore(50)
+
+    async def connect(client: Client):
+        async with connect_limit:
+            await client.connect()
+
+    await asyncio.gather(*(connect(client) for client in clients))
+
+    sockets_per_user: Dict[int, int] = {}
+    for client in clients:
+        sockets_per_user[client.user["id"]] = sockets_per_user.get(client.user["id"], 0) + 1
+    connected_ids = list(sockets_per_user)
+    group_sockets: Dict[int, int] = {}
+    for user_id, group_id in groups.items():
+        group_sockets[group_id] = group_sockets.get(group_id, 0) + sockets_per_user.get(user_id, 0)
+
+    def pick_target(client: Client):
+        sender_id = client.user["id"]
+        use_group = args.pattern == "group" or (args.pattern == "mixed" and random.random() < args.group_ratio)
+        if use_group and sender_id in groups:
+            group_id = groups[sender_id]
+            return {"group_id": group_id}, group_sockets[group_id] - sockets_per_user[sender_id]
+        receiver_id = random.choice(connected_ids)
+        while receiver_id == sender_id and len(connected_ids) > 1:
+            receiver_id = random.choice(connected_ids)
+        expected = sockets_per_user[receiver_id] if receiver_id != sender_id else 0
+        return {"receiver_id": receiver_id}, expected
+
+    stop = asyncio.Event()
+    tasks = [asyncio.create_task(measure_loop_lag(stats, stop))]
+    for client in clients:
+        tasks.append(asyncio.create_task(client.receive_loop()))
+        tasks.append(asyncio.create_task(client.heartbeat_loop()))
+        if args.rate > 0:
+            tasks.append(asyncio.create_task(send_loop(client, args, pick_target, stop)))
+
+    stats.measure_from = time.perf_counter() + args.warmup
+    await asyncio.sleep(args.warmup + args.duration)
+    stop.set()
+    await asyncio.sleep(args.drain)
+
+    server_stats = None
+    try:
+        server_stats = await asyncio.to_thread(_http, "GET", base_url + "/chat/ws/stats", users[0]["token"])
+    except Exception as e:
+        print(f"Could not read server socket stats : {e}", file=sys.stderr)
+
+    for task in tasks:
+        task.cancel()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    stats.errors = sum(
+        1 for result in results
+        if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError)
+    )
+    await asyncio.gather(*(client.websocket.close() for client in clients), return_exceptions=True)
+
+    return {
+        "config": {
+            key: value for key, value in vars(args).items()
+            if key not in ("output", "baseline", "tolerance")
+        },
+        "duration_s": args.duration,
+        "messages_sent": stats.sent,
+        "messages_acked": stats.acked,
+        "deliveries": stats.deliveries,
+        "expected_deliveries": stats.expected_deliveries,
+        "delivery_ratio": round(stats.deliveries / stats.expected_deliveries, 4) if stats.expected_deliveries else None,
+        "throttled": stats.throttled,
+        "errors": stats.errors,
+        "send_rate_per_s": round(stats.sent / args.duration, 2),
+        "delivery_rate_per_s": round(stats.deliveries / args.duration, 2),
+        "delivery_latency_ms": _summary(stats.delivery_latency),
+        "ack_latency_ms": _summary(stats.ack_latency),
+        "client_loop_lag_ms": _summary(stats.loop_lag),
+        "server": server_stats,
+    }
+
+# ---------------------------------------------------------------- reporting
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    regressions = []
+    for metric in ("delivery_latency_ms", "ack_latency_ms"):
+        for percentile in ("p50", "p95", "p99"):
+            before = baseline.get(metric, {}).get(percentile)
+            after = report.get(metric, {}).get(percentile)
+            if before and after and after > before * (1 + tolerance):
+                regressions.append(f"{metric}.{percentile}: {before} -> {after}")
+    for metric in ("send_rate_per_s", "delivery_rate_per_s", "delivery_ratio"):
+        before, after = baseline.get(metric), report.get(metric)
+        if before and after is not None and after < before * (1 - tolerance):
+            regressions.append(f"{metric}: {before} -> {after}")
+    return regressions
+
+def main():
+    args = parse_args()
+    process = None
+    base_url = args.url
+    if base_url is None:
+        process, base_url = start_server(args)
+    try:
+        report = asyncio.run(run(args, base_url.rstrip("/")))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        report["regressions"] = regressions
+        if regressions:
+            print("Regressed against baseline:\n  " + "\n  ".join(regressions), file=sys.stderr)
+            status = 1
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import os
+import tempfile
+import uuid
+
+import pytest
+
+# Settings are read and engines created on import, so the environment comes first
+TEST_DIR = tempfile.mkdtemp(prefix="chat-tests-")
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{TEST_DIR}/test.db",
+    "SECRET_KEY": "test-secret",
+    "ALGORITHM": "HS256",
+    "ACCESS_TOKEN_EXPIRE_MINUTES": "60",
+    "BCRYPT_ROUNDS": "4",
+    "STORAGE_BACKEND": "local",
+    "MEDIA_ROOT": os.path.join(TEST_DIR, "media"),
+    "UPLOAD_TMP_DIR": TEST_DIR,
+    "BROKER_URL": "",
+})
+
+from fastapi.testclient import TestClient
+
+from app.main import app
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(app) as test_client:
+        yield test_client
+
+@pytest.fixture
+def signup(client):
+    """Creates a user with a fresh name; returns (token, user_id, auth headers)."""
+    def create():
+        name = f"user_{uuid.uuid4().hex[:10]}"
+        response = client.post(
+            "/auth/signup",
+            data={"username": name, "email": f"{name}@example.com", "password": "pw", "full_name": name}
+        )
+        assert response.status_code == 200, response.text
+        token = response.json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        user_id = client.get("/users/me", headers=headers).json()["id"]
+        return token, user_id, headers
+    return create
+
+def receive_until(websocket, event_type: str) -> dict:
+    """Next event of event_type, skipping everything else the socket sends."""
+    while True:
+        event = websocket.receive_json()
+        if event.get("type") == event_type:
+            return event
@@ -0,0 +1,59 @@
+from datetime import datetime
+
+from sqlmodel import Session
+
+from app.db.session import engine
+from app.models.message import Message
+
+def _store(sender_id: int, receiver_id: int, content: str) -> int:
+    with Session(engine) as session:
+        message = Message(
+            sender_id=sender_id, receiver_id=receiver_id, content=content, timestamp=datetime.utcnow(), is_read=False
+        )
+        session.add(message)
+        session.commit()
+        return message.id
+
+def test_history_pages_backwards_with_the_cursor(client, signup):
+    _, alice, alice_headers = signup()
+    _, bob, _ = signup()
+    _, carol, _ = signup()
+    ids = []
+    for i in range(5):
+        sender, receiver = (alice, bob) if i % 2 else (bob, alice)
+        ids.append(_store(sender, receiver, f"message {i}"))
+        # Someone else's conversation in between must never show up
+        _store(carol, alice if i % 2 else bob, "noise")
+
+    pages = []
+    params = {"limit": 2}
+    while True:
+        response = client.get(f"/chat/history/{bob}", params=params, headers=alice_headers)
+        assert response.status_code == 200
+        pages.append([message["id"] for message in response.json()])
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+        params = {"limit": 2, "before_id": cursor}
+
+    # Newest page first, each page oldest first, nothing skipped or repeated
+    assert pages == [ids[3:5], ids[1:3], ids[0:1]]
+
+def test_history_pages_forwards_from_after_id(client, signup):
+    _, alice, alice_headers = signup()
+    _, bob, _ = signup()
+    ids = [_store(alice, bob, f"message {i}") for i in range(3)]
+
+    response = client.get(f"/chat/history/{bob}", params={"limit": 1, "after_id": ids[0]}, headers=alice_headers)
+    assert [message["id"] for message in response.json()] == [ids[1]]
+    assert response.headers["X-Next-Cursor"] == str(ids[1])
+
+    response = client.get(f"/chat/history/{bob}", params={"limit": 5, "after_id": ids[1]}, headers=alice_headers)
+    assert [message["id"] for message in response.json()] == [ids[2]]
+    assert "X-Next-Cursor" not in response.headers
+
+def test_history_rejects_both_cursors(client, signup):
+    _, _, headers = signup()
+    _, bob, _ = signup()
+    response = client.get(f"/chat/history/{bob}", params={"before_id": 5, "after_id": 1}, headers=headers)
+    assert response.status_code == 400
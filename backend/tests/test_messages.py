@@ -0,0 +1,43 @@
+from conftest import receive_until
+
+from app.services.delivery import recent_client_ids
+
+def test_resent_client_msg_id_is_acked_as_duplicate(client, signup):
+    alice_token, _, alice_headers = signup()
+    _, bob, _ = signup()
+
+    with client.websocket_connect(f"/chat/ws/{alice_token}") as socket:
+        socket.send_json({"receiver_id": bob, "content": "hello", "client_msg_id": "c-1"})
+        first = receive_until(socket, "ACK")
+        assert first["client_msg_id"] == "c-1" and first["duplicate"] is False
+
+        # Answered from the recent ids cache
+        socket.send_json({"receiver_id": bob, "content": "hello", "client_msg_id": "c-1"})
+        again = receive_until(socket, "ACK")
+        assert again["id"] == first["id"] and again["duplicate"] is True
+
+        # As after a restart or on another worker: only the unique index knows
+        recent_client_ids._senders.clear()
+        socket.send_json({"receiver_id": bob, "content": "hello", "client_msg_id": "c-1"})
+        after_restart = receive_until(socket, "ACK")
+        assert after_restart["id"] == first["id"] and after_restart["duplicate"] is True
+
+        socket.send_json({"receiver_id": bob, "content": "hello", "client_msg_id": "c-2"})
+        assert receive_until(socket, "ACK")["id"] > first["id"]
+
+    history = client.get(f"/chat/history/{bob}", headers=alice_headers).json()
+    assert [message["client_msg_id"] for message in history] == ["c-1", "c-2"]
+
+def test_client_msg_id_is_scoped_to_the_sender(client, signup):
+    alice_token, _, _ = signup()
+    bob_token, bob, _ = signup()
+    _, carol, _ = signup()
+
+    with client.websocket_connect(f"/chat/ws/{alice_token}") as socket:
+        socket.send_json({"receiver_id": carol, "content": "from alice", "client_msg_id": "same"})
+        from_alice = receive_until(socket, "ACK")
+    with client.websocket_connect(f"/chat/ws/{bob_token}") as socket:
+        socket.send_json({"receiver_id": carol, "content": "from bob", "client_msg_id": "same"})
+        from_bob = receive_until(socket, "ACK")
+
+    assert from_bob["duplicate"] is False and from_bob["id"] != from_alice["id"]
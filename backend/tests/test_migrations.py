@@ -0,0 +1,128 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+
+import app.main as main
+from app.db.migrations import ADDED_COLUMNS, ADDED_INDEXES, has_index
+
+# The tables as they shipped before any of the migrated columns or indexes existed
+BASELINE_SCHEMA = [
+    """CREATE TABLE user (
+        id INTEGER NOT NULL PRIMARY KEY,
+        username VARCHAR NOT NULL,
+        email VARCHAR NOT NULL,
+        hashed_password VARCHAR NOT NULL,
+        full_name VARCHAR NOT NULL,
+        bio VARCHAR NOT NULL,
+        gender VARCHAR NOT NULL,
+        profile_picture VARCHAR,
+        created_at DATETIME NOT NULL,
+        allow_stranger_dms BOOLEAN NOT NULL
+    )""",
+    "CREATE UNIQUE INDEX ix_user_username ON user (username)",
+    "CREATE UNIQUE INDEX ix_user_email ON user (email)",
+    """CREATE TABLE friendrequest (
+        id INTEGER NOT NULL PRIMARY KEY,
+        sender_id INTEGER NOT NULL REFERENCES user (id),
+        receiver_id INTEGER NOT NULL REFERENCES user (id),
+        status VARCHAR(8) NOT NULL
+    )""",
+    """CREATE TABLE "group" (
+        id INTEGER NOT NULL PRIMARY KEY,
+        name VARCHAR NOT NULL,
+        description VARCHAR,
+        avatar_url VARCHAR,
+        creator_id INTEGER NOT NULL REFERENCES user (id),
+        created_at DATETIME NOT NULL
+    )""",
+    """CREATE TABLE message (
+        id INTEGER NOT NULL PRIMARY KEY,
+        content VARCHAR NOT NULL,
+        message_type VARCHAR,
+        media_url VARCHAR,
+        timestamp DATETIME NOT NULL,
+        is_read BOOLEAN NOT NULL,
+        sender_id INTEGER NOT NULL REFERENCES user (id),
+        receiver_id INTEGER REFERENCES user (id),
+        group_id INTEGER REFERENCES "group" (id),
+        reply_to_id INTEGER REFERENCES message (id)
+    )""",
+    """CREATE TABLE groupmember (
+        id INTEGER NOT NULL PRIMARY KEY,
+        group_id INTEGER NOT NULL REFERENCES "group" (id),
+        "User_id" INTEGER NOT NULL REFERENCES user (id),
+        joined_at DATETIME NOT NULL,
+        role VARCHAR NOT NULL
+    )""",
+]
+
+@pytest.fixture
+def baseline_engine(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'baseline.db'}")
+    now = datetime.utcnow().isoformat()
+    with engine.begin() as conn:
+        for statement in BASELINE_SCHEMA:
+            conn.execute(text(statement))
+        for user_id, name in enumerate(["alice", "bob", "carol"], 1):
+            conn.execute(
+                text(
+                    "INSERT INTO user (id, username, email, hashed_password, full_name, bio, gender, "
+                    "created_at, allow_stranger_dms) VALUES (:id, :name, :email, 'x', :name, '', 'other', :now, 0)"
+                ),
+                {"id": user_id, "name": name, "email": f"{name}@example.com", "now": now}
+            )
+        # A request in each direction for alice and bob, the accepted one must survive
+        conn.execute(text(
+            "INSERT INTO friendrequest (id, sender_id, receiver_id, status) VALUES "
+            "(1, 1, 2, 'PENDING'), (2, 2, 1, 'ACCEPTED'), (3, 3, 1, 'PENDING')"
+        ))
+        # Alternating between alice and bob; the first four were read
+        for message_id in range(1, 7):
+            sender, receiver = (1, 2) if message_id % 2 else (2, 1)
+            conn.execute(
+                text(
+                    "INSERT INTO message (id, content, message_type, timestamp, is_read, sender_id, receiver_id) "
+                    "VALUES (:id, :content, 'text', :now, :is_read, :sender, :receiver)"
+                ),
+                {
+                    "id": message_id, "content": f"hello {message_id}", "now": now,
+                    "is_read": message_id <= 4, "sender": sender, "receiver": receiver,
+                }
+            )
+    monkeypatch.setattr(main, "engine", engine)
+    yield engine
+    engine.dispose()
+
+def test_startup_upgrades_a_baseline_database(baseline_engine):
+    main.on_startup()
+
+    inspector = inspect(baseline_engine)
+    for table_name, column_name, _ in ADDED_COLUMNS:
+        assert column_name in {column["name"] for column in inspector.get_columns(table_name)}
+    with baseline_engine.connect() as conn:
+        for table_name, index_name in ADDED_INDEXES:
+            assert has_index(conn, table_name, index_name)
+        assert has_index(conn, "friendrequest", "uq_friendrequest_pair")
+
+        requests = conn.execute(text(
+            "SELECT pair_low_id, pair_high_id, status FROM friendrequest ORDER BY pair_high_id"
+        )).all()
+        assert requests == [(1, 2, "ACCEPTED"), (1, 3, "PENDING")]
+
+        # Watermarks derived from the legacy is_read flags
+        watermarks = dict(conn.execute(text(
+            "SELECT user_id, last_read_message_id FROM conversationsummary"
+        )).all())
+        assert watermarks == {1: 4, 2: 3}
+
+        matches = conn.execute(text("SELECT rowid FROM message_fts WHERE message_fts MATCH '\"hello\"'")).all()
+        assert len(matches) == 6
+
+def test_startup_is_idempotent(baseline_engine):
+    main.on_startup()
+    main.on_startup()
+
+    with baseline_engine.connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM friendrequest")).scalar() == 2
+        assert conn.execute(text("SELECT count(*) FROM conversationsummary")).scalar() == 2
@@ -0,0 +1,46 @@
+import uuid
+
+from conftest import receive_until
+
+from app.core.config import settings
+from app.core.rate_limit import SocketThrottle, TokenBucket, user_limiter
+
+def test_token_bucket_allows_a_burst_then_refills_at_rate():
+    bucket = TokenBucket(rate=10.0, burst=3)
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    retry_after = bucket.take()
+    assert 0 < retry_after <= 0.1
+    # A denied take spends nothing
+    assert bucket.wait() <= retry_after
+
+def test_socket_throttle_denies_past_the_burst_without_spending():
+    username = f"throttle_{uuid.uuid4().hex}"
+    throttle = SocketThrottle(username)
+    for _ in range(settings.WS_CONNECTION_BURST):
+        assert throttle.check() == 0.0
+    assert throttle.strikes == 0
+
+    assert throttle.check() > 0
+    assert throttle.check() > 0
+    assert throttle.strikes == 2
+    # Denials didn't draw from the user's shared bucket either
+    assert user_limiter.wait(username, settings.RATE_LIMIT_BURST - settings.WS_CONNECTION_BURST) == 0.0
+
+def test_socket_throttle_is_abusive_after_max_strikes():
+    throttle = SocketThrottle(f"throttle_{uuid.uuid4().hex}")
+    while throttle.check() == 0.0:
+        pass
+    for _ in range(settings.WS_RATE_LIMIT_MAX_STRIKES - 1):
+        throttle.check()
+    assert throttle.abusive
+
+def test_flooding_socket_gets_throttled_but_heartbeats_still_answer(client, signup):
+    token, _, _ = signup()
+    with client.websocket_connect(f"/chat/ws/{token}") as socket:
+        for _ in range(settings.WS_CONNECTION_BURST + 1):
+            socket.send_json({"type": "typing"})
+        notice = receive_until(socket, "THROTTLED")
+        assert notice["retry_after"] > 0
+
+        socket.send_json({"type": "ping"})
+        assert receive_until(socket, "pong") == {"type": "pong"}
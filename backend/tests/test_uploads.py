@@ -0,0 +1,82 @@
+import io
+import os
+
+import pytest
+from conftest import receive_until
+from PIL import Image
+
+from app.services.attachments import sniff
+
+def _png() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (20, 20), "red").save(buffer, "PNG")
+    return buffer.getvalue()
+
+@pytest.mark.parametrize("header, filename, expected", [
+    (_png(), "photo.png", ("image/png", ".png")),
+    (b"\xff\xd8\xff\xe0" + b"\x00" * 16, "photo.jpeg", ("image/jpeg", ".jpg")),
+    (b"RIFF\x00\x00\x00\x00WEBPVP8 ", "x", ("image/webp", ".webp")),
+    (b"GIF89a\x01\x00", "anim.gif", ("image/gif", ".gif")),
+    (b"%PDF-1.7\n", "report.pdf", ("application/pdf", ".pdf")),
+    (b"PK\x03\x04" + b"\x00" * 26, "sheet.xlsx", (
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", ".xlsx"
+    )),
+    (b"PK\x03\x04" + b"\x00" * 26, "payload.html", ("application/zip", ".zip")),
+    (b"\x00\x00\x00\x18ftypqt  ", "clip", ("video/quicktime", ".mov")),
+    # Whatever the name says, markup is served back as plain text
+    (b"<html><script>alert(1)</script></html>", "page.html", ("text/plain", ".txt")),
+    (b"<svg onload=alert(1)>", "image.svg", ("text/plain", ".txt")),
+    (b"\x00\x01\x02\x03\xff", "blob.exe", ("application/octet-stream", ".bin")),
+])
+def test_sniff_decides_by_content_not_name(header, filename, expected):
+    assert sniff(header, filename) == expected
+
+def test_avatar_upload_rejects_anything_but_images(client, signup):
+    _, _, headers = signup()
+    for name, body in [("avatar.png", b"<html><script>alert(1)</script></html>"), ("avatar.gif", b"<svg onload=alert(1)>")]:
+        response = client.post("/users/updateme/avatar", headers=headers, files={"file": (name, body, "image/png")})
+        assert response.status_code == 415
+    response = client.post("/groups/upload-avatar", headers=headers, files={"file": ("g.jpg", b"not an image", "image/jpeg")})
+    assert response.status_code == 415
+
+def test_avatar_extension_comes_from_the_content(client, signup):
+    _, _, headers = signup()
+    response = client.post("/users/updateme/avatar", headers=headers, files={"file": ("avatar.html", _png(), "text/html")})
+    assert response.status_code == 200
+    assert os.path.splitext(response.json()["profile_picture"])[1] in {".png", ".webp", ".jpg"}
+
+def test_attachment_is_sent_at_most_once(client, signup):
+    token, _, headers = signup()
+    _, bob, _ = signup()
+    data = b"meeting notes\n" * 50
+
+    with client.websocket_connect(f"/chat/ws/{token}") as socket:
+        upload = client.post("/uploads/files", headers=headers, json={"filename": "notes.html", "size": len(data)}).json()
+        half = len(data) // 2
+        response = client.patch(
+            f"/uploads/files/{upload['upload_id']}", headers={**headers, "Upload-Offset": "0"}, content=data[:half]
+        )
+        assert response.json()["offset"] == half and "job" not in response.json()
+        # Resumes where the server says it is
+        assert client.get(f"/uploads/files/{upload['upload_id']}", headers=headers).json()["offset"] == half
+        response = client.patch(
+            f"/uploads/files/{upload['upload_id']}", headers={**headers, "Upload-Offset": str(half)}, content=data[half:]
+        )
+        job = response.json()["job"]
+        assert job["meta"]["mime"] == "text/plain"
+
+        ready = receive_until(socket, "UPLOAD_READY")
+        assert ready["job_id"] == job["job_id"]
+        assert client.get(f"/uploads/{job['job_id']}", headers=headers).json()["status"] == "done"
+
+        socket.send_json({"receiver_id": bob, "upload_job_id": job["job_id"], "client_msg_id": "a-1"})
+        sent = receive_until(socket, "ACK")
+        assert sent["duplicate"] is False
+
+        socket.send_json({"receiver_id": bob, "upload_job_id": job["job_id"], "client_msg_id": "a-2"})
+        assert receive_until(socket, "REJECTED")["client_msg_id"] == "a-2"
+
+        # A plain resend of the first message is still acknowledged
+        socket.send_json({"receiver_id": bob, "upload_job_id": job["job_id"], "client_msg_id": "a-1"})
+        resent = receive_until(socket, "ACK")
+        assert resent["id"] == sent["id"] and resent["duplicate"] is True
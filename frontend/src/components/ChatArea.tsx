@@ -1,8 +1,9 @@
-import { useEffect, useState, useRef, useMemo} from "react";
+import { useEffect, useLayoutEffect, useState, useRef, useMemo} from "react";
 import { useAuthStore, type AuthState } from "../store/authStore";
-import { ArrowLeft, Send, Reply, X } from "lucide-react";
+import { ArrowLeft, Send, Reply, X, Paperclip, FileText } from "lucide-react";
 import UserProfileModal from "./UserProfileModal";
 import { getDateLabel } from "../utils/getDateLabel";
+import { uploadFile } from "../utils/uploadFile";
 
 interface Message {
   id: number;
@@ -12,6 +13,22 @@ interface Message {
   timestamp: string;
   is_read: boolean;
   reply_to_id?: number | null;
+  message_type?: "text" | "image" | "file";
+  media_url?: string | null;
+  media_name?: string | null;
+  media_size?: number | null;
+  media_width?: number | null;
+  media_height?: number | null;
+  media_thumbnail?: string | null;
+}
+
+interface Attachment {
+  file: File;
+  sent: number;
+  status: "uploading" | "processing" | "ready" | "failed";
+  jobId?: string;
+  expiresAt?: string | null;
+  error?: string;
 }
 
 interface UserProfile {
@@ -31,6 +48,17 @@ interface UserProfile {
     | "self";
 }
 
+const formatFileSize = (bytes?: number | null) => {
+  if (!bytes) return "";
+  if (bytes < 1024) return `${bytes} B`;
+  if (bytes < 1024 * 1024) return `${(bytes / 1024).toFixed(1)} KB`;
+  return `${(bytes / (1024 * 1024)).toFixed(1)} MB`;
+};
+
+// Attachments may have no caption
+const previewText = (msg: Message) =>
+  msg.content || (msg.message_type === "image" ? "Photo" : msg.media_name || "File");
+
 interface ChatAreaProps {
   currentUser: any;
   selectedFriend: UserProfile;
@@ -50,9 +78,21 @@ export default function ChatArea({
   const [newMessage, setNewMessage] = useState("");
   const [viewingUser, setViewingUser] = useState<UserProfile | null>(null);
   const [replyTo, setReplyTo] = useState<Message | null>(null);
+  const [attachment, setAttachment] = useState<Attachment | null>(null);
 
   const socketRef = useRef<WebSocket | null>(null);
+  const fileInputRef = useRef<HTMLInputElement>(null);
+  // UPLOAD_READY / UPLOAD_FAILED can arrive before the upload request has returned
+  const uploadEventsRef = useRef(new Map<string, string>());
   const messagesEndRef = useRef<HTMLDivElement>(null);
+  const messagesRef = useRef<HTMLDivElement>(null);
+  // Id to pass as before_id for the next older page, null once the start is reached
+  const [olderCursor, setOlderCursor] = useState<string | null>(null);
+  const [loadingOlder, setLoadingOlder] = useState(false);
+  // Scroll height before older messages were prepended, to keep the view in place
+  const prependedFromRef = useRef<number | null>(null);
+  // A freshly loaded conversation jumps to the bottom instead of scrolling past the top
+  const jumpToBottomRef = useRef(false);
   const textAreaRef = useRef<HTMLTextAreaElement>(null);
 
   const messagemap = useMemo(() => {
@@ -76,14 +116,46 @@ export default function ChatArea({
     }
   }
 
-  // Auto scroll
-  useEffect(() => {
-    messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
+  // Auto scroll, except when older messages were added above
+  useLayoutEffect(() => {
+    const container = messagesRef.current;
+    if (prependedFromRef.current !== null && container) {
+      container.scrollTop += container.scrollHeight - prependedFromRef.current;
+      prependedFromRef.current = null;
+      return;
+    }
+    messagesEndRef.current?.scrollIntoView({ behavior: jumpToBottomRef.current ? "auto" : "smooth" });
+    jumpToBottomRef.current = false;
   }, [messages]);
 
+  const loadOlder = async () => {
+    if (!olderCursor || loadingOlder || !selectedFriend) return;
+    setLoadingOlder(true);
+    try {
+      const res = await fetch(
+        `${import.meta.env.VITE_API_URL}/chat/history/${selectedFriend.id}?before_id=${olderCursor}`,
+        { headers: { Authorization: `Bearer ${token}` } }
+      );
+      if (res.ok) {
+        const data: Message[] = await res.json();
+        setOlderCursor(res.headers.get("X-Next-Cursor"));
+        prependedFromRef.current = messagesRef.current?.scrollHeight ?? null;
+        setMessages((prev) => {
+          const seen = new Set(prev.map((msg) => msg.id));
+          return [...data.filter((msg) => !seen.has(msg.id)), ...prev];
+        });
+      }
+    } catch (err) {
+      console.error("History Fetch Failed", err);
+    } finally {
+      setLoadingOlder(false);
+    }
+  };
+
 
   useEffect(() => {
     if (!selectedFriend) return;
+    setOlderCursor(null);
 
     const fetchHistory = async () => {
       try {
@@ -93,6 +165,9 @@ export default function ChatArea({
         );
         if (res.ok) {
           const data = await res.json();
+          // Only the newest page comes first; older ones load on scrolling up
+          setOlderCursor(res.headers.get("X-Next-Cursor"));
+          jumpToBottomRef.current = true;
           setMessages(data);
           console.log(data);
           markAsRead();
@@ -108,6 +183,13 @@ export default function ChatArea({
       `${import.meta.env.VITE_WS_URL}/chat/ws/${token}`
     );
 
+    // Heartbeat so the server doesn't drop the socket as idle
+    const heartbeat = setInterval(() => {
+      if (ws.readyState === WebSocket.OPEN) {
+        ws.send(JSON.stringify({ type: "ping" }));
+      }
+    }, 25000);
+
     ws.onmessage = (event) => {
       const message = JSON.parse(event.data);
 
@@ -122,6 +204,20 @@ export default function ChatArea({
         return;
       }
 
+      if (message.type === "UPLOAD_READY" || message.type === "UPLOAD_FAILED") {
+        const status = message.type === "UPLOAD_READY" ? "ready" : "failed";
+        uploadEventsRef.current.set(message.job_id, status);
+        setAttachment((prev) =>
+          prev && prev.jobId === message.job_id
+            ? { ...prev, status, expiresAt: message.expires_at, error: message.error }
+            : prev
+        );
+        return;
+      }
+
+      // Other events (pong, presence) are not chat messages
+      if (message.type) return;
+
       const isRelevant =
         message.sender_id === selectedFriend.id ||
         (message.sender_id === currentUser.id &&
@@ -140,28 +236,63 @@ export default function ChatArea({
     socketRef.current = ws;
 
     return () => {
+      clearInterval(heartbeat);
       ws.close();
+      setAttachment(null);
     };
   }, [selectedFriend, currentUser.id, token]);
 
+  const attachFile = async (file: File) => {
+    if (!token) return;
+    setAttachment({ file, sent: 0, status: "uploading" });
+    // A newer attachment, or a cancel, replaces this one
+    const isCurrent = (prev: Attachment | null) => prev?.file === file;
+
+    try {
+      const job = await uploadFile(file, token, (sent) =>
+        setAttachment((prev) => (isCurrent(prev) ? { ...prev!, sent } : prev))
+      );
+      const seen = uploadEventsRef.current.get(job.job_id);
+      const status = job.status === "done" ? "ready" : job.status === "failed" ? "failed" : seen || "processing";
+      setAttachment((prev) =>
+        isCurrent(prev)
+          ? { ...prev!, jobId: job.job_id, expiresAt: job.expires_at, status: status as Attachment["status"] }
+          : prev
+      );
+    } catch (err) {
+      const error = err instanceof Error ? err.message : "Upload failed";
+      setAttachment((prev) => (isCurrent(prev) ? { ...prev!, status: "failed", error } : prev));
+    }
+  };
+
   const sendMessage = () => {
+    const ready = attachment?.status === "ready" ? attachment : null;
     if (
-      !newMessage.trim() ||
+      (!newMessage.trim() && !ready) ||
+      (attachment && !ready) ||
       !socketRef.current ||
       socketRef.current.readyState !== WebSocket.OPEN
     )
       return;
 
+    if (ready?.expiresAt && new Date(ready.expiresAt + "Z") <= new Date()) {
+      // The server has forgotten the upload by now
+      setAttachment({ ...ready, status: "failed", error: "Upload expired, please attach the file again" });
+      return;
+    }
+
     socketRef.current.send(
       JSON.stringify({
         receiver_id: selectedFriend.id,
         content: newMessage.trim(),
         reply_to_id: replyTo?.id || null,
+        upload_job_id: ready?.jobId,
       })
     );
 
     setNewMessage("");
     setReplyTo(null);
+    setAttachment(null);
 
     if (textAreaRef.current) {
       textAreaRef.current.style.height = "auto";
@@ -221,7 +352,24 @@ export default function ChatArea({
       </div>
 
       {/* Messages */}
-      <div className="flex-1 overflow-y-auto p-4 space-y-4 min-h-0">
+      <div
+        ref={messagesRef}
+        onScroll={(e) => {
+          if (e.currentTarget.scrollTop < 50) loadOlder();
+        }}
+        className="flex-1 overflow-y-auto p-4 space-y-4 min-h-0"
+      >
+        {olderCursor && (
+          <div className="w-full text-center">
+            <button
+              onClick={loadOlder}
+              disabled={loadingOlder}
+              className="text-xs text-slate-400 hover:text-white bg-slate-800 px-3 py-1 rounded-full disabled:opacity-50"
+            >
+              {loadingOlder ? "Loading..." : "Load older messages"}
+            </button>
+          </div>
+        )}
         {messages.map((msg, index) => {
           const prevmsg = messages[index - 1];
 
@@ -266,14 +414,38 @@ export default function ChatArea({
                         {repliedMessage?.sender_id === currentUser.id ? "You" : selectedFriend.full_name || selectedFriend.username}
                       </p>
                       <p className="truncate text-xs text-slate-200">
-                        {repliedMessage.content.length > 30
-                          ? repliedMessage.content.slice(0, 30) + "..."
-                          : repliedMessage.content}
+                        {previewText(repliedMessage).length > 30
+                          ? previewText(repliedMessage).slice(0, 30) + "..."
+                          : previewText(repliedMessage)}
                       </p>
                     </div>
                   )}
                 <div className="whitespace-pre-wrap break-words">
-                  <p>{msg.content}</p>
+                  {msg.message_type === "image" && msg.media_url && (
+                    <a href={msg.media_url} target="_blank" rel="noreferrer">
+                      <img
+                        src={msg.media_thumbnail || msg.media_url}
+                        alt={msg.media_name || "Photo"}
+                        width={msg.media_width || undefined}
+                        height={msg.media_height || undefined}
+                        loading="lazy"
+                        className="rounded-lg max-h-64 w-auto h-auto mb-1"
+                      />
+                    </a>
+                  )}
+                  {msg.message_type === "file" && msg.media_url && (
+                    <a
+                      href={msg.media_url}
+                      target="_blank"
+                      rel="noreferrer"
+                      className="flex items-center gap-2 mb-1 p-2 rounded bg-black/20 hover:bg-black/30"
+                    >
+                      <FileText size={20} className="shrink-0" />
+                      <span className="truncate">{msg.media_name || "File"}</span>
+                      <span className="text-xs opacity-70 shrink-0">{formatFileSize(msg.media_size)}</span>
+                    </a>
+                  )}
+                  {msg.content && <p>{msg.content}</p>}
                   <div className="flex items-center justify-end gap-1 mt-1">
                   <span className="text-[10px] opacity-70">
                     {new Date(
@@ -313,7 +485,7 @@ export default function ChatArea({
             <p className="text-emerald-500 text-xs font-bold mb-1">
               Replying to {replyTo.sender_id === currentUser.id ? "yourself" : selectedFriend.full_name || selectedFriend.username}
             </p>
-            <p className="text-slate-300 text-sm truncate">{replyTo.content}</p>
+            <p className="text-slate-300 text-sm truncate">{previewText(replyTo)}</p>
           </div>
           <button 
             onClick={() => setReplyTo(null)} 
@@ -324,8 +496,46 @@ export default function ChatArea({
         </div>
       )}
 
+      {attachment && (
+        <div className="bg-black/50 px-4 py-2 flex justify-between items-center rounded-t-lg mx-4 mt-2">
+          <div className="flex-1 min-w-0">
+            <p className="text-slate-300 text-sm truncate">{attachment.file.name}</p>
+            <p className={`text-xs ${attachment.status === "failed" ? "text-red-400" : "text-slate-400"}`}>
+              {attachment.status === "uploading" &&
+                `Uploading ${Math.floor((attachment.sent / attachment.file.size) * 100)}%`}
+              {attachment.status === "processing" && "Processing..."}
+              {attachment.status === "ready" && `Ready to send, ${formatFileSize(attachment.file.size)}`}
+              {attachment.status === "failed" && (attachment.error || "Upload failed")}
+            </p>
+          </div>
+          <button
+            onClick={() => setAttachment(null)}
+            className="text-slate-400 hover:text-white p-2 rounded-full hover:bg-slate-700 transition ml-2"
+          >
+            <X size={18} />
+          </button>
+        </div>
+      )}
+
       {/* Input */}
       <div className="shrink-0 p-3 bg-slate-800 border-t border-slate-700 flex items-end gap-2">
+        <input
+          ref={fileInputRef}
+          type="file"
+          className="hidden"
+          onChange={(e) => {
+            const file = e.target.files?.[0];
+            if (file) attachFile(file);
+            e.target.value = "";
+          }}
+        />
+        <button
+          onClick={() => fileInputRef.current?.click()}
+          disabled={attachment?.status === "uploading" || attachment?.status === "processing"}
+          className="p-3 text-slate-300 rounded-full hover:bg-slate-700 hover:text-white disabled:opacity-50"
+        >
+          <Paperclip className="w-6 h-6" />
+        </button>
         <textarea
           ref={textAreaRef}
           rows={1}
@@ -13,6 +13,7 @@ interface Friend {
   gender: string;
   allow_stranger_dms: boolean;
   profile_picture: string | null;
+  profile_thumbnail?: string | null;
   last_message_time: string | null;
   last_message_content: string | null;
   unread_count: number;
@@ -52,6 +53,13 @@ export default function ChatSidebar({ onSelectFriend, selectedFriendId, refreshT
 
     const ws = new WebSocket(`${import.meta.env.VITE_WS_URL}/chat/ws/${token}`);
 
+    // Heartbeat so the server doesn't drop the socket as idle
+    const heartbeat = setInterval(() => {
+      if (ws.readyState === WebSocket.OPEN) {
+        ws.send(JSON.stringify({ type: "ping" }));
+      }
+    }, 25000);
+
     ws.onmessage = (event) => {
       const data = JSON.parse(event.data);
 
@@ -99,6 +107,7 @@ export default function ChatSidebar({ onSelectFriend, selectedFriendId, refreshT
     };
 
     return () => {
+      clearInterval(heartbeat);
       ws.close();
     };
   }, [token, selectedFriendId]); // Re-run if we select a different friend so isCurrentlyOpen is accurate
@@ -150,7 +159,7 @@ export default function ChatSidebar({ onSelectFriend, selectedFriendId, refreshT
               >
                 <div className="w-12 h-12 rounded-full bg-slate-600 flex-shrink-0 overflow-hidden">
                   {friend.profile_picture ? (
-                    <img src={friend.profile_picture} alt={friend.username} className="w-full h-full object-cover"/>
+                    <img src={friend.profile_thumbnail || friend.profile_picture} alt={friend.username} className="w-full h-full object-cover"/>
                   ) : (
                     <div className="w-full h-full flex items-center justify-center text-slate-300 font-bold text-lg">
                         {friend.username[0].toUpperCase()}
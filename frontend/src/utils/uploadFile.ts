@@ -0,0 +1,67 @@
+const CHUNK_BYTES = 1024 * 1024;
+const MAX_RETRIES = 5;
+
+export interface UploadJob {
+    job_id: string;
+    status: string;
+    expires_at: string | null;
+}
+
+const errorDetail = async (res: Response) => {
+    try {
+        const data = await res.json();
+        return data.detail || res.statusText;
+    } catch {
+        return res.statusText;
+    }
+};
+
+// Resumable upload: declare the size, then send chunks at the offset the server reports.
+// After a dropped request it asks for the offset again and carries on from there.
+export const uploadFile = async (
+    file: File,
+    token: string,
+    onProgress?: (sent: number) => void
+): Promise<UploadJob> => {
+    const api = `${import.meta.env.VITE_API_URL}/uploads/files`;
+    const headers = { Authorization: `Bearer ${token}` };
+
+    const created = await fetch(api, {
+        method: "POST",
+        headers: { ...headers, "Content-Type": "application/json" },
+        body: JSON.stringify({ filename: file.name, size: file.size })
+    });
+    if (!created.ok) throw new Error(await errorDetail(created));
+    const { upload_id } = await created.json();
+
+    let offset = 0;
+    let retries = 0;
+    while (true) {
+        try {
+            const res = await fetch(`${api}/${upload_id}`, {
+                method: "PATCH",
+                headers: { ...headers, "Upload-Offset": String(offset) },
+                body: file.slice(offset, offset + CHUNK_BYTES)
+            });
+            if (res.status >= 400 && res.status < 500 && res.status !== 409) {
+                throw new Error(await errorDetail(res));
+            }
+            if (res.ok) {
+                const data = await res.json();
+                offset = data.offset;
+                retries = 0;
+                onProgress?.(offset);
+                if (data.job) return data.job;
+                continue;
+            }
+        } catch (err) {
+            if (err instanceof Error && !(err instanceof TypeError)) throw err;
+        }
+
+        // Network error, conflict or server error: resume from wherever the server got to
+        if (++retries > MAX_RETRIES) throw new Error("Upload failed, please try again");
+        await new Promise((resolve) => setTimeout(resolve, 1000 * retries));
+        const status = await fetch(`${api}/${upload_id}`, { headers }).catch(() => null);
+        if (status?.ok) offset = (await status.json()).offset;
+    }
+};